@@ -1,13 +1,40 @@
+import abc
+import asyncio
+import contextvars
 import os
+import re
 import logging
-from datetime import datetime
+import sqlite3
+import base64
+import fcntl
+import hashlib
+import hmac
+import json
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict, deque
+from datetime import date, datetime
 from functools import wraps
+from zoneinfo import ZoneInfo
+import click
+import codecs
+import csv
+import io
+from urllib.parse import quote
+import httpx
+import jwt
 from dotenv import load_dotenv
-from flask import Flask, render_template, request, redirect, url_for, flash, session, g, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, session, g, jsonify, stream_with_context, has_app_context
 from supabase import create_client, Client
 from gotrue.errors import AuthApiError
 from postgrest.exceptions import APIError
+from postgrest.constants import DEFAULT_POSTGREST_CLIENT_TIMEOUT
 import itertools
+import atexit
+import queue
+from contextlib import contextmanager
+from postgrest import AsyncPostgrestClient, SyncPostgrestClient, SyncQueryRequestBuilder, SyncSingleRequestBuilder, SyncMaybeSingleRequestBuilder
 
 # --- Initialization ---
 
@@ -30,6 +57,115 @@ if not supabase_url or not supabase_key:
     raise ValueError("Supabase credentials not found in environment variables")
 supabase: Client = create_client(supabase_url, supabase_key)
 
+# JWT verification settings
+# AUTH_VERIFY_MODE=local verifies the signature and expiry of the session JWT in-process,
+# using SUPABASE_JWT_SECRET (HS256) if set, otherwise the project's JWKS endpoint.
+auth_verify_mode = os.environ.get("AUTH_VERIFY_MODE", "remote").lower()
+supabase_jwt_secret = os.environ.get("SUPABASE_JWT_SECRET")
+supabase_jwks_url = os.environ.get("SUPABASE_JWKS_URL", f"{supabase_url.rstrip('/')}/auth/v1/.well-known/jwks.json")
+auth_cache_ttl = int(os.environ.get("AUTH_CACHE_TTL", 300))
+auth_cache_max_size = int(os.environ.get("AUTH_CACHE_MAX_SIZE", 1024))
+
+# Timeout (seconds) of PostgREST requests, sync and async; a gather_queries() call is cancelled after it too
+db_timeout = float(os.environ.get("DB_TIMEOUT", DEFAULT_POSTGREST_CLIENT_TIMEOUT))
+
+# Number of idle PostgREST clients (each with its own keep-alive connection) kept per worker
+supabase_pool_size = int(os.environ.get("SUPABASE_POOL_SIZE", 8))
+
+# Independent queries of a request (see gather_queries) run concurrently on a per-worker asyncio
+# loop sharing one async connection pool; ASYNC_DB_ENABLED=false runs them one after another
+async_db_enabled = os.environ.get("ASYNC_DB_ENABLED", "true").lower() == "true"
+async_db_max_connections = int(os.environ.get("ASYNC_DB_MAX_CONNECTIONS", 20))
+
+# Page size for keyset-paginated reads. Must not exceed the PostgREST max-rows setting (1000 on Supabase).
+db_page_size = int(os.environ.get("DB_PAGE_SIZE", 1000))
+
+# Work history writes: 'sync' inserts before the response returns, 'async' queues rows
+# for a background thread that flushes them in batches with retry (rows of a session whose
+# token would expire before the flush are inserted synchronously)
+history_write_mode = os.environ.get("HISTORY_WRITE_MODE", "sync").lower()
+history_batch_size = int(os.environ.get("HISTORY_BATCH_SIZE", 500))
+history_flush_interval = float(os.environ.get("HISTORY_FLUSH_INTERVAL", 1.0))
+history_max_retries = int(os.environ.get("HISTORY_MAX_RETRIES", 3))
+# Work history pages: rows per page of the /history browser and per timeline on the part and
+# production pages. HISTORY_TIMEZONE is the time zone of the browser's date filters.
+history_page_size = int(os.environ.get("HISTORY_PAGE_SIZE", 50))
+history_timeline_size = int(os.environ.get("HISTORY_TIMELINE_SIZE", 20))
+history_timezone = ZoneInfo(os.environ.get("HISTORY_TIMEZONE", "Asia/Tokyo"))
+
+# Search backend: 'ilike' ORs five ILIKE conditions, 'trgm' calls the search_parts_ranked RPC
+# (see supabase/migrations) and falls back to ILIKE if the RPC is unavailable
+search_mode = os.environ.get("SEARCH_MODE", "ilike").lower()
+search_cache_ttl = int(os.environ.get("SEARCH_CACHE_TTL", 60))
+search_cache_max_size = int(os.environ.get("SEARCH_CACHE_MAX_SIZE", 256))
+
+# Production summary cache (per production number), invalidated on writes
+production_summary_cache_ttl = int(os.environ.get("PRODUCTION_SUMMARY_CACHE_TTL", 300))
+production_summary_cache_max_size = int(os.environ.get("PRODUCTION_SUMMARY_CACHE_MAX_SIZE", 512))
+
+# Page size of the /inventory and /all lists (LIST_MAX_PAGE_SIZE caps the per_page parameter)
+list_page_size = int(os.environ.get("LIST_PAGE_SIZE", 100))
+list_max_page_size = int(os.environ.get("LIST_MAX_PAGE_SIZE", 200))
+
+# Location snapshot refresh intervals (seconds) for the inventory maps
+map_snapshot_refresh_interval = float(os.environ.get("MAP_SNAPSHOT_REFRESH_INTERVAL", 5))
+map_snapshot_full_refresh_interval = float(os.environ.get("MAP_SNAPSHOT_FULL_REFRESH_INTERVAL", 600))
+
+# Live map updates (Server-Sent Events). With several gunicorn workers set LOCATION_EVENTS_FILE
+# to a path shared by all workers on the host (e.g. under /dev/shm) so events reach every worker.
+location_events_file = os.environ.get("LOCATION_EVENTS_FILE")
+location_events_poll_interval = float(os.environ.get("LOCATION_EVENTS_POLL_INTERVAL", 0.5))
+location_events_keepalive = float(os.environ.get("LOCATION_EVENTS_KEEPALIVE", 15))
+# Streams are closed after this many seconds so the worker thread is freed; browsers reconnect
+location_events_max_duration = float(os.environ.get("LOCATION_EVENTS_MAX_DURATION", 300))
+# Most streams open at once per worker. Each holds one of the worker's threads (--threads in the
+# Procfile), so keep it well below that; map pages refused a stream poll /api/v1/locations instead
+location_events_max_streams = int(os.environ.get("LOCATION_EVENTS_MAX_STREAMS", 8))
+# LOCATION_EVENTS_FILE is replaced by an empty file once it grows past this many bytes (0: never)
+location_events_file_max_bytes = int(os.environ.get("LOCATION_EVENTS_FILE_MAX_BYTES", 8 * 1024 * 1024))
+
+# Change feed keeping the caches of all workers coherent. 'realtime' subscribes to changes of parts
+# through Supabase Realtime (see supabase/migrations); 'file' tails CHANGE_FEED_FILE, a stand-in for
+# local testing that every worker of a host appends its writes to; 'off' relies on refresh intervals.
+change_feed_mode = os.environ.get("CHANGE_FEED_MODE", "off").lower()
+change_feed_file = os.environ.get("CHANGE_FEED_FILE")
+change_feed_poll_interval = float(os.environ.get("CHANGE_FEED_POLL_INTERVAL", 0.5))
+# CHANGE_FEED_FILE is replaced by an empty file once it grows past this many bytes (0: never)
+change_feed_file_max_bytes = int(os.environ.get("CHANGE_FEED_FILE_MAX_BYTES", 8 * 1024 * 1024))
+if any(0 < max_bytes < 65536 for max_bytes in (location_events_file_max_bytes, change_feed_file_max_bytes)):
+    # Holes are tracked in pages, so a smaller limit would replace the file on every write
+    raise ValueError("LOCATION_EVENTS_FILE_MAX_BYTES and CHANGE_FEED_FILE_MAX_BYTES must be 0 or at least 65536")
+# Token of the Realtime subscription, which row-level security applies to. If unset, a short-lived
+# token is signed with SUPABASE_JWT_SECRET, or the anon key is used.
+change_feed_access_token = os.environ.get("CHANGE_FEED_ACCESS_TOKEN")
+if change_feed_mode not in ('off', 'realtime', 'file'):
+    raise ValueError("CHANGE_FEED_MODE must be one of: off, realtime, file")
+if change_feed_mode == 'file' and not change_feed_file:
+    raise ValueError("CHANGE_FEED_FILE must be set when CHANGE_FEED_MODE=file")
+
+# Most (production number, from, to) operations accepted by one /api/v1/moves/batch request
+move_batch_max_size = int(os.environ.get("MOVE_BATCH_MAX_SIZE", 200))
+
+# Once the database answers that a function does not exist (PGRST202: migration not applied),
+# calls take their fallback without asking again for this many seconds
+rpc_missing_retry_interval = float(os.environ.get("RPC_MISSING_RETRY_INTERVAL", 600))
+
+# Bulk import: rows per upsert, and the most row errors listed in an import report
+import_batch_size = int(os.environ.get("IMPORT_BATCH_SIZE", 500))
+import_max_reported_errors = int(os.environ.get("IMPORT_MAX_REPORTED_ERRORS", 1000))
+
+# Optional local read replica of the parts table: a SQLite file shared by the workers of a host.
+# Read routes are served from it; writes go to Supabase and are applied to it. The replica does
+# not apply row-level security, so every logged-in user reads the same rows.
+read_replica_path = os.environ.get("READ_REPLICA_PATH")
+read_replica_sync_interval = float(os.environ.get("READ_REPLICA_SYNC_INTERVAL", 5))
+read_replica_full_sync_interval = float(os.environ.get("READ_REPLICA_FULL_SYNC_INTERVAL", 3600))
+
+# Request instrumentation. /metrics is open to logged-in users and to scrapers sending
+# "Authorization: Bearer <METRICS_TOKEN>". Metrics are per worker process.
+metrics_token = os.environ.get("METRICS_TOKEN")
+request_log_enabled = os.environ.get("REQUEST_LOG_ENABLED", "true").lower() == "true"
+
 
 # --- Custom Jinja2 Filter ---
 def flatten_filter(list_of_lists):
@@ -39,31 +175,527 @@ def flatten_filter(list_of_lists):
 app.jinja_env.filters['flatten'] = flatten_filter
 
 
+# --- Caching ---
+
+class TTLCache:
+    """
+    A small thread-safe LRU cache whose entries expire after a TTL.
+    Each entry may also carry its own expiry time, which is capped by the cache TTL.
+    """
+
+    def __init__(self, max_size=1024, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, expires_at=None):
+        max_expires_at = time.time() + self.ttl
+        expires_at = min(expires_at, max_expires_at) if expires_at else max_expires_at
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return entry[1] if entry else default
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {'size': len(self._entries), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses}
+
+
+class GenerationalCache(TTLCache):
+    """
+    A TTLCache that is invalidated wholesale by bumping a generation counter.
+    Callers read the generation before computing a value and store it under that generation,
+    so a result computed concurrently with a write is never served after the write.
+    """
+
+    def __init__(self, max_size=1024, ttl=300):
+        super().__init__(max_size=max_size, ttl=ttl)
+        self.generation = 0
+
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        return {**super().stats(), 'generation': self.generation}
+
+
+# --- Instrumentation ---
+
+class RequestStats:
+    """Database usage of the current request, collected by the instrumented PostgREST client."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.db_calls = 0
+        self.db_time = 0.0
+        self.db_bytes = 0
+
+
+def current_request_stats():
+    """Returns the stats of the request being handled, or None outside a request (e.g. background threads)."""
+    return g.get('request_stats') if has_app_context() else None
+
+
+def instrument_execute(execute):
+    """Wraps a PostgREST builder's execute() to count the call and its latency for the current request."""
+    @wraps(execute)
+    def instrumented_execute(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return execute(self, *args, **kwargs)
+        finally:
+            stats = current_request_stats()
+            if stats is not None:
+                stats.db_calls += 1
+                stats.db_time += time.perf_counter() - started
+    return instrumented_execute
+
+
+# Every query, RPC and write goes through one of these builders
+for _builder_class in (SyncQueryRequestBuilder, SyncSingleRequestBuilder, SyncMaybeSingleRequestBuilder):
+    _builder_class.execute = instrument_execute(_builder_class.execute)
+
+
+def record_response_bytes(response):
+    """httpx response hook: adds the size of a PostgREST response body to the current request's stats."""
+    stats = current_request_stats()
+    if stats is not None:
+        response.read()
+        stats.db_bytes += len(response.content)
+
+
+class EndpointMetrics:
+    """Per-endpoint request counters and histograms, rendered in the Prometheus text format."""
+
+    DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    DB_CALL_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = Counter()
+        self._db_bytes = Counter()
+        self._histograms = {
+            'request_duration_seconds': ({}, self.DURATION_BUCKETS, "Time spent handling a request."),
+            'request_db_seconds': ({}, self.DURATION_BUCKETS, "Time spent in database calls per request."),
+            'request_db_calls': ({}, self.DB_CALL_BUCKETS, "Database round trips per request."),
+        }
+
+    def observe(self, endpoint, method, status, stats, duration):
+        with self._lock:
+            self._requests[(endpoint, method, status)] += 1
+            self._db_bytes[endpoint] += stats.db_bytes
+            self._observe('request_duration_seconds', endpoint, duration)
+            self._observe('request_db_seconds', endpoint, stats.db_time)
+            self._observe('request_db_calls', endpoint, stats.db_calls)
+
+    def _observe(self, name, endpoint, value):
+        series, buckets, _ = self._histograms[name]
+        counts = series.get(endpoint)
+        if counts is None:
+            # One count per bucket, then +Inf, then the sum
+            counts = series[endpoint] = [0] * (len(buckets) + 1) + [0.0]
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                counts[i] += 1
+        counts[len(buckets)] += 1
+        counts[-1] += value
+
+    def render(self, prefix='inventory_dashboard'):
+        lines = [f"# HELP {prefix}_requests_total Requests handled.", f"# TYPE {prefix}_requests_total counter"]
+        with self._lock:
+            for (endpoint, method, status), count in sorted(self._requests.items()):
+                lines.append(f'{prefix}_requests_total{{endpoint="{endpoint}",method="{method}",status="{status}"}} {count}')
+            lines += [f"# HELP {prefix}_db_response_bytes_total Bytes received from the database.",
+                      f"# TYPE {prefix}_db_response_bytes_total counter"]
+            for endpoint, total in sorted(self._db_bytes.items()):
+                lines.append(f'{prefix}_db_response_bytes_total{{endpoint="{endpoint}"}} {total}')
+            for name, (series, buckets, help_text) in self._histograms.items():
+                lines += [f"# HELP {prefix}_{name} {help_text}", f"# TYPE {prefix}_{name} histogram"]
+                for endpoint, counts in sorted(series.items()):
+                    for bound, count in zip(buckets, counts):
+                        lines.append(f'{prefix}_{name}_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}')
+                    lines.append(f'{prefix}_{name}_bucket{{endpoint="{endpoint}",le="+Inf"}} {counts[len(buckets)]}')
+                    lines.append(f'{prefix}_{name}_sum{{endpoint="{endpoint}"}} {counts[-1]}')
+                    lines.append(f'{prefix}_{name}_count{{endpoint="{endpoint}"}} {counts[len(buckets)]}')
+        return '\n'.join(lines) + '\n'
+
+
+endpoint_metrics = EndpointMetrics()
+
+
+# --- Database Client Pool ---
+
+def create_postgrest_client():
+    """Creates a PostgREST client with its own keep-alive HTTP connection pool."""
+    client = SyncPostgrestClient(
+        f"{supabase_url.rstrip('/')}/rest/v1",
+        headers={'apiKey': supabase_key, 'Authorization': f"Bearer {supabase_key}"},
+        timeout=db_timeout,
+    )
+    event_hooks = client.session.event_hooks
+    event_hooks['response'].append(record_response_bytes)
+    client.session.event_hooks = event_hooks
+    return client
+
+
+class PostgrestClientPool:
+    """
+    A pool of PostgREST clients. A request borrows a client bound to the caller's token
+    and returns it afterwards, so concurrent requests never share an Authorization header.
+    When the pool is empty a new client is created; surplus clients are closed on release.
+    """
+
+    def __init__(self, factory, size):
+        self._factory = factory
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def acquire(self, token=None):
+        try:
+            client = self._idle.get_nowait()
+        except queue.Empty:
+            client = self._factory()
+        client.auth(token or supabase_key)
+        return client
+
+    def release(self, client):
+        # Never leave a user's token on an idle client
+        client.auth(supabase_key)
+        try:
+            self._idle.put_nowait(client)
+        except queue.Full:
+            self._close(client)
+
+    @contextmanager
+    def borrow(self, token=None):
+        client = self.acquire(token)
+        try:
+            yield client
+        finally:
+            self.release(client)
+
+    def drain(self):
+        """Closes all idle clients."""
+        while True:
+            try:
+                self._close(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+    @staticmethod
+    def _close(client):
+        try:
+            client.session.close()
+        except Exception as e:
+            logging.warning(f"Failed to close PostgREST client: {e}")
+
+
+postgrest_pool = PostgrestClientPool(create_postgrest_client, supabase_pool_size)
+
+
+# --- Background Threads ---
+
+class LazyThread:
+    """
+    Daemon thread started on first use instead of at import. The gunicorn master imports the
+    app before forking the workers and threads do not survive a fork, so starting on first use
+    creates the thread in the worker process. ensure_started() also restarts a thread that died.
+    """
+
+    def __init__(self, target, name):
+        self.target = target
+        self.name = name
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self, before_start=None):
+        """
+        Starts the thread unless it is running; before_start is called first, under the same lock,
+        to set up what the thread uses. Returns True if the thread was (re)started by this call.
+        """
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return False
+            if before_start is not None:
+                before_start()
+            self._thread = threading.Thread(target=self.target, name=self.name, daemon=True)
+            self._thread.start()
+            return True
+
+    def is_alive(self):
+        """Whether the thread is running in this process (a thread of the master is not, after the fork)."""
+        return self._thread is not None and self._thread.is_alive()
+
+
+# --- Concurrent Queries ---
+
+# Byte counter of the gather() call whose queries are running (see record_async_response_bytes)
+_gathered_response_bytes = contextvars.ContextVar('gathered_response_bytes', default=None)
+
+
+async def record_async_response_bytes(response):
+    """httpx response hook of the async client: adds the body size to the counter of the gather() call that sent it."""
+    counter = _gathered_response_bytes.get()
+    if counter is not None:
+        await response.aread()
+        counter[0] += len(response.content)
+
+
+def create_async_http_client():
+    """Creates the async HTTP connection pool shared by the concurrent queries of all requests of a worker."""
+    return httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=async_db_max_connections),
+        timeout=db_timeout,
+        follow_redirects=True,
+        http2=True,
+        event_hooks={'response': [record_async_response_bytes]},
+    )
+
+
+class ConcurrentQueryRunner:
+    """
+    Runs independent PostgREST queries concurrently.
+    Each worker process has one asyncio event loop on a background thread and one async
+    connection pool used by all requests. The request thread blocks until its queries are
+    done, so it waits for the slowest query instead of the sum of all of them.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._loop = None
+        self._http_client = None
+        self._thread = LazyThread(self._run_loop, 'postgrest-async')
+
+    def _ensure_started(self):
+        # A restarted thread gets a new loop and connections; those of a dead one (or of the master) are unusable
+        self._thread.ensure_started(before_start=self._create_loop)
+        return self._loop, self._http_client
+
+    def _create_loop(self):
+        self._loop = asyncio.new_event_loop()
+        self._http_client = self._factory()
+
+    def _run_loop(self):
+        self._loop.run_forever()
+
+    def gather(self, queries, token=None, return_exceptions=False):
+        """Executes the queries with the given user's token and returns their responses in order."""
+        loop, http_client = self._ensure_started()
+        client = AsyncPostgrestClient(
+            f"{supabase_url.rstrip('/')}/rest/v1",
+            headers={'apiKey': supabase_key, 'Authorization': f"Bearer {token or supabase_key}"},
+            http_client=http_client,
+        )
+        received = [0]
+        started = time.perf_counter()
+        future = asyncio.run_coroutine_threadsafe(self._gather(client, queries, return_exceptions, received), loop)
+        try:
+            # The per-request timeout bounds each read, not the whole call, so the request thread gets a deadline too
+            return future.result(timeout=db_timeout)
+        except TimeoutError:
+            future.cancel()
+            raise TimeoutError(f"Concurrent queries did not finish within {db_timeout} seconds")
+        finally:
+            stats = current_request_stats()
+            if stats is not None:
+                stats.db_calls += len(queries)
+                stats.db_time += time.perf_counter() - started
+                stats.db_bytes += received[0]
+
+    @staticmethod
+    async def _gather(client, queries, return_exceptions, received):
+        # Tasks started by asyncio.gather inherit this context, so the response hook sees the counter
+        _gathered_response_bytes.set(received)
+        return await asyncio.gather(*(query(client).execute() for query in queries), return_exceptions=return_exceptions)
+
+    def close(self):
+        """Closes the connection pool and stops the loop. Called at interpreter exit."""
+        if not self._thread.is_alive():
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self._http_client.aclose(), self._loop).result(timeout=5)
+        except Exception as e:
+            logging.warning(f"Failed to close the async PostgREST connection pool: {e}")
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+concurrent_queries = ConcurrentQueryRunner(create_async_http_client)
+atexit.register(concurrent_queries.close)
+
+
+def gather_queries(*queries, return_exceptions=False):
+    """
+    Executes independent queries of the current request and returns their responses in order.
+    Each query is a function that takes a PostgREST client and returns a query builder, e.g.
+    `lambda db: db.table('parts').select('id').eq('production_no', production_no)`, so the same
+    query runs on the async client or, with ASYNC_DB_ENABLED=false, on g.db.
+    With return_exceptions=True a failed query's exception is returned in its place.
+    """
+    if async_db_enabled and len(queries) > 1:
+        return concurrent_queries.gather(queries, session.get('user_jwt'), return_exceptions)
+    results = []
+    for query in queries:
+        try:
+            results.append(query(g.db).execute())
+        except Exception as e:
+            if not return_exceptions:
+                raise
+            results.append(e)
+    return results
+
+
+# --- Authentication Helpers ---
+
+# Verified Supabase users keyed by the SHA-256 hash of their access token
+verified_user_cache = TTLCache(max_size=auth_cache_max_size, ttl=auth_cache_ttl)
+_jwks_client = None
+
+
+def _token_cache_key(token: str) -> str:
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def _get_jwks_client():
+    """Lazily creates the JWKS client. Signing keys are cached by PyJWT."""
+    global _jwks_client
+    if _jwks_client is None:
+        _jwks_client = jwt.PyJWKClient(supabase_jwks_url, cache_keys=True, lifespan=auth_cache_ttl)
+    return _jwks_client
+
+
+def verify_jwt_locally(token: str) -> dict:
+    """
+    Verifies the signature and expiry of a Supabase access token without a network call
+    (apart from the occasional JWKS refresh). Raises jwt.InvalidTokenError if invalid.
+    """
+    options = {'require': ['exp', 'sub']}
+    if supabase_jwt_secret:
+        return jwt.decode(token, supabase_jwt_secret, algorithms=['HS256'], audience='authenticated', options=options)
+    signing_key = _get_jwks_client().get_signing_key_from_jwt(token)
+    return jwt.decode(token, signing_key.key, algorithms=['RS256', 'ES256'], audience='authenticated', options=options)
+
+
+def get_verified_user(token: str):
+    """
+    Returns the Supabase user for an access token.
+    Users are served from a bounded TTL cache and only revalidated against Supabase Auth
+    once their cache entry expires. Cache entries never outlive the token's own expiry.
+    """
+    if auth_verify_mode == 'local':
+        claims = verify_jwt_locally(token)
+    else:
+        # The token is verified remotely before it is cached, so the unverified claims can be trusted here
+        claims = jwt.decode(token, options={'verify_signature': False})
+        if claims.get('exp') and claims['exp'] <= time.time():
+            raise jwt.ExpiredSignatureError("Signature has expired")
+
+    cache_key = _token_cache_key(token)
+    user = verified_user_cache.get(cache_key)
+    if user is not None:
+        return user
+
+    user = supabase.auth.get_user(token).user
+    if user is not None:
+        verified_user_cache.set(cache_key, user, expires_at=claims.get('exp'))
+    return user
+
+
 # --- Decorators & Hooks ---
 
+@app.before_request
+def start_request_stats():
+    """Start timing the request. Registered first so the timing includes authentication."""
+    g.request_stats = RequestStats()
+
+
 @app.before_request
 def before_request():
-    """Set user object in g and supabase auth if logged in."""
+    """Set user object in g and borrow a database client bound to the user's token."""
     g.user = None
+    token = None
     if 'user_jwt' in session:
         try:
-            # Set the auth token for the client for this request
-            supabase.postgrest.auth(session['user_jwt'])
-            user_info = supabase.auth.get_user(session['user_jwt'])
-            g.user = user_info.user
-        except AuthApiError as e:
+            g.user = get_verified_user(session['user_jwt'])
+            if g.user is None:
+                logging.warning("No user found for session JWT, clearing session")
+                session.clear()
+            else:
+                token = session['user_jwt']
+        except (AuthApiError, jwt.InvalidTokenError) as e:
             logging.warning(f"Invalid JWT, clearing session: {e}")
             session.clear() # Clear invalid session
-            # After clearing session, reset auth to anon key
-            supabase.postgrest.auth(os.environ.get("SUPABASE_ANON_KEY"))
         except Exception as e:
             logging.error(f"Error getting user from JWT: {e}")
             session.clear()
-            # After clearing session, reset auth to anon key
-            supabase.postgrest.auth(os.environ.get("SUPABASE_ANON_KEY"))
-    else:
-        # For requests without a logged-in user, ensure we use the anon key
-        supabase.postgrest.auth(os.environ.get("SUPABASE_ANON_KEY"))
+    # Requests without a logged-in user use the anon key
+    g.db = postgrest_pool.acquire(token)
+
+
+@app.before_request
+def start_change_feed():
+    """Starts the change feed in this worker process on its first request."""
+    if change_feed is not None:
+        change_feed.ensure_started()
+
+
+@app.after_request
+def record_request_stats(response):
+    """Adds a Server-Timing header, logs the request's timings and records them in the endpoint metrics."""
+    stats = g.pop('request_stats', None)
+    if stats is None:
+        return response
+    # Streamed responses (exports, event streams) are measured until their headers are ready
+    duration = time.perf_counter() - stats.started
+    endpoint = request.endpoint or 'unmatched'
+    response.headers['Server-Timing'] = (
+        f'db;dur={stats.db_time * 1000:.1f};desc="{stats.db_calls} calls, {stats.db_bytes} bytes", '
+        f'app;dur={(duration - stats.db_time) * 1000:.1f}, total;dur={duration * 1000:.1f}'
+    )
+    endpoint_metrics.observe(endpoint, request.method, response.status_code, stats, duration)
+    if request_log_enabled:
+        logging.info(f"request method={request.method} path={request.path} endpoint={endpoint} "
+                     f"status={response.status_code} duration_ms={duration * 1000:.1f} db_calls={stats.db_calls} "
+                     f"db_ms={stats.db_time * 1000:.1f} db_bytes={stats.db_bytes}")
+    return response
+
+
+@app.teardown_request
+def teardown_request(exc):
+    """Return the borrowed database client to the pool."""
+    db = g.pop('db', None)
+    if db is not None:
+        postgrest_pool.release(db)
 
 
 def login_required(f):
@@ -71,78 +703,2202 @@ def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if g.user is None:
+            if request.path.startswith('/api/'):
+                return jsonify({'success': False, 'message': 'ログインが必要です。'}), 401
             flash("このページにアクセスするにはログインが必要です。", "warning")
             return redirect(url_for('login'))
         return f(*args, **kwargs)
     return decorated_function
 
 
-# --- Helper Functions ---
+# --- Helper Functions ---
+
+def escape_like_term(term: str) -> str:
+    """
+    Escapes special characters for PostgreSQL LIKE/ILIKE queries and adds wildcards for substring matching.
+    The backslash is the escape character in PostgreSQL's standard_conforming_strings.
+    """
+    if not term:
+        return "%%"
+    # Escape backslash, then percent, then underscore.
+    # The order is important.
+    escaped_term = term.replace('\\', '\\\\').replace('%', '\%').replace('_', '\_')
+    return f"%{escaped_term}%"
+
+
+def safe_int_convert(value, default=None):
+
+    """
+    Safely converts a value to an integer.
+    Returns the default value (or None) if conversion fails.
+    """
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        return default
+
+
+def build_history_entry(item_id, production_no, parts_name, action, details):
+    """Builds a work_history row."""
+    return {
+        'item_id': item_id,
+        'production_no': production_no,
+        'parts_name': parts_name,
+        'action': action,
+        'details': details,
+    }
+
+
+def insert_work_history(db, entries):
+    """Inserts work_history rows with a single multi-row insert."""
+    for start in range(0, len(entries), history_batch_size):
+        db.table('work_history').insert(entries[start:start + history_batch_size]).execute()
+
+
+class HistoryWriter:
+    """
+    Background writer for work_history rows.
+    Entries are queued together with the token of the user who made the change and
+    flushed in batches (one insert per token per batch), retrying with backoff on failure.
+    """
+
+    # Allowance for the queue being behind, on top of the flush interval and retry backoff
+    QUEUE_DELAY_MARGIN = 30
+
+    def __init__(self, batch_size, flush_interval, max_retries):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self._queue = queue.Queue()
+        self._thread = LazyThread(self._run, 'history-writer')
+
+    def max_delay(self):
+        """Longest time (in seconds) a queued entry is expected to wait until its last write attempt."""
+        return self.flush_interval + sum(2 ** (attempt - 1) for attempt in range(1, self.max_retries)) + self.QUEUE_DELAY_MARGIN
+
+    def accepts(self, token):
+        """
+        Whether entries written with the token can be queued: the token must still be valid when
+        they are flushed, or the insert is refused under RLS and the rows are lost.
+        """
+        if not token:
+            return True
+        try:
+            expires = jwt.decode(token, options={'verify_signature': False}).get('exp')
+        except jwt.PyJWTError:
+            return False
+        return expires is None or expires - time.time() > self.max_delay()
+
+    def enqueue(self, token, entries):
+        self._thread.ensure_started()
+        for entry in entries:
+            self._queue.put((token, entry))
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def flush(self):
+        """Writes everything still queued. Called at interpreter exit."""
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self._write(batch)
+
+    def _write(self, batch):
+        entries_by_token = {}
+        for token, entry in batch:
+            entries_by_token.setdefault(token, []).append(entry)
+
+        for token, entries in entries_by_token.items():
+            for attempt in range(1, self.max_retries + 1):
+                try:
+                    with postgrest_pool.borrow(token) as db:
+                        insert_work_history(db, entries)
+                    break
+                except Exception as e:
+                    if attempt == self.max_retries:
+                        logging.error(f"Failed to write {len(entries)} work history rows after {attempt} attempts: {e}")
+                    else:
+                        logging.warning(f"Failed to write work history (attempt {attempt}), retrying: {e}")
+                        time.sleep(2 ** (attempt - 1))
+
+
+history_writer = HistoryWriter(history_batch_size, history_flush_interval, history_max_retries)
+atexit.register(history_writer.flush)
+
+
+def log_work_history_bulk(entries):
+    """
+    Logs several actions to the work_history table in one round trip,
+    or hands them to the background writer when HISTORY_WRITE_MODE=async.
+    """
+    if not entries:
+        return
+    # Rows of a session whose token expires before they would be flushed are written now instead
+    if history_write_mode == 'async' and history_writer.accepts(session.get('user_jwt')):
+        history_writer.enqueue(session.get('user_jwt'), entries)
+        return
+    try:
+        insert_work_history(g.db, entries)
+    except Exception as e:
+        logging.error(f"Failed to log work history: {e}")
+
+
+def log_work_history(item_id, production_no, parts_name, action, details):
+    """Logs an action to the work_history table."""
+    log_work_history_bulk([build_history_entry(item_id, production_no, parts_name, action, details)])
+
+
+# Database function name -> time.monotonic() of its last PGRST202 answer in this process
+missing_rpcs = {}
+
+
+def rpc_missing(name):
+    """Whether the database recently answered that the function does not exist."""
+    missing_since = missing_rpcs.get(name)
+    return missing_since is not None and time.monotonic() - missing_since < rpc_missing_retry_interval
+
+
+def mark_rpc_missing(name, error):
+    missing_rpcs[name] = time.monotonic()
+    logging.warning(f"{name} RPC unavailable, not calling it for {rpc_missing_retry_interval:.0f} seconds: {error.message}")
+
+
+def move_production_parts(db, production_no, from_location, to_location, action, details_prefix):
+    """
+    Moves the parts of a production number to another location and records their history.
+    from_location=None moves the parts wherever they are.
+    Uses the move_production_parts RPC (one transaction, one round trip); falls back to
+    select + update + history insert if the function has not been created yet.
+    Returns the moved rows, each with its 'previous_storage_location'.
+    """
+    if not rpc_missing('move_production_parts'):
+        try:
+            response = db.rpc('move_production_parts', {
+                'p_production_no': production_no,
+                'p_from_location': from_location,
+                'p_to_location': to_location,
+                'p_action': action,
+                'p_details_prefix': details_prefix,
+                # The app's clock, like every other writer of updated_at
+                'p_updated_at': datetime.now().isoformat(),
+            }).execute()
+            return response.data or []
+        except APIError as e:
+            # Any other error comes from the transaction, which has been rolled back
+            if e.code != 'PGRST202':
+                raise
+            mark_rpc_missing('move_production_parts', e)
+
+    def apply_filters(query):
+        query = query.eq('production_no', production_no)
+        return query.eq('storage_location', from_location) if from_location is not None else query
+
+    items_to_move = list(iter_parts(db, 'id, production_no, parts_name, storage_location', apply_filters))
+    if not items_to_move:
+        return []
+    update_payload = {'storage_location': to_location, 'updated_at': datetime.now().isoformat()}
+    update_response = db.table('parts').update(update_payload).in_('id', [item['id'] for item in items_to_move]).execute()
+    if not update_response.data:
+        logging.warning(f"Database update returned no rows for the move of {production_no}. Response: {update_response}")
+        return []
+
+    # Only rows the update returned were moved
+    previous_locations = {str(item['id']): item.get('storage_location') for item in items_to_move}
+    moved = [dict(row, previous_storage_location=previous_locations.get(str(row['id']))) for row in update_response.data]
+    log_work_history_bulk([
+        build_history_entry(
+            item_id=item['id'],
+            production_no=production_no,
+            parts_name=item['parts_name'],
+            action=action,
+            details=f"{details_prefix}により、保管場所が '{item['previous_storage_location']}' から '{to_location}' に変更されました。"
+        )
+        for item in moved
+    ])
+    return moved
+
+
+def validate_batch_moves(payload):
+    """
+    Validates the operations of a batch move request as a whole.
+    Returns (moves, errors): the normalized {'production_no', 'from_location', 'to_location'}
+    operations, and the error messages (empty if the batch is valid).
+    """
+    moves = payload.get('moves') if isinstance(payload, dict) else None
+    if not isinstance(moves, list) or not moves:
+        return [], ['移動内容 (moves) が指定されていません。']
+    if len(moves) > move_batch_max_size:
+        return [], [f"一度に移動できるのは {move_batch_max_size} 件までです。"]
+
+    normalized = []
+    errors = []
+    seen = set()
+    for index, move in enumerate(moves, start=1):
+        values = {key: str(move.get(key) or '').strip() if isinstance(move, dict) else ''
+                  for key in ('production_no', 'from_location', 'to_location')}
+        if not all(values.values()):
+            errors.append(f"{index} 件目: 製番・移動元・移動先は必須です。")
+            continue
+        if values['from_location'] == values['to_location']:
+            errors.append(f"{index} 件目: 移動元と移動先が同じです。")
+            continue
+        key = (values['production_no'], values['from_location'])
+        if key in seen:
+            errors.append(f"{index} 件目: 製番 '{key[0]}' の '{key[1]}' からの移動が重複しています。")
+            continue
+        seen.add(key)
+        normalized.append(values)
+    return normalized, errors
+
+
+def move_production_parts_batch(db, moves, action, details_format):
+    """
+    Moves the parts of several (production_no, from_location) pairs, each to its own
+    to_location, and records their history. Every operation moves the parts that were at
+    its from_location before the batch, so operations never depend on each other's order.
+    details_format is formatted with the production number to give each history prefix.
+    Uses the move_production_parts_batch RPC (one transaction, one round trip). There is no
+    fallback: separate requests could not move the batch all or nothing.
+    Returns (moved_rows, missing_moves): nothing is moved if any operation has no parts to move.
+    Returns (None, None) if the function has not been created yet.
+    """
+    if rpc_missing('move_production_parts_batch'):
+        return None, None
+    try:
+        response = db.rpc('move_production_parts_batch', {
+            'p_moves': moves,
+            'p_action': action,
+            'p_details_format': details_format,
+            'p_updated_at': datetime.now().isoformat(),
+        }).execute()
+        return response.data or [], []
+    except APIError as e:
+        if e.code == 'P0002':
+            # Raised (and rolled back) by the function when some operations found nothing to move
+            return [], json.loads(e.details or '[]')
+        if e.code != 'PGRST202':
+            raise
+        mark_rpc_missing('move_production_parts_batch', e)
+        return None, None
+
+
+def iter_part_batches(db, columns, apply_filters=None, batch_size=None, key='id'):
+    """
+    Yields batches of rows from the 'parts' table using keyset pagination on `key`.
+    A single PostgREST request is silently truncated at the server's max-rows limit,
+    so anything that must see every matching row should read through this generator.
+    `apply_filters` receives the query builder and returns it with filters applied.
+    """
+    batch_size = batch_size or db_page_size
+    selected = [c.strip() for c in columns.split(',')]
+    if '*' not in selected and key not in selected:
+        columns = f"{columns}, {key}"
+
+    last_key = None
+    while True:
+        query = db.table('parts').select(columns)
+        if apply_filters:
+            query = apply_filters(query)
+        if last_key is not None:
+            query = query.gt(key, last_key)
+        rows = query.order(key).limit(batch_size).execute().data or []
+        if rows:
+            yield rows
+        if len(rows) < batch_size:
+            return
+        last_key = rows[-1][key]
+
+
+def iter_parts(db, columns, apply_filters=None, batch_size=None, key='id'):
+    """Streams rows from the 'parts' table one at a time. See iter_part_batches."""
+    for batch in iter_part_batches(db, columns, apply_filters, batch_size, key):
+        yield from batch
+
+
+def order_slip_sort_key(part):
+    """Sort key matching PostgREST's order('order_slip_no') (ascending, nulls last)."""
+    order_slip_no = part.get('order_slip_no')
+    return (order_slip_no is None, order_slip_no or '')
+
+
+# Results are shared by all users, although the uncached query runs with the caller's JWT. This is safe
+# because the RLS policy on parts is the same for every authenticated user (no per-user rows), which the
+# location snapshot, the production summary cache and the read replica rely on as well. If parts ever
+# gets per-user policies, the key must include the user and those shared copies must go.
+search_cache = GenerationalCache(max_size=search_cache_max_size, ttl=search_cache_ttl)
+
+
+def normalize_search_term(search_term: str) -> str:
+    """Normalizes a search term for use as a cache key (whitespace and case, as ILIKE ignores case)."""
+    return ' '.join(search_term.split()).lower()
+
+
+def search_parts(search_term: str, limit=200):
+    """
+    Performs a search across multiple fields in the 'parts' table.
+    Results are cached for all users until they expire or any write invalidates the cache.
+    """
+    if not search_term:
+        return []
+
+    generation = search_cache.generation
+    cache_key = (generation, normalize_search_term(search_term), limit)
+    cached = search_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    results = _search_parts_uncached(search_term, limit)
+    if results is not None:
+        search_cache.set(cache_key, results)
+    return results or []
+
+
+def _search_parts_uncached(search_term: str, limit):
+    """Runs the search against the database (or the read replica). Returns None on error."""
+    db = read_db()
+    # The ranked search is a database function, so it is not available on the replica
+    if search_mode == 'trgm' and db is g.db and not rpc_missing('search_parts_ranked'):
+        try:
+            response = g.db.rpc('search_parts_ranked', {'search_term': search_term, 'max_rows': limit}).execute()
+            return response.data or []
+        except Exception as e:
+            if isinstance(e, APIError) and e.code == 'PGRST202':
+                mark_rpc_missing('search_parts_ranked', e)
+            else:
+                logging.warning(f"Ranked search failed for term '{search_term}', falling back to ILIKE: {e}")
+
+    search_query = escape_like_term(search_term)
+    or_conditions = ",".join([
+        f"production_no.ilike.{search_query}",
+        f"parts_no.ilike.{search_query}",
+        f"parts_name.ilike.{search_query}",
+        f"drawing_no.ilike.{search_query}",
+        f"order_slip_no.ilike.{search_query}"
+    ])
+
+    try:
+        response = db.table('parts').select('*').or_(or_conditions).limit(limit).execute()
+        return response.data or []
+    except Exception as e:
+        logging.error(f"Database search error for term '{search_term}': {e}")
+        flash("検索中にデータベースエラーが発生しました。", "error")
+        return None
+
+
+# --- Scan Lookup ---
+
+# Columns tried for an exact match of a scanned or typed code, in order of precedence
+SCAN_COLUMNS = ('order_slip_no', 'production_no', 'parts_no')
+
+
+def lookup_scan_code(code):
+    """
+    Looks a code up by exact match on each of SCAN_COLUMNS, concurrently and on their
+    btree indexes, instead of the five-way substring search.
+    Returns (column, rows) for the first column with a match, or (None, []) on a miss.
+    At most two rows are fetched per column: enough to tell a unique part number apart.
+    Unlocated rows come first, so the first row tells whether any matching part is unlocated.
+    """
+    db = read_db()
+    queries = [lambda db, column=column: db.table('parts').select('id, production_no, order_slip_no, parts_no, storage_location')
+               .eq(column, code).order('storage_location', nullsfirst=True).limit(2) for column in SCAN_COLUMNS]
+    if db is g.db:
+        responses = gather_queries(*queries)
+    else:
+        responses = [query(db).execute() for query in queries]
+    for column, response in zip(SCAN_COLUMNS, responses):
+        if response.data:
+            return column, response.data
+    return None, []
+
+
+def scan_target_url(column, rows, code):
+    """Returns the page a scanned code leads to; several parts sharing a part number go to the search results."""
+    if column == 'order_slip_no':
+        # The slip's location form only lists unlocated parts; a fully located slip is shown instead
+        if not rows[0].get('storage_location'):
+            return url_for('update_slip', order_slip_no=code)
+        if len(rows) == 1:
+            return url_for('item_detail', item_id=rows[0]['id'])
+        if len({row['production_no'] for row in rows}) == 1:
+            return url_for('production_details', production_no=rows[0]['production_no'])
+        return url_for('search', search_term=code)
+    if column == 'production_no':
+        return url_for('production_details', production_no=code)
+    if column == 'parts_no' and len(rows) == 1:
+        return url_for('item_detail', item_id=rows[0]['id'])
+    return url_for('search', search_term=code)
+
+
+# --- List Pagination ---
+
+# Columns rendered by inventory.html / all_items.html (build_list_query adds the sort column for the cursor)
+LIST_COLUMNS = 'id, parts_name, production_no, parts_no, drawing_no, order_slip_no, order_quantity, delivery_date, storage_location, created_at'
+# Sortable columns may be null: those rows come after the others in either order (see build_list_query)
+LIST_SORT_COLUMNS = ('created_at', 'updated_at', 'production_no')
+LIST_FILTER_COLUMNS = ('production_no', 'parts_name', 'order_slip_no', 'storage_location')
+
+
+def encode_cursor(row, sort):
+    """Encodes the (sort value, id) keyset position of a row as a URL-safe token."""
+    raw = json.dumps([row.get(sort), row['id']], ensure_ascii=False).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """Decodes a cursor token. Returns None if it is missing or malformed."""
+    if not token:
+        return None
+    try:
+        value, row_id = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        if not isinstance(row_id, int) or not (value is None or isinstance(value, str)):
+            raise TypeError('cursor must hold a text or null value and an integer id')
+        return value, row_id
+    except (ValueError, TypeError):
+        logging.warning(f"Ignoring malformed cursor: {token}")
+        return None
+
+
+def postgrest_quote(value):
+    """Quotes a value for use inside a PostgREST or=(...) filter."""
+    escaped = str(value).replace('\\', '\\\\').replace('"', '\\"')
+    return f'"{escaped}"'
+
+
+def get_list_args():
+    """Reads the sort, filter and page size arguments of a list page from the query string."""
+    sort = request.args.get('sort', 'created_at')
+    if sort not in LIST_SORT_COLUMNS:
+        sort = 'created_at'
+    list_args = {'sort': sort, 'order': 'asc' if request.args.get('order') == 'asc' else 'desc'}
+    per_page = safe_int_convert(request.args.get('per_page'))
+    if per_page:
+        list_args['per_page'] = max(1, min(per_page, list_max_page_size))
+    for column in LIST_FILTER_COLUMNS:
+        value = request.args.get(column, '').strip()
+        if value:
+            list_args[column] = value
+    return list_args
+
+
+def build_list_query(db, columns, list_args, apply_filters, cursor, desc):
+    """
+    Builds a parts query with the list filters, ordered by (sort column, id) and starting after the cursor.
+    Rows whose sort column is null come after all the others in list order, so a query running
+    against the list order (desc differs from list_args['order']) meets them first. The sort
+    column and id are always selected, so the last row can become the next cursor.
+    """
+    sort = list_args['sort']
+    nulls_last = desc == (list_args['order'] == 'desc')
+    selected = [c.strip() for c in columns.split(',')]
+    if '*' not in selected:
+        columns = ', '.join([columns] + [key for key in (sort, 'id') if key not in selected])
+    query = db.table('parts').select(columns)
+    if apply_filters:
+        query = apply_filters(query)
+    for column in LIST_FILTER_COLUMNS:
+        if column in list_args:
+            query = query.ilike(column, escape_like_term(list_args[column]))
+    if cursor is not None:
+        value, last_id = cursor
+        op = 'lt' if desc else 'gt'
+        if value is None:
+            # The rest of the nulls, then (when they come first) every non-null row
+            after = f"and({sort}.is.null,id.{op}.{last_id})"
+            query = query.or_(after if nulls_last else f"{after},{sort}.not.is.null")
+        else:
+            # Comparisons with a value never match null, so the nulls are added back when they come last
+            after = f"{sort}.{op}.{postgrest_quote(value)},and({sort}.eq.{postgrest_quote(value)},id.{op}.{last_id})"
+            query = query.or_(f"{after},{sort}.is.null" if nulls_last else after)
+    return query.order(sort, desc=desc, nullsfirst=not nulls_last).order('id', desc=desc)
+
+
+def iter_list_batches(db, columns, list_args, apply_filters=None):
+    """Yields every row of a list (in list order) in keyset-paginated batches of DB_PAGE_SIZE."""
+    sort = list_args['sort']
+    cursor = None
+    while True:
+        rows = build_list_query(db, columns, list_args, apply_filters, cursor, list_args['order'] == 'desc') \
+            .limit(db_page_size).execute().data or []
+        if rows:
+            yield rows
+        if len(rows) < db_page_size:
+            return
+        cursor = (rows[-1].get(sort), rows[-1]['id'])
+
+
+def fetch_parts_page(db, list_args, apply_filters=None):
+    """
+    Fetches one page of parts using keyset pagination on (sort column, id).
+    The cost of a page does not depend on how deep it is, unlike OFFSET paging.
+    Returns (items, next_cursor, prev_cursor).
+    """
+    sort = list_args['sort']
+    desc = list_args['order'] == 'desc'
+    per_page = list_args.get('per_page', list_page_size)
+    cursor = decode_cursor(request.args.get('cursor'))
+    backwards = cursor is not None and request.args.get('dir') == 'prev'
+    # Moving backwards reverses the sort order; the page is flipped back afterwards
+    query_desc = desc != backwards
+
+    # One extra row tells us whether there is another page
+    rows = build_list_query(db, LIST_COLUMNS, list_args, apply_filters, cursor, query_desc) \
+        .limit(per_page + 1).execute().data or []
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+
+    next_cursor = encode_cursor(rows[-1], sort) if rows and (has_more or backwards) else None
+    prev_cursor = encode_cursor(rows[0], sort) if rows and cursor is not None and (has_more or not backwards) else None
+    return rows, next_cursor, prev_cursor
+
+
+# --- Production Summary ---
+
+PRODUCTION_SUMMARY_COLUMNS = 'order_slip_no, storage_location, part_count, last_moved_at'
+# Columns rendered in an expanded order slip row of production_details.html
+SLIP_PART_COLUMNS = 'id, parts_name, parts_no, drawing_no, order_quantity, delivery_date, storage_location'
+
+production_summary_cache = GenerationalCache(max_size=production_summary_cache_max_size, ttl=production_summary_cache_ttl)
+
+
+def production_summary_query(production_no):
+    """The view query of fetch_production_summary_rows, for running it with other queries (gather_queries)."""
+    return lambda db: db.table('parts_production_summary').select(PRODUCTION_SUMMARY_COLUMNS).eq('production_no', production_no)
+
+
+def fetch_production_summary_rows(db, production_no, response=None):
+    """
+    Fetches the (order_slip_no, storage_location) aggregate rows of a production number
+    from the parts_production_summary view. Falls back to aggregating the parts rows
+    if the view has not been created yet.
+    `response` is the result of production_summary_query() if the caller already ran it
+    (a response, or the exception returned by gather_queries(return_exceptions=True)).
+    """
+    try:
+        if isinstance(response, Exception):
+            raise response
+        if response is None:
+            response = production_summary_query(production_no)(db).execute()
+        return response.data or []
+    except APIError as e:
+        logging.warning(f"parts_production_summary unavailable, aggregating parts rows instead: {e.message}")
+
+    groups = {}
+    for part in iter_parts(db, 'order_slip_no, storage_location, updated_at', lambda query: query.eq('production_no', production_no)):
+        key = (part.get('order_slip_no'), part.get('storage_location'))
+        group = groups.setdefault(key, {'order_slip_no': key[0], 'storage_location': key[1], 'part_count': 0, 'last_moved_at': None})
+        group['part_count'] += 1
+        updated_at = part.get('updated_at')
+        if updated_at and (group['last_moved_at'] is None or updated_at > group['last_moved_at']):
+            group['last_moved_at'] = updated_at
+    return list(groups.values())
+
+
+def get_production_summary(db, production_no, location_name=None, version=None, response=None):
+    """
+    Returns the header data of a production number: per-slip part counts, locations and
+    last change time, plus per-location part counts. Aggregate rows are cached per
+    production number (and data version, if the caller knows it) until a write
+    invalidates the cache. `response` is passed on to fetch_production_summary_rows.
+    """
+    cache_key = (production_summary_cache.generation, production_no, version)
+    rows = production_summary_cache.get(cache_key)
+    if rows is None:
+        rows = fetch_production_summary_rows(db, production_no, response)
+        production_summary_cache.set(cache_key, rows)
+
+    if location_name is not None:
+        rows = [row for row in rows if row.get('storage_location') == location_name]
+
+    order_slips = {}
+    location_counts = {}
+    total_parts_count = 0
+    last_moved_at = None
+    for row in sorted(rows, key=order_slip_sort_key):
+        slip = order_slips.setdefault(row.get('order_slip_no'), {'part_count': 0, 'locations': [], 'last_moved_at': None})
+        slip['part_count'] += row['part_count']
+        total_parts_count += row['part_count']
+        location = row.get('storage_location')
+        if location:
+            slip['locations'].append(location)
+            location_counts[location] = location_counts.get(location, 0) + row['part_count']
+        moved_at = row.get('last_moved_at')
+        if moved_at and (slip['last_moved_at'] is None or moved_at > slip['last_moved_at']):
+            slip['last_moved_at'] = moved_at
+        if moved_at and (last_moved_at is None or moved_at > last_moved_at):
+            last_moved_at = moved_at
+
+    for slip in order_slips.values():
+        slip['locations'].sort()
+    return {
+        'order_slips': order_slips,
+        'total_parts_count': total_parts_count,
+        'location_counts': location_counts,
+        'unique_locations': sorted(location_counts),
+        'last_moved_at': last_moved_at,
+    }
+
+
+def get_production_page(db, production_no, location_name=None):
+    """
+    Returns (summary, history) for the production pages: get_production_summary() and the
+    history timeline (fetch_history_timeline). Unless the aggregate rows are cached or read
+    from the replica, both are fetched concurrently.
+    """
+    history_args = {'production_no': production_no}
+    summary_response = history_response = None
+    if db is g.db and production_summary_cache.get((production_summary_cache.generation, production_no, None)) is None:
+        summary_response, history_response = gather_queries(
+            production_summary_query(production_no), history_timeline_query(history_args), return_exceptions=True)
+    summary = get_production_summary(db, production_no, location_name=location_name, response=summary_response)
+    return summary, fetch_history_timeline(history_args, history_response)
+
+
+# --- Work History ---
+
+HISTORY_COLUMNS = 'id, item_id, production_no, parts_name, action, details, user_email, created_at'
+# Without the user columns of supabase/migrations/20261018000600_work_history_browse.sql
+HISTORY_LEGACY_COLUMNS = 'id, item_id, production_no, parts_name, action, details, created_at'
+HISTORY_FILTER_COLUMNS = ('item_id', 'production_no', 'user_email', 'action')
+# Actions written by the routes, offered as a filter of the /history page
+HISTORY_ACTIONS = ('手動登録', '一括登録', '更新', '移動', '一括移動', '製番一括移動', 'D&D一括移動', 'まとめて移動', '削除')
+
+
+def get_history_args():
+    """Reads the filters of the /history page from the query string."""
+    history_args = {}
+    for key in HISTORY_FILTER_COLUMNS + ('date_from', 'date_to'):
+        value = request.args.get(key, '').strip()
+        if value:
+            history_args[key] = value
+    for key in ('date_from', 'date_to'):
+        if key in history_args:
+            try:
+                date.fromisoformat(history_args[key])
+            except ValueError:
+                logging.warning(f"Ignoring malformed {key}: {history_args[key]}")
+                del history_args[key]
+    return history_args
+
+
+def history_day_start(value, days=0):
+    """Returns the start of a day (YYYY-MM-DD, plus a number of days) in HISTORY_TIMEZONE as an ISO timestamp."""
+    day = date.fromordinal(date.fromisoformat(value).toordinal() + days)
+    return datetime(day.year, day.month, day.day, tzinfo=history_timezone).isoformat()
+
+
+def build_history_query(db, columns, history_args, cursor, desc):
+    """
+    Builds a work_history query with the given filters, ordered by (created_at, id) and
+    starting after the cursor. Each filter has a matching (column, created_at, id) index.
+    """
+    query = db.table('work_history').select(columns)
+    for column in HISTORY_FILTER_COLUMNS:
+        if column in history_args:
+            query = query.eq(column, history_args[column])
+    if 'date_from' in history_args:
+        query = query.gte('created_at', history_day_start(history_args['date_from']))
+    if 'date_to' in history_args:
+        query = query.lt('created_at', history_day_start(history_args['date_to'], days=1))
+    if cursor is not None:
+        value, last_id = cursor
+        op = 'lt' if desc else 'gt'
+        # The plain bound lets the index scan start at the cursor; the OR alone is only a filter
+        query = query.lte('created_at', value) if desc else query.gte('created_at', value)
+        query = query.or_(f"created_at.{op}.{postgrest_quote(value)},and(created_at.eq.{postgrest_quote(value)},id.{op}.{last_id})")
+    return query.order('created_at', desc=desc).order('id', desc=desc)
+
+
+def fetch_history_page(db, history_args, per_page, cursor=None, backwards=False):
+    """
+    Fetches one page of work history, newest first, using keyset pagination on (created_at, id).
+    Returns (rows, next_cursor, prev_cursor).
+    """
+    def fetch(columns):
+        # One extra row tells us whether there is another page
+        return build_history_query(db, columns, history_args, cursor, not backwards) \
+            .limit(per_page + 1).execute().data or []
+
+    try:
+        rows = fetch(HISTORY_COLUMNS)
+    except APIError as e:
+        if e.code != '42703':
+            raise
+        logging.warning(f"work_history has no user columns, showing history without users: {e.message}")
+        if 'user_email' in history_args:
+            return [], None, None
+        rows = fetch(HISTORY_LEGACY_COLUMNS)
+
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+    next_cursor = encode_cursor(rows[-1], 'created_at') if rows and (has_more or backwards) else None
+    prev_cursor = encode_cursor(rows[0], 'created_at') if rows and cursor is not None and (has_more or not backwards) else None
+    return rows, next_cursor, prev_cursor
+
+
+def history_timeline_query(history_args):
+    """The query of fetch_history_timeline, for running it with a page's other queries (gather_queries)."""
+    return lambda db: build_history_query(db, HISTORY_COLUMNS, history_args, None, True).limit(history_timeline_size + 1)
+
+
+def fetch_history_timeline(history_args, response=None):
+    """
+    Returns the latest work history of a part or production number for the timeline of its page,
+    or None if it could not be fetched (the page is still shown).
+    `response` is the result of history_timeline_query() if the caller already ran it
+    (a response, or the exception returned by gather_queries(return_exceptions=True)).
+    """
+    try:
+        if isinstance(response, APIError) and response.code == '42703':
+            # Fetched again by fetch_history_page without the user columns
+            response = None
+        if isinstance(response, Exception):
+            raise response
+        if response is None:
+            rows, next_cursor, _ = fetch_history_page(g.db, history_args, history_timeline_size)
+            has_more = next_cursor is not None
+        else:
+            rows = response.data or []
+            has_more = len(rows) > history_timeline_size
+            rows = rows[:history_timeline_size]
+    except Exception as e:
+        logging.error(f"Error fetching work history for {history_args}: {e}")
+        return None
+    return {'rows': rows, 'has_more': has_more, 'history_args': history_args}
+
+
+# --- Read Replica ---
+
+REPLICA_SCHEMA = """
+create table if not exists parts (
+    id numeric primary key,
+    production_no text,
+    parts_name text,
+    parts_no text,
+    drawing_no text,
+    dimensions text,
+    order_slip_no text,
+    order_quantity numeric,
+    delivery_date text,
+    storage_location text,
+    created_at text,
+    updated_at text,
+    data text not null
+);
+create index if not exists parts_production_no_idx on parts (production_no);
+create index if not exists parts_storage_location_idx on parts (storage_location);
+create index if not exists parts_order_slip_no_idx on parts (order_slip_no);
+create index if not exists parts_created_at_idx on parts (created_at, id);
+create index if not exists parts_updated_at_idx on parts (updated_at, id);
+create view if not exists parts_production_summary as
+    select production_no, order_slip_no, storage_location, count(*) as part_count, max(updated_at) as last_moved_at
+    from parts
+    group by production_no, order_slip_no, storage_location;
+create table if not exists replica_state (key text primary key, value text);
+"""
+# Filterable columns of the replica's parts table (the full row is kept as JSON in 'data')
+REPLICA_PART_COLUMNS = ('id', 'production_no', 'parts_name', 'parts_no', 'drawing_no', 'dimensions', 'order_slip_no',
+                        'order_quantity', 'delivery_date', 'storage_location', 'created_at', 'updated_at')
+REPLICA_VIEW_COLUMNS = {'parts_production_summary': ('production_no', 'order_slip_no', 'storage_location', 'part_count', 'last_moved_at')}
+
+
+class ReplicaResponse:
+    """The parts of a PostgREST APIResponse the read paths use."""
+
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+
+def split_postgrest_logic(text):
+    """Splits the body of a PostgREST or=(...)/and=(...) filter at its top-level commas."""
+    parts, depth, current, quoted, escaped = [], 0, '', False, False
+    for ch in text:
+        if escaped:
+            escaped = False
+        elif quoted and ch == '\\':
+            escaped = True
+        elif ch == '"':
+            quoted = not quoted
+        elif not quoted and ch == '(':
+            depth += 1
+        elif not quoted and ch == ')':
+            depth -= 1
+        elif not quoted and depth == 0 and ch == ',':
+            parts.append(current)
+            current = ''
+            continue
+        current += ch
+    parts.append(current)
+    return parts
+
+
+def unicode_lower(value):
+    """SQLite function of the replica: lower() for all of Unicode, not only ASCII like SQLite's own."""
+    return value.lower() if isinstance(value, str) else value
+
+
+def unquote_postgrest_value(value):
+    """Reverses postgrest_quote."""
+    if len(value) >= 2 and value[0] == value[-1] == '"':
+        return re.sub(r'\\(.)', r'\1', value[1:-1])
+    return value
+
+
+class ReplicaQuery:
+    """
+    A read-only query on the read replica, with the subset of the PostgREST query builder
+    used by the read paths (filters, or_, order, limit, single, exact counts), so the same
+    code runs against Supabase or the replica.
+    """
+
+    OPERATORS = {'eq': '=', 'neq': '<>', 'gt': '>', 'gte': '>=', 'lt': '<', 'lte': '<='}
+
+    def __init__(self, replica, table):
+        if table != 'parts' and table not in REPLICA_VIEW_COLUMNS:
+            raise ValueError(f"Table '{table}' is not replicated")
+        self._replica = replica
+        self._table = table
+        self._known_columns = REPLICA_PART_COLUMNS if table == 'parts' else REPLICA_VIEW_COLUMNS[table]
+        self._columns = ['*']
+        self._count = None
+        self._where = []
+        self._params = []
+        self._order = []
+        self._limit = None
+        self._single = False
+        self._negate_next = False
+
+    def select(self, columns='*', count=None):
+        self._columns = [column.strip() for column in columns.split(',') if column.strip()]
+        self._count = count
+        return self
+
+    def _column(self, column):
+        # Column names are interpolated into the SQL, so only known columns are accepted
+        if column not in self._known_columns:
+            raise ValueError(f"Column '{column}' is not available in the read replica")
+        return column
+
+    def _condition(self, column, op, value):
+        """Returns the SQL condition and its parameters for a PostgREST filter."""
+        column = self._column(column)
+        if op in self.OPERATORS:
+            return f"{column} {self.OPERATORS[op]} ?", [value]
+        if op == 'ilike':
+            # SQLite's like only folds ASCII case; ILIKE also matches e.g. full-width letters case-insensitively
+            return f"unicode_lower({column}) like unicode_lower(?) escape '\\'", [value]
+        if op == 'is' and value in (None, 'null'):
+            return f"{column} is null", []
+        if op == 'in':
+            values = list(value)
+            return f"{column} in ({', '.join('?' * len(values))})" if values else '0', values
+        raise ValueError(f"Filter '{op}' is not supported by the read replica")
+
+    def _add(self, column, op, value):
+        sql, params = self._condition(column, op, value)
+        if self._negate_next:
+            sql = f"not ({sql})"
+            self._negate_next = False
+        self._where.append(sql)
+        self._params += params
+        return self
+
+    def eq(self, column, value):
+        return self._add(column, 'eq', value)
+
+    def neq(self, column, value):
+        return self._add(column, 'neq', value)
+
+    def gt(self, column, value):
+        return self._add(column, 'gt', value)
+
+    def gte(self, column, value):
+        return self._add(column, 'gte', value)
+
+    def lt(self, column, value):
+        return self._add(column, 'lt', value)
+
+    def lte(self, column, value):
+        return self._add(column, 'lte', value)
+
+    def ilike(self, column, pattern):
+        return self._add(column, 'ilike', pattern)
+
+    def is_(self, column, value):
+        return self._add(column, 'is', value)
+
+    def in_(self, column, values):
+        return self._add(column, 'in', values)
+
+    @property
+    def not_(self):
+        self._negate_next = True
+        return self
+
+    def or_(self, filters):
+        sql, params = self._logic(filters, 'or')
+        self._where.append(sql)
+        self._params += params
+        return self
+
+    def _logic(self, text, joiner):
+        clauses, params = [], []
+        for part in split_postgrest_logic(text):
+            match = re.fullmatch(r'(and|or)\((.*)\)', part, re.DOTALL)
+            if match:
+                sql, part_params = self._logic(match.group(2), match.group(1))
+            else:
+                column, rest = part.split('.', 1)
+                negate = rest.startswith('not.')
+                if negate:
+                    rest = rest[4:]
+                op, value = rest.split('.', 1)
+                sql, part_params = self._condition(column, op, unquote_postgrest_value(value))
+                if negate:
+                    sql = f"not ({sql})"
+            clauses.append(f"({sql})")
+            params += part_params
+        return f" {joiner} ".join(clauses), params
+
+    def order(self, column, desc=False, nullsfirst=None):
+        # PostgreSQL sorts nulls last in ascending order and first in descending order
+        if nullsfirst is None:
+            nullsfirst = desc
+        column = self._column(column)
+        self._order.append(f"{column} is null {'desc' if nullsfirst else 'asc'}, {column} {'desc' if desc else 'asc'}")
+        return self
+
+    def limit(self, size):
+        self._limit = int(size)
+        return self
+
+    def single(self):
+        self._single = True
+        return self
+
+    def execute(self):
+        where = f" where {' and '.join(self._where)}" if self._where else ''
+        selected = 'data' if self._table == 'parts' else ', '.join(self._known_columns)
+        sql = f"select {selected} from {self._table}{where}"
+        if self._order:
+            sql += f" order by {', '.join(self._order)}"
+        if self._limit is not None:
+            sql += f" limit {self._limit}"
+
+        conn = self._replica.connection()
+        if self._table == 'parts':
+            rows = [json.loads(data) for (data,) in conn.execute(sql, self._params)]
+        else:
+            rows = [dict(zip(self._known_columns, row)) for row in conn.execute(sql, self._params)]
+        if '*' not in self._columns:
+            rows = [{column: row.get(column) for column in self._columns} for row in rows]
+        count = None
+        if self._count:
+            count = conn.execute(f"select count(*) from {self._table}{where}", self._params).fetchone()[0]
+        if self._single:
+            if len(rows) != 1:
+                raise APIError({'message': 'JSON object requested, multiple (or no) rows returned',
+                                'code': 'PGRST116', 'details': f"The result contains {len(rows)} rows", 'hint': None})
+            return ReplicaResponse(rows[0], count)
+        return ReplicaResponse(rows, count)
+
+
+class ReplicaClient:
+    """Stands in for a PostgREST client for read-only queries on the replicated tables."""
+
+    def __init__(self, replica):
+        self._replica = replica
+
+    def table(self, table):
+        return ReplicaQuery(self._replica, table)
+
+
+class ReadReplica:
+    """
+    Local SQLite mirror of the parts table (READ_REPLICA_PATH) serving the read routes.
+    One file is shared by all workers of a host. After an initial full copy it is synced
+    incrementally by `updated_at`, and rows deleted in Supabase are removed using the
+    parts_tombstones table (see supabase/migrations). Writes still go to Supabase; the rows
+    they return are applied to the mirror right away, as are changes from the change feed
+    (which then replaces the incremental syncs of this worker). Only one worker syncs at a
+    time, coordinated through a lease stored in the file itself.
+    """
+
+    SYNC_LEASE = 300
+
+    def __init__(self, path, sync_interval, full_sync_interval):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.full_sync_interval = full_sync_interval
+        self.ready = False
+        self.live = False
+        self._local = threading.local()
+        self._last_sync = 0.0
+        self._sync_lock = threading.Lock()
+        self._tombstones_available = True
+
+    def connection(self):
+        """Returns this thread's connection (reopened after a fork)."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('pragma journal_mode=wal')
+            conn.execute('pragma synchronous=normal')
+            conn.create_function('unicode_lower', 1, unicode_lower, deterministic=True)
+            conn.executescript(REPLICA_SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def client(self):
+        return ReplicaClient(self)
+
+    def _get_state(self, conn, key):
+        row = conn.execute("select value from replica_state where key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def _set_state(conn, key, value):
+        conn.execute("insert or replace into replica_state (key, value) values (?, ?)", (key, None if value is None else str(value)))
+
+    @staticmethod
+    def _row_params(row):
+        return [row.get(column) for column in REPLICA_PART_COLUMNS] + [json.dumps(row, ensure_ascii=False, default=str)]
+
+    def _upsert(self, conn, rows, table='parts'):
+        columns = REPLICA_PART_COLUMNS + ('data',)
+        placeholders = ', '.join('?' * len(columns))
+        updates = ', '.join(f"{column} = excluded.{column}" for column in columns if column != 'id')
+        # A row never goes back to an older version, e.g. when a write-through races a change feed event
+        conn.executemany(
+            f"insert into {table} ({', '.join(columns)}) values ({placeholders}) "
+            f"on conflict (id) do update set {updates} "
+            f"where excluded.updated_at >= {table}.updated_at or {table}.updated_at is null",
+            map(self._row_params, rows))
+
+    @staticmethod
+    @contextmanager
+    def _transaction(conn):
+        # Taking the write lock up front avoids deadlocks between workers upgrading read locks
+        conn.execute('begin immediate')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('rollback')
+            raise
+        conn.execute('commit')
+
+    def sync(self, db):
+        """Brings the mirror up to date if it is due, unless another worker is already syncing it."""
+        now = time.monotonic()
+        sync_interval = self.full_sync_interval if self.live else self.sync_interval
+        if self.ready and now - self._last_sync < sync_interval:
+            return
+        # Serve the current mirror while another thread syncs it
+        if not self._sync_lock.acquire(blocking=not self.ready):
+            return
+        try:
+            conn = self.connection()
+            full = self._claim(conn)
+            if full is not None:
+                try:
+                    if full:
+                        self._full_sync(conn, db)
+                    else:
+                        self._incremental_sync(conn, db)
+                    self._set_state(conn, 'synced_at', time.time())
+                finally:
+                    self._set_state(conn, 'sync_lease', 0)
+            self.ready = self.ready or self._get_state(conn, 'full_synced_at') is not None
+        finally:
+            # Also after a failure, so a broken sync is not retried on every request
+            self._last_sync = now
+            self._sync_lock.release()
+
+    def _claim(self, conn):
+        """
+        Takes the sync lease unless another worker holds it or has synced within the interval.
+        Returns None if there is nothing to do, otherwise whether a full sync is due.
+        """
+        wall_now = time.time()
+        with self._transaction(conn):
+            if float(self._get_state(conn, 'sync_lease') or 0) > wall_now:
+                return None
+            full_synced_at = self._get_state(conn, 'full_synced_at')
+            full = full_synced_at is None or wall_now - float(full_synced_at) >= self.full_sync_interval
+            if not full and wall_now - float(self._get_state(conn, 'synced_at') or 0) < self.sync_interval:
+                return None
+            self._set_state(conn, 'sync_lease', wall_now + self.SYNC_LEASE)
+            return full
+
+    def _latest_tombstone_seq(self, db):
+        try:
+            rows = db.table('parts_tombstones').select('seq').order('seq', desc=True).limit(1).execute().data or []
+            self._tombstones_available = True
+            return rows[0]['seq'] if rows else 0
+        except APIError as e:
+            if self._tombstones_available:
+                logging.warning(f"parts_tombstones unavailable, deletions reach the read replica only on full syncs: {e.message}")
+            self._tombstones_available = False
+            return None
+
+    def _full_sync(self, conn, db):
+        # Deletions recorded from here on are applied by the next incremental sync
+        tombstone_seq = self._latest_tombstone_seq(db)
+        # Copy into a temporary table first so the shared file is only locked for the final swap
+        conn.execute("create temp table if not exists parts_staging as select * from parts where 0")
+        conn.execute("delete from parts_staging")
+        watermark = None
+        count = 0
+        columns = REPLICA_PART_COLUMNS + ('data',)
+        for rows in iter_part_batches(db, '*'):
+            conn.executemany(f"insert into parts_staging ({', '.join(columns)}) values ({', '.join('?' * len(columns))})",
+                             map(self._row_params, rows))
+            count += len(rows)
+            watermark = max([watermark or ''] + [row['updated_at'] for row in rows if row.get('updated_at')]) or None
+        with self._transaction(conn):
+            conn.execute("delete from parts")
+            conn.execute("insert into parts select * from parts_staging")
+            self._set_state(conn, 'watermark', watermark)
+            self._set_state(conn, 'tombstone_seq', tombstone_seq)
+            self._set_state(conn, 'full_synced_at', time.time())
+        conn.execute("delete from parts_staging")
+        logging.info(f"Read replica fully synced with {count} parts.")
+
+    def _incremental_sync(self, conn, db):
+        watermark = self._get_state(conn, 'watermark')
+        filters = (lambda query: query.gte('updated_at', watermark)) if watermark else None
+        for rows in iter_part_batches(db, '*', filters):
+            with self._transaction(conn):
+                self._upsert(conn, rows)
+                watermark = max([watermark or ''] + [row['updated_at'] for row in rows if row.get('updated_at')]) or None
+                self._set_state(conn, 'watermark', watermark)
+
+        tombstone_seq = self._get_state(conn, 'tombstone_seq')
+        if tombstone_seq is None:
+            # The tombstone table did not exist at the last full sync
+            return
+        try:
+            while True:
+                rows = db.table('parts_tombstones').select('id, seq').gt('seq', int(tombstone_seq)) \
+                    .order('seq').limit(db_page_size).execute().data or []
+                if not rows:
+                    return
+                with self._transaction(conn):
+                    conn.executemany("delete from parts where id = ?", [(row['id'],) for row in rows])
+                    tombstone_seq = rows[-1]['seq']
+                    self._set_state(conn, 'tombstone_seq', tombstone_seq)
+        except APIError as e:
+            logging.warning(f"Failed to read parts_tombstones: {e.message}")
+
+    def invalidate(self):
+        """Forces a sync on the next read."""
+        self._last_sync = 0.0
+
+    def apply(self, rows):
+        """Writes rows returned by a write to Supabase (or received from the change feed) through to the mirror."""
+        with self._transaction(self.connection()) as conn:
+            self._upsert(conn, rows)
+
+    def discard(self, item_ids):
+        """Removes parts deleted through this app from the mirror."""
+        with self._transaction(self.connection()) as conn:
+            conn.executemany("delete from parts where id = ?", [(item_id,) for item_id in item_ids])
+
+    def stats(self):
+        conn = self.connection()
+        return {
+            'path': self.path,
+            'ready': self.ready,
+            'parts': conn.execute("select count(*) from parts").fetchone()[0],
+            'watermark': self._get_state(conn, 'watermark'),
+            'tombstone_seq': self._get_state(conn, 'tombstone_seq'),
+            'synced_at': self._get_state(conn, 'synced_at'),
+            'full_synced_at': self._get_state(conn, 'full_synced_at'),
+        }
+
+
+read_replica = ReadReplica(read_replica_path, read_replica_sync_interval, read_replica_full_sync_interval) if read_replica_path else None
+
+
+def read_db():
+    """
+    Returns the client for read-only queries on parts: the read replica if READ_REPLICA_PATH
+    is set and has been loaded, otherwise g.db. Reads that decide what a write changes keep
+    using g.db so they never act on stale rows.
+    """
+    # The replica is synced with the user's token, so anonymous requests never fill it
+    if read_replica is None or g.get('user') is None:
+        return g.db
+    try:
+        read_replica.sync(g.db)
+    except Exception as e:
+        logging.error(f"Error syncing read replica: {e}", exc_info=True)
+    return read_replica.client() if read_replica.ready else g.db
+
+
+# --- Location Snapshot ---
+
+MAP_ITEM_COLUMNS = 'id, production_no, storage_location, parts_name, parts_no, updated_at'
+
+
+class LocationSnapshot:
+    """
+    Process-wide index of located parts shared by all map routes.
+    Holds a location -> items index and a location -> sorted production numbers index.
+    After the initial full load it is refreshed incrementally by `updated_at`; a periodic
+    full reload picks up rows deleted by other workers. While the change feed is live it
+    patches the snapshot, and only the periodic full reload remains.
+    The index dicts are replaced, never mutated, so readers need no lock.
+    """
+
+    def __init__(self, refresh_interval, full_refresh_interval):
+        self.refresh_interval = refresh_interval
+        self.full_refresh_interval = full_refresh_interval
+        self.live = False
+        self.location_items = {}
+        self.location_product_numbers = {}
+        self.watermark = None
+        # Order-independent checksum of the (id, location, production number) of every located part.
+        # It changes with any change of the map contents, including patches that keep the watermark,
+        # and is the same in every worker holding the same contents.
+        self.checksum = 0
+        self.loaded = False
+        self._items_by_location = {}
+        self._location_by_id = {}
+        self._last_refresh = 0.0
+        self._last_full_refresh = 0.0
+        self._refresh_lock = threading.Lock()
+
+    def refresh(self, db, force_full=False):
+        """Brings the snapshot up to date if it is due for a refresh."""
+        now = time.monotonic()
+        refresh_interval = self.full_refresh_interval if self.live else self.refresh_interval
+        if not force_full and self.loaded and now - self._last_refresh < refresh_interval:
+            return
+        # Serve the current snapshot while another thread refreshes it
+        if not self._refresh_lock.acquire(blocking=not self.loaded):
+            return
+        try:
+            # Without a watermark (no located row had an updated_at) there is nothing to refresh from
+            full = (force_full or not self.loaded or self.watermark is None
+                    or now - self._last_full_refresh >= self.full_refresh_interval)
+            if full:
+                self._rebuild(iter_part_batches(
+                    db, MAP_ITEM_COLUMNS,
+                    lambda query: query.not_.is_('storage_location', 'null').neq('storage_location', '')))
+                self._last_full_refresh = now
+                logging.info(f"Location snapshot rebuilt with {len(self._location_by_id)} located parts.")
+            else:
+                # Rows whose location was cleared must be seen too, so no location filter here
+                for rows in iter_part_batches(db, MAP_ITEM_COLUMNS, lambda query: query.gte('updated_at', self.watermark)):
+                    self._apply(rows)
+            self._last_refresh = now
+            self.loaded = True
+        finally:
+            self._refresh_lock.release()
+
+    def invalidate(self, full=False):
+        """Forces an incremental (or full) refresh on the next read, e.g. after a write in this worker."""
+        self._last_refresh = 0.0
+        if full:
+            self._last_full_refresh = 0.0
+
+    def patch(self, rows, deleted_ids=()):
+        """
+        Applies rows written by this worker or received from the change feed. The watermark
+        is kept, so a change the feed missed is still picked up by the next refresh.
+        """
+        if not self.loaded:
+            return
+        columns = [column.strip() for column in MAP_ITEM_COLUMNS.split(',')]
+        with self._refresh_lock:
+            changes = []
+            for row in rows:
+                item_id = str(row['id'])
+                current = self._items_by_location.get(self._location_by_id.get(item_id), {}).get(item_id)
+                # An event can arrive after this worker already holds a newer version of the row
+                if current and current.get('updated_at') and row.get('updated_at') and row['updated_at'] < current['updated_at']:
+                    continue
+                changes.append({column: row.get(column) for column in columns})
+            changes += [{'id': item_id, 'storage_location': None} for item_id in deleted_ids]
+            watermark = self.watermark
+            self._apply(changes)
+            self.watermark = watermark
+
+    def _rebuild(self, batches):
+        # Build into a staging snapshot so readers never see a half-built index.
+        # The derived per-location lists are built once at the end, not once per batch.
+        staging = LocationSnapshot(self.refresh_interval, self.full_refresh_interval)
+        touched = set()
+        for rows in batches:
+            touched |= staging._index_rows(rows)
+        staging._publish(touched)
+        self._items_by_location = staging._items_by_location
+        self._location_by_id = staging._location_by_id
+        self.watermark = staging.watermark
+        self.checksum = staging.checksum
+        self.location_items = staging.location_items
+        self.location_product_numbers = staging.location_product_numbers
+
+    def _apply(self, rows):
+        self._publish(self._index_rows(rows))
+
+    def _index_rows(self, rows):
+        """Updates the id and location indexes; returns the locations whose contents changed."""
+        touched = set()
+        for item in rows:
+            item_id = str(item['id'])
+            old_loc = self._location_by_id.pop(item_id, None)
+            if old_loc is not None:
+                old_item = self._items_by_location[old_loc].pop(item_id, None)
+                self.checksum ^= self._item_checksum(item_id, old_loc, old_item)
+                touched.add(old_loc)
+            loc = item.get('storage_location')
+            if loc:
+                self._items_by_location.setdefault(loc, {})[item_id] = item
+                self._location_by_id[item_id] = loc
+                self.checksum ^= self._item_checksum(item_id, loc, item)
+                touched.add(loc)
+            updated_at = item.get('updated_at')
+            if updated_at and (self.watermark is None or updated_at > self.watermark):
+                self.watermark = updated_at
+        return touched
+
+    @staticmethod
+    def _item_checksum(item_id, loc, item):
+        production_no = (item or {}).get('production_no') or ''
+        return zlib.crc32(f"{item_id}\0{loc}\0{production_no}".encode('utf-8'))
+
+    def _publish(self, touched):
+        """Replaces the derived per-location dicts for the touched locations."""
+        if not touched:
+            return
+
+        location_items = dict(self.location_items)
+        location_product_numbers = dict(self.location_product_numbers)
+        for loc in touched:
+            items = list(self._items_by_location.get(loc, {}).values())
+            if items:
+                location_items[loc] = items
+                prod_nos = {item.get('production_no') for item in items if item.get('production_no')}
+                location_product_numbers[loc] = sorted(list(prod_nos))
+            else:
+                self._items_by_location.pop(loc, None)
+                location_items.pop(loc, None)
+                location_product_numbers.pop(loc, None)
+        self.location_items = location_items
+        self.location_product_numbers = location_product_numbers
+
+    @property
+    def located_count(self):
+        return len(self._location_by_id)
+
+
+location_snapshot = LocationSnapshot(map_snapshot_refresh_interval, map_snapshot_full_refresh_interval)
+
+
+def get_location_snapshot():
+    """Returns the shared location snapshot, refreshing it first if it is due."""
+    try:
+        location_snapshot.refresh(read_db())
+    except Exception as e:
+        logging.error(f"Error refreshing location snapshot: {e}")
+        flash("マップデータの取得中にエラーが発生しました。", "error")
+    return location_snapshot
+
+
+def invalidate_part_caches(deleted_ids=None, written_rows=None):
+    """
+    Invalidates the in-process read caches after a write to the 'parts' table and applies
+    the rows the write returned (or the deleted ids) to the location snapshot and the read
+    replica. Other workers learn about the write through the change feed.
+    """
+    # Rows returned by move_production_parts carry their previous location, which is not a column
+    written_rows = [{key: value for key, value in row.items() if key != 'previous_storage_location'}
+                    for row in written_rows or []]
+    search_cache.invalidate()
+    production_summary_cache.invalidate()
+    if written_rows or deleted_ids:
+        location_snapshot.patch(written_rows, deleted_ids or ())
+    else:
+        location_snapshot.invalidate()
+    if change_feed is not None:
+        change_feed.publish(written_rows, deleted_ids or [])
+    if read_replica is not None:
+        try:
+            if deleted_ids:
+                read_replica.discard(deleted_ids)
+            if written_rows:
+                read_replica.apply(written_rows)
+        except Exception as e:
+            # The next incremental sync picks the rows up anyway
+            logging.warning(f"Failed to apply a write to the read replica: {e}")
+
+
+def filter_locations(location_index, predicate):
+    """Returns the subset of a location-keyed index whose location codes match the predicate."""
+    return {loc: value for loc, value in location_index.items() if predicate(loc)}
+
+
+# --- Location Events ---
+
+class LocationEventBroker:
+    """
+    In-process fan-out of location change events to the open SSE streams of this worker.
+    Recent events are kept so a reconnecting stream can replay what it missed (Last-Event-ID).
+    At most max_subscribers streams are served at once (None: no limit).
+    """
+
+    def __init__(self, history_size=256, subscriber_queue_size=256, max_subscribers=None):
+        self.subscriber_queue_size = subscriber_queue_size
+        self.max_subscribers = max_subscribers
+        self._subscribers = set()
+        self._recent = deque(maxlen=history_size)
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def publish(self, event):
+        with self._lock:
+            event_id = self._next_id
+            self._next_id += 1
+        self._dispatch(event_id, event)
+
+    def subscribe(self, last_event_id=None):
+        """
+        Returns a queue of (event_id, event) pairs, pre-filled with events newer than last_event_id,
+        or None if max_subscribers streams are already open.
+        """
+        subscriber = queue.Queue(maxsize=self.subscriber_queue_size)
+        with self._lock:
+            if self.max_subscribers is not None and len(self._subscribers) >= self.max_subscribers:
+                return None
+            if last_event_id is not None:
+                for event_id, event in self._recent:
+                    if event_id > last_event_id:
+                        subscriber.put_nowait((event_id, event))
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def _dispatch(self, event_id, event):
+        with self._lock:
+            self._recent.append((event_id, event))
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait((event_id, event))
+            except queue.Full:
+                # A stalled client loses events; it catches up on its next page load
+                logging.warning("Location event dropped for a slow subscriber.")
+
+
+class FileTailBroker(LocationEventBroker):
+    """
+    Broker shared by the workers of one host through an append-only file.
+    Each worker appends the events it publishes and tails the file to fan out the events
+    of all workers. The byte offset of an event's line is its id, so ids agree across workers.
+    Past max_bytes (0: never) the file is replaced by one that starts with a hole of the old
+    file's size, so ids keep increasing while the events already read no longer take space.
+    """
+
+    def __init__(self, path, poll_interval, max_bytes=0, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self.poll_interval = poll_interval
+        self.max_bytes = max_bytes
+        self._thread = LazyThread(self._run, 'location-events-tail')
+
+    def publish(self, event):
+        self.publish_all([event])
+
+    def publish_all(self, events):
+        self._thread.ensure_started()
+        lines = ''.join(json.dumps(event, ensure_ascii=False, default=str) + '\n' for event in events).encode('utf-8')
+        while True:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                # Writers lock the file so none appends to it after it has been replaced
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                if os.fstat(fd).st_ino != os.stat(self.path).st_ino:
+                    continue
+                # A single O_APPEND write keeps lines from different workers whole
+                os.write(fd, lines)
+                self._rotate_if_full(fd)
+                return
+            finally:
+                os.close(fd)
+
+    def _rotate_if_full(self, fd):
+        size = os.fstat(fd).st_size
+        # Only the events after the hole count; readers must not see two replacements in one poll
+        if not self.max_bytes or size - os.lseek(fd, 0, os.SEEK_DATA) <= self.max_bytes:
+            return
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        temp_fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(temp_fd, size)
+        finally:
+            os.close(temp_fd)
+        os.replace(temp_path, self.path)
+
+    def subscribe(self, last_event_id=None):
+        self._thread.ensure_started()
+        return super().subscribe(last_event_id)
+
+    def _run(self):
+        try:
+            position = os.path.getsize(self.path)
+        except OSError:
+            position = 0
+        f = None
+        while True:
+            try:
+                f, position = self._tail(f, position)
+            except Exception as e:
+                logging.error(f"Error reading location events from {self.path}: {e}")
+            time.sleep(self.poll_interval)
+
+    def _tail(self, f, position):
+        """Reads the new lines of the open file f (opened if None); returns the file to read next and the position."""
+        if f is None:
+            try:
+                f = open(self.path, 'rb')
+            except OSError:
+                return None, position
+        position = self._read_from(f, position)
+        try:
+            replaced = os.stat(self.path).st_ino != os.fstat(f.fileno()).st_ino
+        except OSError:
+            replaced = True
+        if replaced:
+            # Every write to the old file was made before it was replaced, so this reads the last ones
+            position = self._read_from(f, position)
+            f.close()
+            f = None
+        return f, position
+
+    def _read_from(self, f, position):
+        if os.fstat(f.fileno()).st_size < position:
+            # The file was truncated
+            position = 0
+        f.seek(position)
+        while True:
+            line = f.readline()
+            if not line.endswith(b'\n'):
+                # Nothing more, or a line still being written
+                return position
+            # Skips the hole a replaced file starts with (only read if it was replaced twice between polls)
+            data = line.lstrip(b'\0')
+            position += len(line) - len(data)
+            event_id = position + 1
+            position += len(data)
+            try:
+                event = json.loads(data)
+            except ValueError:
+                logging.warning(f"Skipping malformed location event at offset {event_id - 1}.")
+                continue
+            self._dispatch(event_id, event)
+
+
+if location_events_file:
+    location_events = FileTailBroker(location_events_file, location_events_poll_interval,
+                                     max_bytes=location_events_file_max_bytes, max_subscribers=location_events_max_streams)
+else:
+    location_events = LocationEventBroker(max_subscribers=location_events_max_streams)
+
+
+def publish_location_changes(changes):
+    """
+    Publishes one event per (production_no, from, to) group of moved parts.
+    If this worker has a loaded location snapshot, each event also carries the production
+    numbers now stored in the affected cells, so map pages can patch them without a fetch.
+    """
+    counts = Counter((production_no, from_loc or None, to_loc or None) for production_no, from_loc, to_loc in changes
+                     if (from_loc or None) != (to_loc or None))
+    if not counts:
+        return
+    # Only a snapshot that is already loaded is worth refreshing on the write path
+    location_product_numbers = None
+    if location_snapshot.loaded:
+        try:
+            location_snapshot.refresh(read_db())
+            location_product_numbers = location_snapshot.location_product_numbers
+        except Exception as e:
+            logging.error(f"Error refreshing location snapshot for events: {e}")
+    for (production_no, from_loc, to_loc), count in counts.items():
+        event = {'production_no': production_no, 'from': from_loc, 'to': to_loc, 'count': count}
+        if location_product_numbers is not None:
+            event['cells'] = {loc: location_product_numbers.get(loc, []) for loc in (from_loc, to_loc) if loc}
+        location_events.publish(event)
+
+
+# --- Change Feed ---
+
+def apply_part_changes(changes):
+    """
+    Applies a batch of change events for the 'parts' table to the caches of this worker.
+    Events have the shape of Supabase Realtime postgres_changes payloads:
+    {'type': 'INSERT'|'UPDATE'|'DELETE', 'record': {...}, 'old_record': {...}}.
+    """
+    rows = {}
+    deleted_ids = []
+    for change in changes:
+        if change.get('type') == 'DELETE':
+            item_id = (change.get('old_record') or {}).get('id')
+            if item_id is not None:
+                rows.pop(str(item_id), None)
+                deleted_ids.append(item_id)
+        elif change.get('record'):
+            rows[str(change['record']['id'])] = change['record']
+    if not rows and not deleted_ids:
+        return
+    rows = list(rows.values())
+    search_cache.invalidate()
+    production_summary_cache.invalidate()
+    location_snapshot.patch(rows, deleted_ids)
+    if read_replica is not None:
+        try:
+            if deleted_ids:
+                read_replica.discard(deleted_ids)
+            if rows:
+                read_replica.apply(rows)
+        except Exception as e:
+            logging.warning(f"Failed to apply changes to the read replica: {e}")
+            read_replica.invalidate()
+
+
+class ChangeFeed(abc.ABC):
+    """
+    Stream of row changes of the 'parts' table shared by all workers. A consumer thread
+    applies received changes in batches (apply_part_changes), so the caches of every worker
+    follow writes made anywhere instead of waiting for their refresh intervals.
+    While the feed is live the snapshot and the read replica only do their periodic full
+    refresh; when it drops they fall back to their normal refresh intervals, and when it
+    (re)connects everything is refreshed once to cover changes missed in between.
+    """
+
+    mode = None
+    BATCH_SIZE = 500
+
+    def __init__(self):
+        self.live = False
+        self.received = 0
+        self._changes = queue.Queue()
+        self._thread = LazyThread(self._consume, 'change-feed')
+
+    def ensure_started(self):
+        if self._thread.ensure_started():
+            self._start_source()
+
+    def publish(self, rows, deleted_ids):
+        """Announces a write made by this worker. Feeds fed by the database itself need not."""
+
+    def stats(self):
+        return {'mode': self.mode, 'live': self.live, 'received': self.received, 'queued': self._changes.qsize()}
+
+    @abc.abstractmethod
+    def _start_source(self):
+        """Starts receiving changes (passed to _receive) from the feed's source."""
+
+    def _receive(self, change):
+        self._changes.put(change)
+
+    def _consume(self):
+        while True:
+            changes = [self._changes.get()]
+            while len(changes) < self.BATCH_SIZE:
+                try:
+                    changes.append(self._changes.get_nowait())
+                except queue.Empty:
+                    break
+            self.received += len(changes)
+            try:
+                apply_part_changes([change for change in changes if change.get('table', 'parts') == 'parts'])
+            except Exception as e:
+                logging.error(f"Failed to apply {len(changes)} part changes: {e}")
+                self._resync()
+
+    def _set_live(self, live):
+        if live and not self.live:
+            logging.info(f"Change feed ({self.mode}) is live.")
+            self._resync()
+        elif not live and self.live:
+            logging.warning(f"Change feed ({self.mode}) is down; caches fall back to their refresh intervals.")
+        self.live = live
+        location_snapshot.live = live
+        if read_replica is not None:
+            read_replica.live = live
+
+    def _resync(self):
+        search_cache.invalidate()
+        production_summary_cache.invalidate()
+        location_snapshot.invalidate(full=True)
+        if read_replica is not None:
+            read_replica.invalidate()
+
+
+class ChangeFileTail(FileTailBroker):
+    """FileTailBroker handing each line of the change file to a callback instead of SSE subscribers."""
+
+    def __init__(self, path, poll_interval, callback, max_bytes=0):
+        super().__init__(path, poll_interval, max_bytes=max_bytes, history_size=0)
+        self.callback = callback
+
+    def start(self):
+        self._thread.ensure_started()
+
+    def _dispatch(self, event_id, event):
+        self.callback(event)
+
+
+class FileChangeFeed(ChangeFeed):
+    """
+    Change feed for local testing and single-host deployments without Realtime: every worker
+    appends the rows its writes returned to CHANGE_FEED_FILE and tails it for everyone's.
+    Writes made outside the app (e.g. in the Supabase dashboard) are not seen.
+    """
+
+    mode = 'file'
+
+    def __init__(self, path, poll_interval, max_bytes=0):
+        super().__init__()
+        self._tail = ChangeFileTail(path, poll_interval, self._receive, max_bytes)
+
+    def publish(self, rows, deleted_ids):
+        events = [{'type': 'UPDATE', 'table': 'parts', 'record': row} for row in rows]
+        events += [{'type': 'DELETE', 'table': 'parts', 'old_record': {'id': item_id}} for item_id in deleted_ids]
+        if not events:
+            return
+        try:
+            self._tail.publish_all(events)
+        except OSError as e:
+            logging.error(f"Failed to append to the change feed: {e}")
+
+    def _start_source(self):
+        self._tail.start()
+        self._set_live(True)
+
+
+class RealtimeChangeFeed(ChangeFeed):
+    """
+    Change feed subscribed to the postgres_changes of public.parts through Supabase Realtime,
+    so every committed write is seen, whoever made it. Runs its own event loop thread and
+    reconnects with backoff.
+    """
+
+    mode = 'realtime'
+    CHECK_INTERVAL = 5
+    TOKEN_LIFETIME = 3600
+    MAX_BACKOFF = 60
+
+    def __init__(self, url, api_key, access_token=None, jwt_secret=None):
+        super().__init__()
+        self.url = f"{url.rstrip('/')}/realtime/v1"
+        self.api_key = api_key
+        self.access_token = access_token
+        self.jwt_secret = jwt_secret
+        self._token_expires = None
+
+    def _start_source(self):
+        threading.Thread(target=asyncio.run, args=(self._run(),), name='change-feed-realtime', daemon=True).start()
+
+    def _token(self):
+        """Returns the token to subscribe with; signs a short-lived one if only the JWT secret is configured."""
+        if self.access_token or not self.jwt_secret:
+            return self.access_token or self.api_key
+        self._token_expires = time.time() + self.TOKEN_LIFETIME
+        return jwt.encode({'role': 'authenticated', 'aud': 'authenticated', 'sub': 'change-feed',
+                           'exp': int(self._token_expires)}, self.jwt_secret, algorithm='HS256')
+
+    async def _run(self):
+        from realtime import AsyncRealtimeClient, RealtimeSubscribeStates
+
+        backoff = 1
+        while True:
+            client = AsyncRealtimeClient(self.url, token=self.api_key, params={'apikey': self.api_key}, auto_reconnect=False)
+            subscribed = asyncio.Event()
+
+            def on_state(state, error=None):
+                if state == RealtimeSubscribeStates.SUBSCRIBED:
+                    subscribed.set()
+                    self._set_live(True)
+                else:
+                    logging.warning(f"Change feed channel {state}: {error}")
+                    subscribed.clear()
+                    self._set_live(False)
+
+            try:
+                await client.connect()
+                await client.set_auth(self._token())
+                channel = client.channel('inventory-dashboard-parts')
+                channel.on_postgres_changes('*', schema='public', table='parts', callback=lambda payload: self._receive(payload['data']))
+                await channel.subscribe(on_state)
+                await asyncio.wait_for(subscribed.wait(), timeout=30)
+                backoff = 1
+                while client.is_connected and subscribed.is_set():
+                    await asyncio.sleep(self.CHECK_INTERVAL)
+                    if self._token_expires and time.time() > self._token_expires - self.TOKEN_LIFETIME / 2:
+                        await client.set_auth(self._token())
+                logging.warning("Change feed connection lost.")
+            except Exception as e:
+                logging.error(f"Change feed error: {e}")
+            finally:
+                self._set_live(False)
+                try:
+                    await client.close()
+                except Exception:
+                    pass
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.MAX_BACKOFF)
+
+
+if change_feed_mode == 'realtime':
+    change_feed = RealtimeChangeFeed(supabase_url, supabase_key, change_feed_access_token, supabase_jwt_secret)
+elif change_feed_mode == 'file':
+    change_feed = FileChangeFeed(change_feed_file, change_feed_poll_interval, change_feed_file_max_bytes)
+else:
+    change_feed = None
+
+
+# --- Warehouse Layout ---
+
+# Shelf layout of the inventory maps: the shelf numbers of each area in display order,
+# and the slot letters of each shelf in the order the map cells are rendered.
+WAREHOUSE_LAYOUT = {
+    'small': {'name': '小エリア', 'shelves': [40, 39], 'slots': list('ABCDEFGHIJKLMNOPQRSTUVWX'), 'slots_per_row': 8},
+    'north': {'name': '北エリア', 'shelves': list(range(2, 11)), 'slots': ['E', 'F', 'C', 'D', 'A', 'B']},
+    'south': {'name': '南エリア', 'shelves': [34, 33, 22, 23, 24, 25, 26, 27], 'slots': ['E', 'F', 'C', 'D', 'A', 'B']},
+}
+
+LOCATION_CODE_PATTERN = re.compile(r'^(\d+)([A-Za-z]?)')
 
-def escape_like_term(term: str) -> str:
+
+class WarehouseLayout:
     """
-    Escapes special characters for PostgreSQL LIKE/ILIKE queries and adds wildcards for substring matching.
-    The backslash is the escape character in PostgreSQL's standard_conforming_strings.
+    Compiled form of a layout definition.
+    Location codes are parsed into a (shelf_number, slot_letter) key, so '22A' belongs
+    to shelf 22 rather than matching a '2' prefix. Lookups are memoised per location code.
     """
-    if not term:
-        return "%%"
-    # Escape backslash, then percent, then underscore.
-    # The order is important.
-    escaped_term = term.replace('\\', '\\\\').replace('%', '\%').replace('_', '\_')
-    return f"%{escaped_term}%"
 
+    def __init__(self, definition):
+        self.areas = definition
+        self._area_by_shelf = {}
+        self._cells = {}
+        for area, spec in definition.items():
+            for shelf in spec['shelves']:
+                self._area_by_shelf[shelf] = area
+                for slot in spec['slots']:
+                    self._cells[(shelf, slot)] = area
+        self._area_by_location = {}
+
+    @staticmethod
+    def parse_location(location):
+        """Parses a location code like '22A' into (22, 'A'). Returns None if it is not a shelf code."""
+        match = LOCATION_CODE_PATTERN.match(location or '')
+        if not match:
+            return None
+        return int(match.group(1)), match.group(2).upper()
+
+    def area_of(self, location):
+        """Returns the area name for a location code, or None if it is outside the layout."""
+        try:
+            return self._area_by_location[location]
+        except KeyError:
+            pass
+        key = self.parse_location(location)
+        area = None
+        if key is not None:
+            # Codes with a sub-position (e.g. '22A-1') still belong to their shelf's area
+            area = self._cells.get(key) or self._area_by_shelf.get(key[0])
+        self._area_by_location[location] = area
+        return area
+
+    def area_locations(self, location_index, area):
+        """Returns the subset of a location-keyed index that belongs to the given area."""
+        return filter_locations(location_index, lambda loc: self.area_of(loc) == area)
+
+
+warehouse_layout = WarehouseLayout(WAREHOUSE_LAYOUT)
+
+
+# --- Part Import ---
+
+# Header names accepted in import files besides the column names (labels of the registration form)
+IMPORT_COLUMN_ALIASES = {
+    '製番': 'production_no',
+    '品名': 'parts_name',
+    '部品番号': 'parts_no',
+    '図番': 'drawing_no',
+    '寸法': 'dimensions',
+    '発注伝票No': 'order_slip_no',
+    '納期': 'delivery_date',
+    '保管場所': 'storage_location',
+    '数量': 'order_quantity',
+}
+PART_TEXT_COLUMNS = ('production_no', 'parts_name', 'parts_no', 'drawing_no', 'dimensions', 'order_slip_no', 'storage_location')
+# Natural key of a part: the unique constraint reported as 23505 by add_item
+PART_KEY_COLUMNS = ('production_no', 'parts_no', 'order_slip_no', 'dimensions', 'drawing_no', 'parts_name')
+DELIVERY_DATE_FORMATS = ('%Y-%m-%d', '%Y/%m/%d', '%Y.%m.%d', '%Y%m%d')
+
+
+def cell_text(value) -> str:
+    """Returns a form or spreadsheet value as stripped text ('' for empty cells)."""
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        if value != value:  # NaN
+            return ''
+        if value.is_integer():
+            # Numeric cells such as production numbers are read back as floats
+            return str(int(value))
+    return str(value).strip()
 
-def safe_int_convert(value, default=None):
 
+def parse_delivery_date(value):
     """
-    Safely converts a value to an integer.
-    Returns the default value (or None) if conversion fails.
+    Returns a delivery date as an ISO date string, or None if empty.
+    Raises ValueError if the value is not a date.
     """
-    if value is None:
-        return default
+    if isinstance(value, datetime):
+        return value.date().isoformat()
+    if isinstance(value, date):
+        return value.isoformat()
+    text = cell_text(value)
+    if not text:
+        return None
+    # Dates exported with a time part
+    text = text.split(' ')[0].split('T')[0]
+    for date_format in DELIVERY_DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format).date().isoformat()
+        except ValueError:
+            continue
+    raise ValueError(f"納期の形式が正しくありません: {text}")
+
+
+def normalize_part(fields):
+    """
+    Builds a 'parts' row from form or import fields with the manual registration rules.
+    Returns (part, errors); the part must not be saved if there are errors.
+    """
+    part = {column: cell_text(fields.get(column)) for column in PART_TEXT_COLUMNS}
+    errors = []
+    if not part['production_no'] or not part['parts_name']:
+        errors.append("製番と品名は必須です。")
     try:
-        return int(value)
-    except (ValueError, TypeError):
-        return default
+        part['delivery_date'] = parse_delivery_date(fields.get('delivery_date'))
+    except ValueError as e:
+        part['delivery_date'] = None
+        errors.append(str(e))
+    if 'order_quantity' in fields:
+        quantity = cell_text(fields.get('order_quantity'))
+        part['order_quantity'] = safe_int_convert(quantity)
+        if quantity and part['order_quantity'] is None:
+            errors.append(f"数量が数値ではありません: {quantity}")
+    part['updated_at'] = datetime.now().isoformat()
+    return part, errors
+
+
+def iter_import_rows(stream, filename, chunk_size):
+    """
+    Reads a CSV or XLSX file in chunks of (line number, fields) pairs.
+    Header aliases are mapped to column names; line 1 is the header.
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in ('.xlsx', '.xlsm'):
+        return _iter_xlsx_rows(stream, chunk_size)
+    if extension in ('.csv', '.txt'):
+        return _iter_csv_rows(stream, chunk_size)
+    raise ValueError("対応していないファイル形式です。CSV または Excel (.xlsx) ファイルを指定してください。")
 
 
-def log_work_history(item_id, production_no, parts_name, action, details):
-    """Logs an action to the work_history table."""
+def _import_column_name(header):
+    header = cell_text(header)
+    return IMPORT_COLUMN_ALIASES.get(header, header)
+
+
+def _iter_csv_rows(stream, chunk_size):
+    # pandas is only needed by imports, so it is not loaded at startup
+    import pandas as pd
+
+    # Order lists exported from Excel on Japanese Windows are Shift_JIS (cp932)
+    head = stream.read(64 * 1024)
+    stream.seek(0)
     try:
-        supabase.table('parts').insert({
-            'item_id': item_id,
-            'production_no': production_no,
-            'parts_name': parts_name,
-            'action': action,
-            'details': details,
-        }).execute()
-    except Exception as e:
-        logging.error(f"Failed to log parts: {e}")
+        codecs.getincrementaldecoder('utf-8')().decode(head)
+        encoding = 'utf-8-sig'
+    except UnicodeDecodeError:
+        encoding = 'cp932'
+
+    line_no = 2
+    reader = pd.read_csv(stream, dtype=str, keep_default_na=False, skip_blank_lines=False,
+                         encoding=encoding, chunksize=chunk_size)
+    for frame in reader:
+        frame = frame.rename(columns=_import_column_name)
+        records = frame.to_dict('records')
+        yield [(line_no + offset, fields) for offset, fields in enumerate(records)]
+        line_no += len(records)
+
+
+def _iter_xlsx_rows(stream, chunk_size):
+    from openpyxl import load_workbook
+
+    # Read-only mode streams rows instead of loading the whole sheet
+    workbook = load_workbook(stream, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = [_import_column_name(name) for name in header]
+        chunk = []
+        for line_no, values in enumerate(rows, start=2):
+            chunk.append((line_no, dict(zip(columns, values))))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+    finally:
+        workbook.close()
+
+
+def import_parts(db, row_chunks, write_history, source_name):
+    """
+    Validates imported rows and upserts them in batches of IMPORT_BATCH_SIZE.
+    Rows whose natural key already exists, in the table or earlier in the file, are skipped.
+    Returns a report with the row counts and the errors as (line number, message) pairs.
+    """
+    report = {'total': 0, 'inserted': 0, 'skipped': 0, 'error_count': 0, 'errors': []}
+    seen_keys = set()
+
+    def add_error(line_no, message):
+        report['error_count'] += 1
+        if len(report['errors']) < import_max_reported_errors:
+            report['errors'].append((line_no, message))
+
+    for chunk in row_chunks:
+        parts, part_lines = [], []
+        for line_no, fields in chunk:
+            if not any(cell_text(value) for value in fields.values()):
+                continue
+            report['total'] += 1
+            part, errors = normalize_part(fields)
+            if errors:
+                add_error(line_no, ' '.join(errors))
+                continue
+            key = tuple(part[column] for column in PART_KEY_COLUMNS)
+            if key in seen_keys:
+                report['skipped'] += 1
+                continue
+            seen_keys.add(key)
+            parts.append(part)
+            part_lines.append(line_no)
+
+        for start in range(0, len(parts), import_batch_size):
+            batch = parts[start:start + import_batch_size]
+            try:
+                # Duplicates of existing rows are skipped by the database and not returned
+                response = db.table('parts').upsert(
+                    batch, on_conflict=','.join(PART_KEY_COLUMNS), ignore_duplicates=True).execute()
+            except Exception as e:
+                logging.error(f"Error importing rows {part_lines[start]}-{part_lines[start + len(batch) - 1]} of {source_name}: {e}")
+                message = getattr(e, 'message', None) or str(e)
+                for line_no in part_lines[start:start + len(batch)]:
+                    add_error(line_no, f"データベースへの登録に失敗しました: {message}")
+                continue
+
+            inserted = response.data or []
+            report['inserted'] += len(inserted)
+            report['skipped'] += len(batch) - len(inserted)
+            if inserted:
+                invalidate_part_caches(written_rows=inserted)
+                write_history([
+                    build_history_entry(
+                        item_id=row['id'],
+                        production_no=row['production_no'],
+                        parts_name=row['parts_name'],
+                        action="一括登録",
+                        details=f"「{source_name}」から部品「{row['parts_name']}」が一括登録されました。"
+                    )
+                    for row in inserted
+                ])
 
+    logging.info(f"Imported {source_name}: {report['inserted']} inserted, {report['skipped']} skipped, "
+                 f"{report['error_count']} errors out of {report['total']} rows.")
+    return report
 
-def search_parts(search_term: str, limit=200):
+
+# --- CSV Export ---
+
+EXPORT_COLUMNS = ('production_no', 'parts_name', 'parts_no', 'drawing_no', 'dimensions', 'order_slip_no',
+                  'order_quantity', 'delivery_date', 'storage_location', 'updated_at')
+# Same header names as the import accepts, so an export can be edited and imported again
+EXPORT_HEADERS = {column: header for header, column in IMPORT_COLUMN_ALIASES.items()}
+EXPORT_HEADERS['updated_at'] = '更新日時'
+
+
+def export_parts_csv(filename, batches):
     """
-    Performs a search across multiple fields in the 'parts' table.
+    Streams parts as a CSV download while the batches are still being read.
+    ?format=excel prepends a UTF-8 BOM so Excel opens Japanese text correctly.
     """
-    if not search_term:
-        return []
-    
-    search_query = escape_like_term(search_term)
-    or_conditions = ",".join([
-        f"production_no.ilike.{search_query}",
-        f"parts_no.ilike.{search_query}",
-        f"parts_name.ilike.{search_query}",
-        f"drawing_no.ilike.{search_query}",
-        f"order_slip_no.ilike.{search_query}"
-    ])
+    excel = request.args.get('format') == 'excel'
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow([EXPORT_HEADERS[column] for column in EXPORT_COLUMNS])
+        # The header goes out before the first query so the download starts immediately
+        yield ('\ufeff' if excel else '') + buffer.getvalue()
+        row_count = 0
+        try:
+            for rows in batches:
+                buffer.seek(0)
+                buffer.truncate()
+                writer.writerows([['' if row.get(column) is None else row[column] for column in EXPORT_COLUMNS] for row in rows])
+                row_count += len(rows)
+                yield buffer.getvalue()
+        except Exception as e:
+            # The status line has already been sent; the download ends short
+            logging.error(f"Error exporting {filename} after {row_count} rows: {e}", exc_info=True)
+            return
+        logging.info(f"Exported {row_count} rows to {filename}.")
+
+    response = app.response_class(stream_with_context(generate()), mimetype='text/csv')
+    # Location names and production numbers may be Japanese, which needs the RFC 5987 form
+    ascii_filename = filename.encode('ascii', 'replace').decode('ascii').replace('?', '_')
+    response.headers['Content-Disposition'] = f"attachment; filename=\"{ascii_filename}\"; filename*=UTF-8''{quote(filename)}"
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
-    try:
-        response = supabase.table('parts').select('*').or_(or_conditions).limit(limit).execute()
-        return response.data or []
-    except Exception as e:
-        logging.error(f"Database search error for term '{search_term}': {e}")
-        flash("検索中にデータベースエラーが発生しました。", "error")
-        return []
 
 # --- Routes ---
 
@@ -157,28 +2913,31 @@ def index():
 @login_required
 def inventory():
     """Main page showing parts with a storage location."""
+    list_args = get_list_args()
     try:
-        response = supabase.table('parts').select('*, order_quantity').not_.is_('storage_location', 'null').neq('storage_location', '').order('created_at', desc=True).limit(100).execute()
-        items = response.data or []
+        items, next_cursor, prev_cursor = fetch_parts_page(
+            read_db(), list_args, lambda query: query.not_.is_('storage_location', 'null').neq('storage_location', ''))
     except Exception as e:
         logging.error(f"Error fetching parts for inventory page: {e}")
         flash("部品データの取得中にエラーが発生しました。", "error")
-        items = []
-    return render_template('inventory.html', items=items, page_title='保管場所登録済み部品')
+        items, next_cursor, prev_cursor = [], None, None
+    return render_template('inventory.html', items=items, page_title='保管場所登録済み部品',
+                           list_args=list_args, next_cursor=next_cursor, prev_cursor=prev_cursor)
 
 
 @app.route('/all')
 @login_required
 def all_items():
     """Page showing all parts."""
+    list_args = get_list_args()
     try:
-        response = supabase.table('parts').select('*, order_quantity').order('created_at', desc=True).limit(100).execute()
-        items = response.data or []
+        items, next_cursor, prev_cursor = fetch_parts_page(read_db(), list_args)
     except Exception as e:
         logging.error(f"Error fetching all parts: {e}")
         flash("全部品データの取得中にエラーが発生しました。", "error")
-        items = []
-    return render_template('all_items.html', items=items, page_title='すべての部品')
+        items, next_cursor, prev_cursor = [], None, None
+    return render_template('all_items.html', items=items, page_title='すべての部品',
+                           list_args=list_args, next_cursor=next_cursor, prev_cursor=prev_cursor)
 
 
 @app.route('/add', methods=['GET', 'POST'])
@@ -187,31 +2946,20 @@ def add_item():
     """Page to manually add a new item."""
     if request.method == 'POST':
         try:
-            delivery_date_str = request.form.get('delivery_date', '').strip()
-            new_part = {
-                'production_no': request.form.get('production_no', '').strip(),
-                'parts_name': request.form.get('parts_name', '').strip(),
-                'parts_no': request.form.get('parts_no', '').strip(),
-                'drawing_no': request.form.get('drawing_no', '').strip(),
-                'dimensions': request.form.get('dimensions', '').strip(),
-                'order_slip_no': request.form.get('order_slip_no', '').strip(),
-                
-                'delivery_date': delivery_date_str if delivery_date_str else None,
-                'storage_location': request.form.get('storage_location', '').strip(),
-                'updated_at': datetime.now().isoformat()
-            }
-
-            if not new_part['production_no'] or not new_part['parts_name']:
-                flash("製番と品名は必須です。", "danger")
+            new_part, errors = normalize_part(request.form)
+            if errors:
+                for error in errors:
+                    flash(error, "danger")
                 return render_template('add_item.html', item=new_part)
 
-            insert_response = supabase.table('parts').insert(new_part).execute()
+            insert_response = g.db.table('parts').insert(new_part).execute()
             
             inserted_item = insert_response.data[0] if insert_response.data else None
 
             if not inserted_item:
                 flash("データベースへの登録に失敗しました。", "danger")
                 return render_template('add_item.html', item=new_part)
+            invalidate_part_caches(written_rows=insert_response.data)
 
             log_work_history(
                 item_id=inserted_item['id'],
@@ -238,6 +2986,37 @@ def add_item():
     return render_template('add_item.html')
 
 
+@app.route('/import', methods=['GET', 'POST'])
+@login_required
+def import_items():
+    """Page to register parts in bulk from a CSV or Excel order list."""
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if not upload or not upload.filename:
+            flash("取り込むファイルを選択してください。", "warning")
+            return render_template('import_items.html')
+
+        try:
+            report = import_parts(
+                g.db, iter_import_rows(upload.stream, upload.filename, import_batch_size),
+                log_work_history_bulk, upload.filename)
+        except ValueError as e:
+            # Unsupported file type, undecodable text or malformed CSV
+            flash(f"ファイルを読み込めませんでした: {e}", "danger")
+            return render_template('import_items.html')
+        except Exception as e:
+            logging.error(f"Error importing {upload.filename}: {e}", exc_info=True)
+            flash("ファイルの取り込み中に予期せぬエラーが発生しました。", "danger")
+            return render_template('import_items.html')
+
+        flash(f"{report['total']}行中 {report['inserted']}件を登録しました"
+              f"（登録済みのため除外 {report['skipped']}件、エラー {report['error_count']}件）。",
+              "success" if not report['error_count'] else "warning")
+        return render_template('import_items.html', report=report)
+
+    return render_template('import_items.html')
+
+
 @app.route('/search', methods=['GET', 'POST'])
 @login_required
 def search():
@@ -259,13 +3038,41 @@ def search():
     return render_template('inventory.html', items=items, search_term=search_term, page_title=f"'{search_term}' の検索結果")
 
 
+@app.route('/scan')
+@app.route('/scan/<path:code>')
+@login_required
+def scan(code=None):
+    """Jumps to the page of a scanned code (order slip, production number or part number), or searches for it."""
+    code = (code if code is not None else request.args.get('code', '')).strip()
+    if not code:
+        flash("コードを入力してください。", "info")
+        return redirect(url_for('inventory'))
+    try:
+        column, rows = lookup_scan_code(code)
+    except Exception as e:
+        logging.error(f"Error looking up scanned code '{code}': {e}")
+        column, rows = None, []
+    return redirect(scan_target_url(column, rows, code))
+
+
 @app.route('/item/<item_id>')
 @login_required
 def item_detail(item_id):
     """Displays details for a single part."""
     logging.info(f"Accessing /item/{item_id}")
+    history_args = {'item_id': str(item_id)}
+    history_response = None
     try:
-        item_response = supabase.table('parts').select('*, order_quantity').eq('id', item_id).single().execute()
+        db = read_db()
+        item_query = lambda db: db.table('parts').select('*, order_quantity').eq('id', item_id).single()
+        if db is g.db:
+            # The history timeline only needs the id, so it is fetched together with the part
+            item_response, history_response = gather_queries(item_query, history_timeline_query(history_args),
+                                                             return_exceptions=True)
+            if isinstance(item_response, Exception):
+                raise item_response
+        else:
+            item_response = item_query(db).execute()
         item = item_response.data
         if not item:
             flash("指定された部品が見つかりません。", "error")
@@ -275,7 +3082,7 @@ def item_detail(item_id):
         order_slip_no = item.get('order_slip_no')
         if order_slip_no:
             logging.info(f"Fetching related items for order slip: {order_slip_no}")
-            related_response = supabase.table('parts').select('id, production_no, parts_name').eq('order_slip_no', order_slip_no).neq('id', item_id).execute()
+            related_response = db.table('parts').select('id, production_no, parts_name').eq('order_slip_no', order_slip_no).neq('id', item_id).execute()
             related_items = related_response.data or []
             logging.info(f"Found {len(related_items)} related items.")
 
@@ -284,7 +3091,8 @@ def item_detail(item_id):
         flash("部品詳細の取得中にエラーが発生しました。", "error")
         return redirect(url_for('inventory'))
 
-    return render_template('detail.html', item=item, related_items=related_items)
+    return render_template('detail.html', item=item, related_items=related_items,
+                           history=fetch_history_timeline(history_args, history_response))
 
 
 @app.route('/map')
@@ -298,168 +3106,103 @@ def inventory_map_index():
 @login_required
 def inventory_map_small_area():
     """Displays the small area inventory map."""
-    location_items = {}
-    location_product_numbers = {}
-    small_area_items = {}
-
-    try:
-        response = supabase.table('parts').select('id, production_no, storage_location, parts_name, parts_no').not_.is_('storage_location', 'null').neq('storage_location', '').execute()
-        if response.data:
-            for item in response.data:
-                loc = item.get('storage_location')
-                if not loc: continue
-
-                if loc.startswith('39') or loc.startswith('40'):
-                    if loc not in small_area_items:
-                        small_area_items[loc] = []
-                    small_area_items[loc].append(item)
-
-                if loc not in location_items:
-                    location_items[loc] = []
-                location_items[loc].append(item)
-
-            for loc, items in location_items.items():
-                prod_nos = {item.get('production_no') for item in items if item.get('production_no')}
-                location_product_numbers[loc] = sorted(list(prod_nos))
-
-    except Exception as e:
-        logging.error(f"Error fetching data for small area map: {e}")
-        flash("マップデータの取得中にエラーが発生しました。", "error")
+    snapshot = get_location_snapshot()
+    # Only this area's locations are embedded; cell items are loaded lazily by map.js
+    location_product_numbers = warehouse_layout.area_locations(snapshot.location_product_numbers, 'small')
 
     return render_template('map_small_area.html', 
-                           location_items=location_items, 
-                           location_product_numbers=location_product_numbers,
-                           small_area_items=small_area_items)
+                           area=warehouse_layout.areas['small'],
+                           location_product_numbers=location_product_numbers)
 
 
 @app.route('/map/north_area')
 @login_required
 def inventory_map_north_area():
     """Displays the north area inventory map."""
-    location_items = {}
-    location_product_numbers = {}
-    north_area_items = {}
-
-    try:
-        response = supabase.table('parts').select('id, production_no, storage_location, parts_name, parts_no').not_.is_('storage_location', 'null').neq('storage_location', '').execute()
-        if response.data:
-            for item in response.data:
-                loc = item.get('storage_location')
-                if not loc: continue
-
-                if any(loc.startswith(str(n)) for n in range(2, 11)):
-                    if loc not in north_area_items:
-                        north_area_items[loc] = []
-                    north_area_items[loc].append(item)
-
-                if loc not in location_items:
-                    location_items[loc] = []
-                location_items[loc].append(item)
-
-            for loc, items in location_items.items():
-                prod_nos = {item.get('production_no') for item in items if item.get('production_no')}
-                location_product_numbers[loc] = sorted(list(prod_nos))
-
-    except Exception as e:
-        logging.error(f"Error fetching data for north area map: {e}")
-        flash("マップデータの取得中にエラーが発生しました。", "error")
+    snapshot = get_location_snapshot()
+    # Only this area's locations are embedded; cell items are loaded lazily by map.js
+    location_product_numbers = warehouse_layout.area_locations(snapshot.location_product_numbers, 'north')
 
     return render_template('map_north_area.html', 
-                           location_items=location_items, 
-                           location_product_numbers=location_product_numbers,
-                           north_area_items=north_area_items)
+                           area=warehouse_layout.areas['north'],
+                           location_product_numbers=location_product_numbers)
 
 
 @app.route('/map/south_area')
 @login_required
 def inventory_map_south_area():
     """Displays the south area inventory map."""
-    location_items = {}
-    location_product_numbers = {}
-    south_area_items = {}
-
-    try:
-        response = supabase.table('parts').select('id, production_no, storage_location, parts_name, parts_no').not_.is_('storage_location', 'null').neq('storage_location', '').execute()
-        if response.data:
-            for item in response.data:
-                loc = item.get('storage_location')
-                if not loc: continue
-
-                if any(loc.startswith(str(n)) for n in [34, 33, 22, 23, 24, 25, 26, 27]):
-                    if loc not in south_area_items:
-                        south_area_items[loc] = []
-                    south_area_items[loc].append(item)
-
-                if loc not in location_items:
-                    location_items[loc] = []
-                location_items[loc].append(item)
-
-            for loc, items in location_items.items():
-                prod_nos = {item.get('production_no') for item in items if item.get('production_no')}
-                location_product_numbers[loc] = sorted(list(prod_nos))
-
-    except Exception as e:
-        logging.error(f"Error fetching data for south area map: {e}")
-        flash("マップデータの取得中にエラーが発生しました。", "error")
+    snapshot = get_location_snapshot()
+    # Only this area's locations are embedded; cell items are loaded lazily by map.js
+    location_product_numbers = warehouse_layout.area_locations(snapshot.location_product_numbers, 'south')
 
     return render_template('map_south_area.html', 
-                           location_items=location_items, 
-                           location_product_numbers=location_product_numbers,
-                           south_area_items=south_area_items)
+                           area=warehouse_layout.areas['south'],
+                           location_product_numbers=location_product_numbers)
 
 
 @app.route('/map')
 @login_required
 def inventory_map():
     """Displays the inventory map."""
-    location_items = {}
-    location_product_numbers = {}
-    small_area_items = {}
-    north_area_items = {}
-    south_area_items = {}
-
-    try:
-        response = supabase.table('parts').select('id, production_no, storage_location, parts_name, parts_no').not_.is_('storage_location', 'null').neq('storage_location', '').execute()
-        if response.data:
-            for item in response.data:
-                loc = item.get('storage_location')
-                if not loc: continue
-
-                # Classify based on location prefix
-                if loc.startswith('39') or loc.startswith('40'):
-                    if loc not in small_area_items:
-                        small_area_items[loc] = []
-                    small_area_items[loc].append(item)
-                elif any(loc.startswith(str(n)) for n in range(2, 11)):
-                    if loc not in north_area_items:
-                        north_area_items[loc] = []
-                    north_area_items[loc].append(item)
-                elif any(loc.startswith(str(n)) for n in [34, 33, 22, 23, 24, 25, 26, 27]):
-                    if loc not in south_area_items:
-                        south_area_items[loc] = []
-                    south_area_items[loc].append(item)
-
-                # Keep the original logic for the modal
-                if loc not in location_items:
-                    location_items[loc] = []
-                location_items[loc].append(item)
-
-            for loc, items in location_items.items():
-                prod_nos = {item.get('production_no') for item in items if item.get('production_no')}
-                location_product_numbers[loc] = sorted(list(prod_nos))
+    snapshot = get_location_snapshot()
+    location_items = snapshot.location_items
 
-    except Exception as e:
-        logging.error(f"Error fetching data for inventory map: {e}")
-        flash("マップデータの取得中にエラーが発生しました。", "error")
+    # Classify by the shelf parsed from each location code
+    small_area_items = warehouse_layout.area_locations(location_items, 'small')
+    north_area_items = warehouse_layout.area_locations(location_items, 'north')
+    south_area_items = warehouse_layout.area_locations(location_items, 'south')
 
     return render_template('map.html', 
                            location_items=location_items, 
-                           location_product_numbers=location_product_numbers,
+                           location_product_numbers=snapshot.location_product_numbers,
                            small_area_items=small_area_items,
                            north_area_items=north_area_items,
                            south_area_items=south_area_items)
 
 
+@app.route('/map/location/<path:location_name>/items')
+@login_required
+def location_items(location_name):
+    """Returns the parts stored in a single map cell as JSON, for the map modal."""
+    snapshot = get_location_snapshot()
+    items = snapshot.location_items.get(location_name, [])
+    return jsonify({'location': location_name, 'items': items})
+
+
+@app.route('/events/locations')
+@login_required
+def location_event_stream():
+    """Server-Sent Events stream of location changes for the map pages."""
+    last_event_id = safe_int_convert(request.headers.get('Last-Event-ID'))
+    subscriber = location_events.subscribe(last_event_id)
+    if subscriber is None:
+        # Every stream holds a worker thread; browsers do not retry a refused stream and poll instead
+        response = jsonify({'success': False, 'message': 'ライブ更新の接続数が上限に達しています。'})
+        response.headers['Retry-After'] = '60'
+        return response, 503
+
+    # Not wrapped in stream_with_context: the stream must not hold the request's DB client
+    def generate():
+        try:
+            yield "retry: 3000\n\n"
+            deadline = time.monotonic() + location_events_max_duration
+            while time.monotonic() < deadline:
+                try:
+                    event_id, event = subscriber.get(timeout=location_events_keepalive)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"id: {event_id}\nevent: location-change\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+        finally:
+            location_events.unsubscribe(subscriber)
+
+    response = app.response_class(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
 @app.route('/update', methods=['GET', 'POST'])
 @login_required
 def search_for_update():
@@ -506,8 +3249,7 @@ def search_for_update():
         try:
             logging.info(f"GET request with production_no: '{production_no_param}'")
             # 製番で直接検索
-            response = supabase.table('parts').select('*').eq('production_no', production_no_param).execute()
-            search_results = response.data or []
+            search_results = list(iter_parts(read_db(), '*', lambda query: query.eq('production_no', production_no_param)))
             logging.info(f"Found {len(search_results)} results for production_no '{production_no_param}'")
 
             if not search_results:
@@ -563,33 +3305,16 @@ def move_production():
         return redirect(url_for('production_details', production_no=production_no))
 
     try:
-        # First, get the IDs and original info of the parts to be moved
-        select_response = supabase.table('parts').select("id, parts_name, storage_location").eq('production_no', production_no).execute()
-        items_to_move = select_response.data or []
+        moved = move_production_parts(g.db, production_no, None, new_location,
+                                      "製番一括移動", f"'{production_no}' の一括移動")
 
-        if not items_to_move:
+        if not moved:
             flash(f"製番 '{production_no}' の移動対象部品が見つかりませんでした。", "warning")
             return redirect(url_for('production_details', production_no=production_no))
 
-        item_ids = [item['id'] for item in items_to_move]
-
-        # Update all items at once
-        update_payload = {'storage_location': new_location, 'updated_at': datetime.now().isoformat()}
-        update_response = supabase.table('parts').update(update_payload).in_('id', item_ids).execute()
-
-        if update_response.data:
-            # Log the history for each moved item
-            for item in items_to_move:
-                log_work_history(
-                    item_id=item['id'],
-                    production_no=production_no,
-                    parts_name=item['parts_name'],
-                    action="製番一括移動",
-                    details=f"'{production_no}' の一括移動により、保管場所が '{item.get('storage_location')}' から '{new_location}' に変更されました。"
-                )
-            flash(f"製番 '{production_no}' の部品 {len(update_response.data)} 点を '{new_location}' へ正常に移動しました。", "success")
-        else:
-            flash("データベースの更新に失敗しました。", "danger")
+        invalidate_part_caches(written_rows=moved)
+        publish_location_changes((production_no, item.get('previous_storage_location'), new_location) for item in moved)
+        flash(f"製番 '{production_no}' の部品 {len(moved)} 点を '{new_location}' へ正常に移動しました。", "success")
 
     except Exception as e:
         logging.error(f"Error during bulk production move for {production_no}: {e}", exc_info=True)
@@ -598,18 +3323,28 @@ def move_production():
     return redirect(url_for('production_details', production_no=production_no))
 
 
+def reread_slip_updates(order_slip_no, ids_by_location, error):
+    """
+    Finds which of update_slip's per-location updates were committed when the batch failed as a
+    whole, by reading the slip's rows again. Returns, per target location, the rows of its ids that
+    are now there, or `error` for every location if the slip cannot be read either.
+    """
+    try:
+        rows_by_id = {str(row['id']): row for row in iter_parts(g.db, '*', lambda query: query.eq('order_slip_no', order_slip_no))}
+    except Exception as e:
+        logging.error(f"Error reading back slip {order_slip_no} after a failed update: {e}", exc_info=True)
+        return [error] * len(ids_by_location)
+    return [[rows_by_id[item_id] for item_id in item_ids
+             if item_id in rows_by_id and rows_by_id[item_id].get('storage_location') == storage_location]
+            for storage_location, item_ids in ids_by_location.items()]
+
+
 @app.route('/update/<order_slip_no>', methods=['GET', 'POST'])
 @login_required
 def update_slip(order_slip_no):
     """Page to update items for a specific order slip."""
     logging.info(f"Accessing /update/{order_slip_no}. Method: {request.method}")
     if request.method == 'POST':
-        # ... (rest of the update logic remains complex, refactoring later if needed)
-        # For now, just ensuring it uses the global supabase client
-        form_data = request.form
-        items_to_update = []
-        errors = []
-
         form_data = request.form
         items_to_update = []
         errors = []
@@ -617,8 +3352,7 @@ def update_slip(order_slip_no):
         # Fetch all current items for this order slip once
         try:
             logging.info(f"Fetching current items for slip: {order_slip_no}")
-            current_items_response = supabase.table('parts').select('*').eq('order_slip_no', order_slip_no).execute()
-            current_items_map = {str(item['id']): item for item in current_items_response.data}
+            current_items_map = {str(item['id']): item for item in iter_parts(g.db, '*', lambda query: query.eq('order_slip_no', order_slip_no))}
             logging.info(f"Found {len(current_items_map)} items for slip: {order_slip_no}")
         except Exception as e:
             logging.error(f"Error fetching current items for update (slip: {order_slip_no}): {e}", exc_info=True)
@@ -654,40 +3388,66 @@ def update_slip(order_slip_no):
             flash("更新する保管場所が入力されていません。", "info")
             return redirect(url_for('update_slip', order_slip_no=order_slip_no))
 
-        updated_count = 0
+        # Group changes by target location so each distinct location is a single UPDATE
+        ids_by_location = {}
         for item_data in items_to_update:
-            try:
-                current_item = item_data['current_item']
-                storage_location = item_data['storage_location']
+            storage_location = bulk_storage_location or item_data['storage_location']
+            ids_by_location.setdefault(storage_location, []).append(item_data['id'])
 
-                if bulk_storage_location:
-                    storage_location = bulk_storage_location
+        def update_location(storage_location, item_ids):
+            update_payload = {
+                'storage_location': storage_location,
+                'updated_at': datetime.now().isoformat()
+            }
+            logging.info(f"Updating {len(item_ids)} items with payload: {update_payload}")
+            return lambda db: db.table('parts').update(update_payload).in_('id', item_ids)
 
-                update_payload = {
-                    'storage_location': storage_location,
-                    'updated_at': datetime.now().isoformat()
-                }
-                logging.info(f"Updating item {current_item['id']} with payload: {update_payload}")
-                update_response = supabase.table('parts').update(update_payload).eq('id', current_item['id']).execute()
+        # The per-location updates are independent, so they run concurrently
+        try:
+            update_responses = gather_queries(
+                *(update_location(storage_location, item_ids) for storage_location, item_ids in ids_by_location.items()),
+                return_exceptions=True)
+            updated_rows = [response if isinstance(response, Exception) else response.data or [] for response in update_responses]
+        except Exception as e:
+            # The batch failed as a whole (e.g. timed out) after some updates may have been committed,
+            # so the slip is read again to record, invalidate and publish the ones that were
+            logging.error(f"Error updating items of slip {order_slip_no}: {e}", exc_info=True)
+            updated_rows = reread_slip_updates(order_slip_no, ids_by_location, e)
 
-                if update_response.data:
-                    log_work_history(
+        updated_count = 0
+        history_entries = []
+        location_changes = []
+        written_rows = []
+        for (storage_location, item_ids), rows in zip(ids_by_location.items(), updated_rows):
+            if isinstance(rows, Exception):
+                logging.error(f"Error updating items {item_ids}: {rows}", exc_info=rows)
+                errors.extend(f"部品ID {item_id} の更新中にエラーが発生しました。" for item_id in item_ids)
+                continue
+
+            # Rows missing from the returned data were not updated
+            updated_ids = {str(row['id']) for row in rows}
+            written_rows.extend(rows)
+            for item_id in item_ids:
+                current_item = current_items_map[item_id]
+                if item_id in updated_ids:
+                    history_entries.append(build_history_entry(
                         item_id=current_item['id'],
                         production_no=current_item.get('production_no'),
                         parts_name=current_item.get('parts_name'),
                         action="更新",
                         details=f"保管場所を「{storage_location}」に更新しました。"
-                    )
+                    ))
+                    location_changes.append((current_item.get('production_no'), current_item.get('storage_location'), storage_location))
                     updated_count += 1
                 else:
-                    logging.warning(f"Database update failed for item {current_item['id']}. Response: {update_response}")
+                    logging.warning(f"Database update failed for item {item_id}: not in the updated rows")
                     errors.append(f"部品 '{current_item.get('parts_name')}' のデータベース更新に失敗しました。")
 
-            except Exception as e:
-                logging.error(f"Error updating item {item_data['id']}: {e}", exc_info=True)
-                errors.append(f"部品ID {item_data['id']} の更新中にエラーが発生しました。")
+        log_work_history_bulk(history_entries)
 
         if updated_count > 0:
+            invalidate_part_caches(written_rows=written_rows)
+            publish_location_changes(location_changes)
             flash(f"{updated_count}件の部品情報を正常に更新しました。", "success")
         for error in errors:
             flash(error, "danger")
@@ -697,8 +3457,7 @@ def update_slip(order_slip_no):
     # GET request
     try:
         logging.info(f"GET request for update_slip: {order_slip_no}")
-        response = supabase.table('parts').select('*').eq('order_slip_no', order_slip_no).or_('storage_location.is.null,storage_location.eq.').execute()
-        items = response.data
+        items = list(iter_parts(read_db(), '*', lambda query: query.eq('order_slip_no', order_slip_no).or_('storage_location.is.null,storage_location.eq.')))
         if not items:
             flash(f"発注伝票No '{order_slip_no}' の部品が見つかりません。", "error")
             return redirect(url_for('search_for_update'))
@@ -718,7 +3477,7 @@ def delete_item(item_id):
     try:
         # アイテムを削除する前に、関連情報を取得
         logging.info(f"Fetching info for item {item_id} before deletion.")
-        item_response = supabase.table('parts').select('production_no, parts_name, order_slip_no').eq('id', item_id).single().execute()
+        item_response = g.db.table('parts').select('production_no, parts_name, order_slip_no').eq('id', item_id).single().execute()
         item_info = item_response.data
         
         if not item_info:
@@ -727,7 +3486,8 @@ def delete_item(item_id):
 
         # 削除実行
         logging.info(f"Executing delete for item {item_id}")
-        supabase.table('parts').delete().eq('id', item_id).execute()
+        g.db.table('parts').delete().eq('id', item_id).execute()
+        invalidate_part_caches(deleted_ids=[item_id])
 
         # 削除が成功したとみなし、作業履歴に記録
         log_work_history(
@@ -745,7 +3505,7 @@ def delete_item(item_id):
             # 同じ製番の他の部品が存在するかチェック
             try:
                 logging.info(f"Checking for remaining parts with production_no: {production_no}")
-                remaining_response = supabase.table('parts').select('id').eq('production_no', production_no).limit(
+                remaining_response = g.db.table('parts').select('id').eq('production_no', production_no).limit(
                     1).execute()
                 if remaining_response.data:
                     logging.info("Remaining parts found. Redirecting to production_details.")
@@ -770,41 +3530,24 @@ def production_details_by_location(production_no, location_name):
     """Displays details for a specific production number within a specific location."""
     logging.info(f"Accessing details for production {production_no} in location {location_name}")
     try:
-        # Filter parts by both production number and storage location
-        response = supabase.table('parts').select('*, order_quantity') \
-            .eq('production_no', production_no) \
-            .eq('storage_location', location_name) \
-            .order('order_slip_no', desc=False).execute()
-        
-        parts = response.data or []
-        logging.info(f"Found {len(parts)} parts for production {production_no} in {location_name}")
+        summary, history = get_production_page(read_db(), production_no, location_name=location_name)
+        logging.info(f"Found {summary['total_parts_count']} parts for production {production_no} in {location_name}")
 
-        if not parts:
+        if not summary['total_parts_count']:
             flash(f"製番 '{production_no}' の部品が場所 '{location_name}' に見つかりません。", "info")
             return redirect(url_for('inventory_map'))
 
-        # Group by order slip number (same logic as the original function)
-        order_slips = {}
-        total_parts_count = 0
-        unique_locations = {location_name} # Only one location in this view
-
-        for part in parts:
-            order_slip_no = part.get('order_slip_no', '未分類')
-            if order_slip_no not in order_slips:
-                order_slips[order_slip_no] = []
-            order_slips[order_slip_no].append(part)
-            total_parts_count += 1
-        
-        logging.info(f"Grouped into {len(order_slips)} order slips.")
-
         # Render the same template, but with extra context
         return render_template('production_details.html',
                                production_no=production_no,
-                               order_slips=order_slips,
-                               total_parts_count=total_parts_count,
-                               unique_locations=sorted(list(unique_locations)),
+                               order_slips=summary['order_slips'],
+                               total_parts_count=summary['total_parts_count'],
+                               unique_locations=summary['unique_locations'],
+                               location_counts=summary['location_counts'],
+                               last_moved_at=summary['last_moved_at'],
                                is_location_view=True, # Flag for the template
-                               location_name=location_name) # Pass location name to template
+                               location_name=location_name, # Pass location name to template
+                               history=history)
 
     except Exception as e:
         logging.error(f"Error fetching location-specific production details: {e}", exc_info=True)
@@ -818,46 +3561,73 @@ def production_details(production_no):
     """製番別の詳細表示ページ."""
     logging.info(f"Accessing /production/{production_no}")
     try:
-        # 指定された製番の全部品を取得
-        response = supabase.table('parts').select('*, order_quantity').eq('production_no', production_no).order('order_slip_no',
-                                                                                                desc=False).execute()
-        parts = response.data or []
-        logging.info(f"Found {len(parts)} parts for production_no '{production_no}'")
+        # 製番の集計 (発注伝票別の部品数・保管場所) を取得。部品一覧は伝票を開いた時に取得する
+        summary, history = get_production_page(read_db(), production_no)
+        logging.info(f"Found {summary['total_parts_count']} parts in {len(summary['order_slips'])} order slips for production_no '{production_no}'")
 
-        if not parts:
+        if not summary['total_parts_count']:
             flash(f"製番 '{production_no}' の部品が見つかりません。", "info")
             return redirect(url_for('inventory_map'))
 
-        # 発注伝票No別にグループ化
-        order_slips = {}
-        total_parts_count = 0
-        unique_locations = set()
-
-        for part in parts:
-            order_slip_no = part.get('order_slip_no', '未分類')
-            if order_slip_no not in order_slips:
-                order_slips[order_slip_no] = []
-
-            order_slips[order_slip_no].append(part)
-            total_parts_count += 1
-
-            if part.get('storage_location'):
-                unique_locations.add(part.get('storage_location'))
-        
-        logging.info(f"Grouped into {len(order_slips)} order slips. Total parts: {total_parts_count}")
-
         # テンプレートに渡すデータ
         return render_template('production_details.html',
                                production_no=production_no,
-                               order_slips=order_slips,
-                               total_parts_count=total_parts_count,
-                               unique_locations=sorted(list(unique_locations)))
+                               order_slips=summary['order_slips'],
+                               total_parts_count=summary['total_parts_count'],
+                               unique_locations=summary['unique_locations'],
+                               location_counts=summary['location_counts'],
+                               last_moved_at=summary['last_moved_at'],
+                               history=history)
 
     except Exception as e:
         logging.error(f"Error fetching production details for {production_no}: {e}", exc_info=True)
         flash("製番詳細の取得中にエラーが発生しました。", "error")
         return redirect(url_for('inventory_map'))
 
+
+@app.route('/production/<production_no>/parts')
+@login_required
+def production_slip_parts(production_no):
+    """Returns the parts of one order slip of a production number as JSON, for an expanded accordion row."""
+    # Without an order_slip_no argument, the parts that have no order slip are returned
+    order_slip_no = request.args.get('order_slip_no')
+    location_name = request.args.get('location')
+
+    def apply_filters(query):
+        query = query.eq('production_no', production_no)
+        if order_slip_no is None:
+            query = query.is_('order_slip_no', 'null')
+        else:
+            query = query.eq('order_slip_no', order_slip_no)
+        if location_name:
+            query = query.eq('storage_location', location_name)
+        return query
+
+    try:
+        parts = list(iter_parts(read_db(), SLIP_PART_COLUMNS, apply_filters))
+    except Exception as e:
+        logging.error(f"Error fetching parts of slip {order_slip_no} for production {production_no}: {e}", exc_info=True)
+        return jsonify({'success': False, 'message': '部品データの取得中にエラーが発生しました。'}), 500
+    return jsonify({'success': True, 'parts': parts})
+
+
+@app.route('/history')
+@login_required
+def work_history():
+    """Work history browser, filtered by user, action, date range, part or production number."""
+    history_args = get_history_args()
+    cursor = decode_cursor(request.args.get('cursor'))
+    try:
+        rows, next_cursor, prev_cursor = fetch_history_page(
+            g.db, history_args, history_page_size, cursor,
+            backwards=cursor is not None and request.args.get('dir') == 'prev')
+    except Exception as e:
+        logging.error(f"Error fetching work history: {e}")
+        flash("作業履歴の取得中にエラーが発生しました。", "error")
+        rows, next_cursor, prev_cursor = [], None, None
+    return render_template('history.html', rows=rows, history_args=history_args, actions=HISTORY_ACTIONS,
+                           next_cursor=next_cursor, prev_cursor=prev_cursor)
+
 '''
 @app.route('/move', methods=['GET', 'POST'])
 @login_required
@@ -872,7 +3642,7 @@ def search_for_move():
         # In move, we search only by production_no
         try:
             search_query = escape_like_term(search_term)
-            response = supabase.table('parts').select('*').ilike('production_no', search_query).execute()
+            response = read_db().table('parts').select('*').ilike('production_no', search_query).execute()
             search_results = response.data or []
         except Exception as e:
             logging.error(f"Error searching for move with term '{search_term}': {e}")
@@ -897,7 +3667,7 @@ def move_item(item_id):
     """Page to move a specific item."""
     logging.info(f"Accessing /move/{item_id}. Method: {request.method}")
     try:
-        item_resp = supabase.table('parts').select('*').eq('id', item_id).single().execute()
+        item_resp = g.db.table('parts').select('*').eq('id', item_id).single().execute()
         current_item = item_resp.data
         if not current_item:
             flash("指定された部品が見つかりません。", "error")
@@ -918,9 +3688,11 @@ def move_item(item_id):
         try:
             update_payload = {'storage_location': new_storage_location, 'updated_at': datetime.now().isoformat()}
             logging.info(f"Updating item {item_id} with payload: {update_payload}")
-            update_response = supabase.table('parts').update(update_payload).eq('id', item_id).execute()
+            update_response = g.db.table('parts').update(update_payload).eq('id', item_id).execute()
 
             if update_response.data:
+                invalidate_part_caches(written_rows=update_response.data)
+                publish_location_changes([(current_item.get('production_no'), current_item.get('storage_location'), new_storage_location)])
                 log_work_history(
                     item_id=item_id,
                     production_no=current_item.get('production_no'),
@@ -954,34 +3726,16 @@ def move_production_from_location(location_name, production_no):
             return render_template('move_production.html', location_name=location_name, production_no=production_no)
 
         try:
-            # Find all parts matching the criteria
-            response = supabase.table('parts').select('id, parts_name').eq('production_no', production_no).eq('storage_location', location_name).execute()
-            items_to_move = response.data or []
+            moved = move_production_parts(g.db, production_no, location_name, new_storage_location,
+                                          "一括移動", f"製番 '{production_no}' の一括移動")
 
-            if not items_to_move:
+            if not moved:
                 flash("移動対象の部品が見つかりませんでした。", "warning")
                 return redirect(url_for('inventory_map'))
 
-            # Update all found items
-            update_payload = {'storage_location': new_storage_location, 'updated_at': datetime.now().isoformat()}
-            
-            # Update in a batch if possible, otherwise loop
-            item_ids = [item['id'] for item in items_to_move]
-            update_response = supabase.table('parts').update(update_payload).in_('id', item_ids).execute()
-
-            if update_response.data:
-                # Log each move for history
-                for item in items_to_move:
-                    log_work_history(
-                        item_id=item['id'],
-                        production_no=production_no,
-                        parts_name=item['parts_name'],
-                        action="一括移動",
-                        details=f"製番 '{production_no}' の一括移動により、保管場所が '{location_name}' から '{new_storage_location}' に変更されました。"
-                    )
-                flash(f"製番 '{production_no}' の部品 {len(items_to_move)} 点を '{new_storage_location}' へ移動しました。", "success")
-            else:
-                flash("データベースの更新に失敗しました。", "danger")
+            invalidate_part_caches(written_rows=moved)
+            publish_location_changes([(production_no, location_name, new_storage_location)] * len(moved))
+            flash(f"製番 '{production_no}' の部品 {len(moved)} 点を '{new_storage_location}' へ移動しました。", "success")
 
             return redirect(url_for('move_production_from_location', location_name=location_name, production_no=production_no))
 
@@ -1005,38 +3759,239 @@ def move_production_dnd():
         return jsonify({'success': False, 'message': '必要な情報が不足しています。'}), 400
 
     try:
-        # Find all parts matching the criteria
-        response = supabase.table('parts').select('id, parts_name').eq('production_no', production_no).eq('storage_location', original_location).execute()
-        items_to_move = response.data or []
+        moved = move_production_parts(g.db, production_no, original_location, new_location,
+                                      "D&D一括移動", f"製番 '{production_no}' のD&D一括移動")
 
-        if not items_to_move:
+        if not moved:
             return jsonify({'success': False, 'message': '移動対象の部品が見つかりませんでした。'}), 404
 
-        # Update all found items
-        update_payload = {'storage_location': new_location, 'updated_at': datetime.now().isoformat()}
-        
-        item_ids = [item['id'] for item in items_to_move]
-        update_response = supabase.table('parts').update(update_payload).in_('id', item_ids).execute()
-
-        if update_response.data:
-            # Log each move for history
-            for item in items_to_move:
-                log_work_history(
-                    item_id=item['id'],
-                    production_no=production_no,
-                    parts_name=item['parts_name'],
-                    action="D&D一括移動",
-                    details=f"製番 '{production_no}' のD&D一括移動により、保管場所が '{original_location}' から '{new_location}' に変更されました。"
-                )
-            return jsonify({'success': True, 'message': f"製番 '{production_no}' の部品 {len(items_to_move)} 点を '{new_location}' へ移動しました。"})
-        else:
-            return jsonify({'success': False, 'message': 'データベースの更新に失敗しました。'}), 500
+        invalidate_part_caches(written_rows=moved)
+        publish_location_changes([(production_no, original_location, new_location)] * len(moved))
+        return jsonify({'success': True, 'message': f"製番 '{production_no}' の部品 {len(moved)} 点を '{new_location}' へ移動しました。"})
 
     except Exception as e:
         logging.error(f"Error during D&D bulk move: {e}", exc_info=True)
         return jsonify({'success': False, 'message': f"一括移動中にエラーが発生しました: {e}"}), 500
 
 
+@app.route('/export/inventory')
+@login_required
+def export_inventory():
+    """CSV download of the parts with a storage location, with the filters and sort order of /inventory."""
+    list_args = get_list_args()
+    return export_parts_csv(
+        f"inventory_{datetime.now():%Y%m%d%H%M}.csv",
+        iter_list_batches(read_db(), ', '.join(EXPORT_COLUMNS), list_args,
+                          lambda query: query.not_.is_('storage_location', 'null').neq('storage_location', '')))
+
+
+@app.route('/export/location/<path:location_name>')
+@login_required
+def export_location(location_name):
+    """CSV download of the parts stored in one location."""
+    return export_parts_csv(
+        f"location_{location_name.replace('/', '_')}.csv",
+        iter_list_batches(read_db(), ', '.join(EXPORT_COLUMNS), get_list_args(),
+                          lambda query: query.eq('storage_location', location_name)))
+
+
+@app.route('/export/production/<production_no>')
+@login_required
+def export_production(production_no):
+    """CSV download of all parts of a production number."""
+    return export_parts_csv(
+        f"production_{production_no}.csv",
+        iter_list_batches(read_db(), ', '.join(EXPORT_COLUMNS), get_list_args(),
+                          lambda query: query.eq('production_no', production_no)))
+
+
+@app.route('/metrics')
+def metrics():
+    """Per-endpoint request metrics of this worker in the Prometheus text format."""
+    authorization = request.headers.get('Authorization', '')
+    token_ok = bool(metrics_token) and hmac.compare_digest(authorization.encode(), f"Bearer {metrics_token}".encode())
+    if not token_ok and g.user is None:
+        return app.response_class("Unauthorized\n", status=401, mimetype='text/plain')
+    return app.response_class(endpoint_metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/cache/stats')
+@login_required
+def cache_stats():
+    """Returns hit/miss counters of this worker's in-process caches."""
+    return jsonify({
+        'search': search_cache.stats(),
+        'verified_users': verified_user_cache.stats(),
+        'read_replica': read_replica.stats() if read_replica is not None else None,
+        'change_feed': change_feed.stats() if change_feed is not None else None,
+    })
+
+
+# --- JSON API ---
+
+def make_etag(*version_parts):
+    """Derives a strong ETag from the values that identify a version of a resource."""
+    return hashlib.sha1(json.dumps(version_parts, default=str).encode('utf-8')).hexdigest()
+
+
+def conditional_json(etag, build_payload):
+    """
+    Returns 304 Not Modified if the client already has this version,
+    otherwise builds the payload and returns it with its ETag.
+    """
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(build_payload())
+    response.set_etag(etag)
+    # Clients must revalidate every time, but may reuse their copy on 304
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+@app.route('/api/v1/locations')
+@login_required
+def api_locations():
+    """Production numbers per location, optionally limited to one map area (?area=north)."""
+    area = request.args.get('area')
+    if area and area not in warehouse_layout.areas:
+        return jsonify({'success': False, 'message': f"不明なエリアです: {area}"}), 400
+
+    snapshot = get_location_snapshot()
+    # The checksum also changes on deletes and change feed patches, which do not move max(updated_at)
+    etag = make_etag('locations', area, snapshot.watermark, snapshot.located_count, snapshot.checksum)
+
+    def build_payload():
+        location_product_numbers = snapshot.location_product_numbers
+        if area:
+            location_product_numbers = warehouse_layout.area_locations(location_product_numbers, area)
+        return {
+            'version': snapshot.watermark,
+            'locations': {
+                loc: {'production_numbers': prod_nos, 'part_count': len(snapshot.location_items.get(loc, []))}
+                for loc, prod_nos in location_product_numbers.items()
+            },
+        }
+
+    return conditional_json(etag, build_payload)
+
+
+@app.route('/api/v1/production/<production_no>')
+@login_required
+def api_production(production_no):
+    """Summary of a production number: per-slip counts, locations and last change time."""
+    try:
+        # max(updated_at) and the row count in one request
+        db = read_db()
+        version_response = db.table('parts').select('updated_at', count='exact').eq('production_no', production_no) \
+            .order('updated_at', desc=True).limit(1).execute()
+    except Exception as e:
+        logging.error(f"Error fetching version of production {production_no}: {e}", exc_info=True)
+        return jsonify({'success': False, 'message': '製番データの取得中にエラーが発生しました。'}), 500
+
+    if not version_response.data:
+        return jsonify({'success': False, 'message': f"製番 '{production_no}' の部品が見つかりません。"}), 404
+    version = (version_response.data[0].get('updated_at'), version_response.count)
+    etag = make_etag('production', production_no, *version)
+
+    def build_payload():
+        summary = get_production_summary(db, production_no, version=version)
+        return {
+            'production_no': production_no,
+            'total_parts_count': summary['total_parts_count'],
+            'last_moved_at': summary['last_moved_at'],
+            'location_counts': summary['location_counts'],
+            'order_slips': [
+                {'order_slip_no': order_slip_no, **slip}
+                for order_slip_no, slip in summary['order_slips'].items()
+            ],
+        }
+
+    return conditional_json(etag, build_payload)
+
+
+@app.route('/api/v1/parts/<item_id>')
+@login_required
+def api_part(item_id):
+    """A single part."""
+    try:
+        response = read_db().table('parts').select('*').eq('id', item_id).limit(1).execute()
+    except Exception as e:
+        logging.error(f"Error fetching part {item_id}: {e}", exc_info=True)
+        return jsonify({'success': False, 'message': '部品データの取得中にエラーが発生しました。'}), 500
+
+    if not response.data:
+        return jsonify({'success': False, 'message': '指定された部品が見つかりません。'}), 404
+    item = response.data[0]
+    return conditional_json(make_etag('part', item_id, item.get('updated_at')), lambda: item)
+
+
+@app.route('/api/v1/moves/batch', methods=['POST'])
+@login_required
+def api_move_batch():
+    """
+    Moves several production numbers between locations in one request, e.g. a queue of
+    drag-and-drops on the map: {"moves": [{"production_no", "from_location", "to_location"}, ...]}.
+    The operations are validated together and applied all or nothing.
+    """
+    moves, errors = validate_batch_moves(request.get_json(silent=True))
+    if errors:
+        return jsonify({'success': False, 'message': '移動内容に誤りがあります。', 'errors': errors}), 400
+
+    try:
+        moved, missing = move_production_parts_batch(g.db, moves, "まとめて移動", "製番 '{}' のまとめて移動")
+    except Exception as e:
+        logging.error(f"Error during batch move: {e}", exc_info=True)
+        return jsonify({'success': False, 'message': f"まとめて移動中にエラーが発生しました: {e}"}), 500
+
+    if moved is None:
+        # Separate requests could not apply the batch all or nothing, so there is no fallback
+        return jsonify({
+            'success': False,
+            'message': 'まとめて移動は現在利用できません。データベースに move_production_parts_batch 関数のマイグレーションを適用してください。',
+        }), 503
+
+    if missing:
+        return jsonify({
+            'success': False,
+            'message': '移動対象の部品が見つからない移動があるため、何も移動しませんでした。',
+            'errors': [f"製番 '{move['production_no']}' の部品が '{move['from_location']}' に見つかりません。" for move in missing],
+        }), 409
+
+    invalidate_part_caches(written_rows=moved)
+    publish_location_changes([(row['production_no'], row['previous_storage_location'], row['storage_location']) for row in moved])
+    counts = Counter((row['production_no'], row['previous_storage_location']) for row in moved)
+    return jsonify({
+        'success': True,
+        'message': f"{len(moves)} 件の移動で部品 {len(moved)} 点を移動しました。",
+        'moves': [dict(move, moved_count=counts[(move['production_no'], move['from_location'])]) for move in moves],
+    })
+
+
+@app.route('/api/v1/scan/<path:code>')
+@login_required
+def api_scan(code):
+    """
+    Resolves a scanned code for handheld scanners: the matched column and the URL to open.
+    Falls back to the substring search on a miss.
+    """
+    code = code.strip()
+    try:
+        column, rows = lookup_scan_code(code)
+    except Exception as e:
+        logging.error(f"Error looking up scanned code '{code}': {e}", exc_info=True)
+        return jsonify({'success': False, 'message': 'コードの照会中にエラーが発生しました。'}), 500
+
+    if column is not None:
+        return jsonify({'success': True, 'match': column, 'url': scan_target_url(column, rows, code),
+                        'part_ids': [row['id'] for row in rows]})
+    parts = search_parts(code)
+    if not parts:
+        return jsonify({'success': False, 'message': f"コード '{code}' に一致する部品は見つかりませんでした。"}), 404
+    return jsonify({'success': True, 'match': 'search', 'url': url_for('search', search_term=code),
+                    'part_ids': [part['id'] for part in parts]})
+
+
 # --- Authentication Routes ---
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -1050,6 +4005,9 @@ def login():
         try:
             res = supabase.auth.sign_in_with_password({"email": email, "password": password})
             session['user_jwt'] = res.session.access_token
+            # Prime the cache so the first page view does not need another auth round trip
+            verified_user_cache.set(_token_cache_key(res.session.access_token), res.user,
+                                    expires_at=res.session.expires_at)
             flash("ログインしました。", "success")
             return redirect(url_for('index'))
         except AuthApiError as e:
@@ -1065,6 +4023,7 @@ def login():
 @login_required
 def logout():
     """Logs the user out."""
+    verified_user_cache.pop(_token_cache_key(session['user_jwt']))
     try:
         supabase.auth.sign_out(session['user_jwt'])
     except Exception as e:
@@ -1095,6 +4054,36 @@ def register():
     return render_template('register.html')
 
 
+# --- CLI Commands ---
+
+@app.cli.command('import-parts')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--email', envvar='IMPORT_USER_EMAIL', required=True, help="User the rows are registered as.")
+@click.option('--password', envvar='IMPORT_USER_PASSWORD', prompt=True, hide_input=True)
+def import_parts_command(path, email, password):
+    """Registers parts from a CSV or XLSX order list, e.g. `flask --app app import-parts orders.xlsx`."""
+    res = supabase.auth.sign_in_with_password({"email": email, "password": password})
+    source_name = os.path.basename(path)
+    started = time.monotonic()
+
+    with postgrest_pool.borrow(res.session.access_token) as db, open(path, 'rb') as f:
+        def write_history(entries):
+            try:
+                insert_work_history(db, entries)
+            except Exception as e:
+                logging.error(f"Failed to log work history: {e}")
+
+        report = import_parts(db, iter_import_rows(f, path, import_batch_size), write_history, source_name)
+
+    for line_no, message in report['errors']:
+        click.echo(f"{line_no}行目: {message}", err=True)
+    if report['error_count'] > len(report['errors']):
+        click.echo(f"... ほか {report['error_count'] - len(report['errors'])}件のエラー", err=True)
+    click.echo(f"{report['total']}行中 {report['inserted']}件を登録しました"
+               f"（登録済みのため除外 {report['skipped']}件、エラー {report['error_count']}件、"
+               f"{time.monotonic() - started:.1f}秒）。")
+
+
 # --- Main Execution ---
 
 if __name__ == '__main__':
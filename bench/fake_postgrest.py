@@ -0,0 +1,520 @@
+"""
+In-memory stand-in for the Supabase PostgREST API, served through an httpx transport.
+
+The app's real PostgREST client (query builder, pooling, instrumentation) is used
+unchanged; only the HTTP transport is replaced. Supports the subset of PostgREST the
+app uses: select/insert/upsert/update/delete on tables, the parts_production_summary
+view, horizontal filters (eq, neq, gt, gte, lt, lte, like, ilike, is, in, not., or, and),
+order, limit/offset, exact counts and single-object responses, and parts_tombstones
+(filled by deletes). It implements move_production_parts_batch, which the app has no
+fallback for; other RPCs answer PGRST202 like a database without the migration, so the
+app takes its fallback paths.
+"""
+import asyncio
+import bisect
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from urllib.parse import parse_qsl
+
+import httpx
+
+# Columns with an equality index, and columns with an ordered index for gt/gte filters.
+# The fake models a database with the indexes the app's queries expect.
+INDEXED_COLUMNS = {
+    'parts': ('production_no', 'storage_location', 'order_slip_no', 'parts_no'),
+    'work_history': (),
+}
+RANGE_INDEXED_COLUMNS = {
+    'parts': ('updated_at',),
+}
+UNIQUE_KEYS = {
+    'parts': ('production_no', 'parts_no', 'order_slip_no', 'dimensions', 'drawing_no', 'parts_name'),
+}
+
+
+class PostgrestError(Exception):
+    def __init__(self, status, code, message, details=None):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+        self.message = message
+        self.details = details
+
+
+# --- Filters ---
+
+def _split_top_level(text):
+    """Splits 'a.eq.1,and(b.eq.2,c.eq.3)' on commas outside parentheses and quotes."""
+    parts, depth, quoted, current = [], 0, False, ''
+    for ch in text:
+        if ch == '"':
+            quoted = not quoted
+        elif not quoted and ch == '(':
+            depth += 1
+        elif not quoted and ch == ')':
+            depth -= 1
+        if ch == ',' and depth == 0 and not quoted:
+            parts.append(current)
+            current = ''
+        else:
+            current += ch
+    if current:
+        parts.append(current)
+    return parts
+
+
+def _unquote(value):
+    if len(value) >= 2 and value[0] == '"' and value[-1] == '"':
+        return value[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+    return value
+
+
+def _like_regex(pattern):
+    out, i = [], 0
+    while i < len(pattern):
+        ch = pattern[i]
+        if ch == '\\' and i + 1 < len(pattern):
+            out.append(re.escape(pattern[i + 1]))
+            i += 2
+            continue
+        out.append('.*' if ch in '%*' else '.' if ch == '_' else re.escape(ch))
+        i += 1
+    return '^' + ''.join(out) + '$'
+
+
+def _compare(row_value, op, value):
+    a, b = row_value, value
+    if isinstance(a, (int, float)) and not isinstance(a, bool):
+        try:
+            b = type(a)(b)
+        except ValueError:
+            a = str(a)
+    else:
+        a = str(a)
+    return {'gt': a > b, 'gte': a >= b, 'lt': a < b, 'lte': a <= b}[op]
+
+
+class Condition:
+    """One column filter, e.g. storage_location=not.is.null."""
+
+    def __init__(self, column, op, value, negate=False):
+        self.column = column
+        self.op = op
+        self.negate = negate
+        if op == 'in':
+            self.value = {_unquote(v) for v in _split_top_level(value.strip('()'))}
+        elif op in ('like', 'ilike'):
+            self.value = re.compile(_like_regex(_unquote(value)), re.DOTALL | (re.IGNORECASE if op == 'ilike' else 0))
+        else:
+            self.value = _unquote(value)
+
+    def __call__(self, row):
+        v = row.get(self.column)
+        op = self.op
+        if op == 'is':
+            result = (v is None) if self.value == 'null' else (str(v).lower() == self.value)
+        elif v is None:
+            result = False
+        elif op == 'eq':
+            result = str(v) == self.value
+        elif op == 'neq':
+            result = str(v) != self.value
+        elif op in ('gt', 'gte', 'lt', 'lte'):
+            result = _compare(v, op, self.value)
+        elif op == 'in':
+            result = str(v) in self.value
+        elif op in ('like', 'ilike'):
+            result = bool(self.value.match(str(v)))
+        else:
+            raise PostgrestError(400, 'PGRST100', f'unsupported operator "{op}"')
+        return not result if self.negate else result
+
+
+class Group:
+    def __init__(self, conditions, any_of):
+        self.conditions = conditions
+        self.any_of = any_of
+
+    def __call__(self, row):
+        if self.any_of:
+            return any(c(row) for c in self.conditions)
+        return all(c(row) for c in self.conditions)
+
+
+def parse_condition(column, expression):
+    negate = expression.startswith('not.')
+    if negate:
+        expression = expression[4:]
+    op, _, value = expression.partition('.')
+    return Condition(column, op, value, negate)
+
+
+def parse_logic(expression):
+    """Parses an or=/and= expression element such as 'and(a.eq.1,b.gt.2)' or 'a.eq.1'."""
+    match = re.match(r'^(not\.)?(and|or)\((.*)\)$', expression, re.DOTALL)
+    if match:
+        group = Group([parse_logic(part) for part in _split_top_level(match.group(3))], match.group(2) == 'or')
+        return (lambda row: not group(row)) if match.group(1) else group
+    column, _, rest = expression.partition('.')
+    return parse_condition(column, rest)
+
+
+# --- Tables ---
+
+class Table:
+    """Rows kept in primary key order with equality indexes on a few columns."""
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = {}
+        self.ids = []
+        self.next_id = 1
+        self.indexes = {column: {} for column in INDEXED_COLUMNS.get(name, ())}
+        self.range_indexes = {column: [] for column in RANGE_INDEXED_COLUMNS.get(name, ())}
+        self.unique_columns = UNIQUE_KEYS.get(name)
+        self.unique_index = {}
+
+    def _unique_key(self, row):
+        return tuple(row.get(c) or '' for c in self.unique_columns)
+
+    def _index(self, row):
+        for column, index in self.indexes.items():
+            index.setdefault(row.get(column), set()).add(row['id'])
+        for column, index in self.range_indexes.items():
+            if row.get(column) is not None:
+                bisect.insort(index, (row[column], row['id']))
+        if self.unique_columns:
+            self.unique_index[self._unique_key(row)] = row['id']
+
+    def _unindex(self, row):
+        for column, index in self.indexes.items():
+            ids = index.get(row.get(column))
+            if ids:
+                ids.discard(row['id'])
+        for column, index in self.range_indexes.items():
+            if row.get(column) is not None:
+                position = bisect.bisect_left(index, (row[column], row['id']))
+                if position < len(index) and index[position] == (row[column], row['id']):
+                    del index[position]
+        if self.unique_columns:
+            self.unique_index.pop(self._unique_key(row), None)
+
+    def insert(self, row):
+        if 'id' not in row:
+            row['id'] = self.next_id
+        self.next_id = max(self.next_id, row['id'] + 1)
+        self.rows[row['id']] = row
+        if self.ids and row['id'] < self.ids[-1]:
+            bisect.insort(self.ids, row['id'])
+        else:
+            self.ids.append(row['id'])
+        self._index(row)
+
+    def find_duplicate(self, row):
+        if not self.unique_columns:
+            return None
+        row_id = self.unique_index.get(self._unique_key(row))
+        return self.rows.get(row_id)
+
+    def update(self, row, changes):
+        self._unindex(row)
+        row.update(changes)
+        self._index(row)
+
+    def delete(self, row):
+        self._unindex(row)
+        del self.rows[row['id']]
+        del self.ids[bisect.bisect_left(self.ids, row['id'])]
+
+    def candidates(self, conditions):
+        """Returns candidate rows in id order, narrowed by an index or an id range when possible."""
+        best = None
+        for condition in conditions:
+            if not isinstance(condition, Condition) or condition.negate:
+                continue
+            if condition.op == 'eq' and condition.column in self.indexes:
+                ids = self.indexes[condition.column].get(condition.value, ())
+            elif condition.op == 'eq' and condition.column == 'id':
+                ids = [int(condition.value)] if condition.value.isdigit() else []
+            elif condition.op == 'in' and condition.column == 'id':
+                ids = [int(v) for v in condition.value if v.isdigit()]
+            elif condition.op in ('gt', 'gte') and condition.column in self.range_indexes:
+                index = self.range_indexes[condition.column]
+                start = bisect.bisect_left(index, (condition.value,)) if condition.op == 'gte' \
+                    else bisect.bisect_right(index, (condition.value, float('inf')))
+                ids = [row_id for _, row_id in index[start:]]
+            else:
+                continue
+            if best is None or len(ids) < len(best):
+                best = ids
+        if best is not None:
+            return [self.rows[i] for i in sorted(best) if i in self.rows]
+
+        start = 0
+        for condition in conditions:
+            if isinstance(condition, Condition) and not condition.negate and condition.column == 'id' \
+                    and condition.op in ('gt', 'gte') and condition.value.lstrip('-').isdigit():
+                bound = int(condition.value)
+                start = max(start, bisect.bisect_right(self.ids, bound) if condition.op == 'gt'
+                            else bisect.bisect_left(self.ids, bound))
+        return (self.rows[i] for i in self.ids[start:])
+
+
+def production_summary_view(db, conditions):
+    """parts_production_summary: part counts and last change per production number, slip and location."""
+    parts = db.tables['parts']
+    groups = {}
+    for row in parts.candidates([c for c in conditions if getattr(c, 'column', None) == 'production_no']):
+        key = (row.get('production_no'), row.get('order_slip_no'), row.get('storage_location'))
+        group = groups.get(key)
+        if group is None:
+            groups[key] = group = {'production_no': key[0], 'order_slip_no': key[1], 'storage_location': key[2],
+                                   'part_count': 0, 'last_moved_at': None}
+        group['part_count'] += 1
+        if row.get('updated_at') and (group['last_moved_at'] is None or row['updated_at'] > group['last_moved_at']):
+            group['last_moved_at'] = row['updated_at']
+    return list(groups.values())
+
+
+def tombstones_view(db, conditions):
+    """parts_tombstones: ids of deleted parts in deletion order, as recorded by the delete trigger."""
+    return db.tombstones
+
+
+VIEWS = {'parts_production_summary': production_summary_view, 'parts_tombstones': tombstones_view}
+
+
+# --- RPCs ---
+
+def move_production_parts_batch_rpc(db, p_moves, p_action, p_details_format, p_updated_at=None):
+    """move_production_parts_batch: moves every operation, or nothing and P0002 with the operations that found no parts."""
+    parts = db.tables['parts']
+    targets = [
+        (parts.rows[row_id], move['to_location'])
+        for move in p_moves if move['from_location'] != move['to_location']
+        for row_id in sorted(parts.indexes['production_no'].get(move['production_no'], ()))
+        if parts.rows[row_id]['storage_location'] == move['from_location']
+    ]
+    found = {(row['production_no'], row['storage_location']) for row, _ in targets}
+    missing = [move for move in p_moves if (move['production_no'], move['from_location']) not in found]
+    if missing:
+        raise PostgrestError(400, 'P0002', f'Nothing to move for {len(missing)} operation(s)', json.dumps(missing))
+
+    now = p_updated_at or datetime.now().isoformat()
+    moved = []
+    for row, to_location in targets:
+        previous = row['storage_location']
+        parts.update(row, {'storage_location': to_location, 'updated_at': now})
+        db.tables['work_history'].insert({
+            'item_id': row['id'], 'production_no': row['production_no'], 'parts_name': row.get('parts_name'),
+            'action': p_action, 'created_at': now,
+            'details': f"{p_details_format.replace('{}', row['production_no'])}により、保管場所が '{previous}' から '{to_location}' に変更されました。",
+        })
+        moved.append(dict(row, previous_storage_location=previous))
+    return moved
+
+
+RPCS = {'move_production_parts_batch': move_production_parts_batch_rpc}
+
+
+class FakePostgrest:
+    """
+    The fake server. `handle` and `handle_async` are the httpx transport handlers of the
+    sync and async clients; every request sleeps for the configured latency (with +-20%
+    jitter) to model the network round trip.
+    """
+
+    def __init__(self, latency=0.0, rng=None):
+        self.latency = latency
+        self.rng = rng or random.Random(0)
+        self.tables = {'parts': Table('parts'), 'work_history': Table('work_history')}
+        self.rpcs = dict(RPCS)
+        self.tombstones = []
+        self.round_trips = 0
+        self._lock = threading.Lock()
+
+    def transport(self):
+        return httpx.MockTransport(self.handle)
+
+    def async_transport(self):
+        return httpx.MockTransport(self.handle_async)
+
+    def handle(self, request):
+        if self.latency:
+            time.sleep(self.latency * self.rng.uniform(0.8, 1.2))
+        return self._respond(request)
+
+    async def handle_async(self, request):
+        if self.latency:
+            await asyncio.sleep(self.latency * self.rng.uniform(0.8, 1.2))
+        return self._respond(request)
+
+    def _respond(self, request):
+        try:
+            with self._lock:
+                self.round_trips += 1
+                return self._dispatch(request)
+        except PostgrestError as e:
+            return httpx.Response(e.status, json={'code': e.code, 'message': e.message, 'details': e.details, 'hint': None})
+
+    def _dispatch(self, request):
+        path = request.url.path.split('/rest/v1/', 1)[-1]
+        params = parse_qsl(request.url.query.decode(), keep_blank_values=True)
+        prefer = {p.strip() for p in request.headers.get('prefer', '').split(',') if p.strip()}
+
+        if path.startswith('rpc/'):
+            name = path[4:]
+            if name not in self.rpcs:
+                raise PostgrestError(404, 'PGRST202', f'Could not find the function public.{name}')
+            args = json.loads(request.content or b'{}')
+            return httpx.Response(200, json=self.rpcs[name](self, **args))
+
+        conditions, select, order, limit, offset, on_conflict = [], '*', [], None, 0, None
+        for key, value in params:
+            if key == 'select':
+                select = value
+            elif key == 'order':
+                order = value.split(',')
+            elif key == 'limit':
+                limit = int(value)
+            elif key == 'offset':
+                offset = int(value)
+            elif key == 'on_conflict':
+                on_conflict = value
+            elif key == 'columns':
+                continue
+            elif key in ('or', 'and'):
+                conditions.append(parse_logic(f"{key}{value}"))
+            else:
+                conditions.append(parse_condition(key, value))
+
+        if path in VIEWS:
+            if request.method != 'GET':
+                raise PostgrestError(405, 'PGRST105', 'views are read-only here')
+            rows = [r for r in VIEWS[path](self, conditions) if all(c(r) for c in conditions)]
+            return self._select_response(request, rows, select, order, limit, offset, prefer)
+        table = self.tables.get(path)
+        if table is None:
+            raise PostgrestError(404, '42P01', f'relation "public.{path}" does not exist')
+
+        if request.method == 'GET':
+            return self._select(request, table, conditions, select, order, limit, offset, prefer)
+        if request.method == 'POST':
+            return self._insert(table, json.loads(request.content), on_conflict, prefer)
+        if request.method == 'PATCH':
+            changes = json.loads(request.content)
+            rows = [r for r in table.candidates(conditions) if all(c(r) for c in conditions)]
+            for row in rows:
+                table.update(row, changes)
+            return self._write_response(rows, prefer)
+        if request.method == 'DELETE':
+            rows = [r for r in table.candidates(conditions) if all(c(r) for c in conditions)]
+            now = datetime.now().isoformat()
+            for row in rows:
+                table.delete(row)
+                if table.name == 'parts':
+                    self.tombstones.append({'seq': len(self.tombstones) + 1, 'id': str(row['id']), 'deleted_at': now})
+            return self._write_response(rows, prefer)
+        raise PostgrestError(405, 'PGRST105', f'unsupported method {request.method}')
+
+    def _select(self, request, table, conditions, select, order, limit, offset, prefer):
+        matching = (r for r in table.candidates(conditions) if all(c(r) for c in conditions))
+        in_id_order = all(o.split('.')[0] == 'id' and '.desc' not in o for o in order)
+        if in_id_order and limit is not None and 'count=exact' not in prefer:
+            # Rows come out in id order already; stop as soon as the page is full
+            rows = []
+            for row in matching:
+                rows.append(row)
+                if len(rows) >= offset + limit:
+                    break
+            return self._select_response(request, rows, select, [], limit, offset, prefer)
+        return self._select_response(request, list(matching), select, order, limit, offset, prefer)
+
+    @staticmethod
+    def _select_response(request, rows, select, order, limit, offset, prefer):
+        for term in reversed(order):
+            column, *modifiers = term.split('.')
+            desc = 'desc' in modifiers
+            nulls_first = 'nullsfirst' in modifiers or (desc and 'nullslast' not in modifiers)
+            present = [r for r in rows if r.get(column) is not None]
+            missing = [r for r in rows if r.get(column) is None]
+            present.sort(key=lambda r: r[column], reverse=desc)
+            rows = missing + present if nulls_first else present + missing
+        total = len(rows)
+        rows = rows[offset:offset + limit] if limit is not None else rows[offset:]
+        columns = [c.strip() for c in select.split(',')]
+        if '*' not in columns:
+            rows = [{c: r.get(c) for c in columns} for r in rows]
+        else:
+            rows = [dict(r) for r in rows]
+
+        headers = {}
+        if 'count=exact' in prefer:
+            headers['content-range'] = f"{offset}-{offset + len(rows) - 1}/{total}" if rows else f"*/{total}"
+        if request.headers.get('accept') == 'application/vnd.pgrst.object+json':
+            if len(rows) != 1:
+                raise PostgrestError(406, 'PGRST116', 'JSON object requested, multiple (or no) rows returned')
+            return httpx.Response(200, json=rows[0], headers=headers)
+        return httpx.Response(200, json=rows, headers=headers)
+
+    def _insert(self, table, payload, on_conflict, prefer):
+        payload = payload if isinstance(payload, list) else [payload]
+        now = datetime.now().isoformat()
+        written = []
+        for values in payload:
+            row = dict(values)
+            duplicate = table.find_duplicate(row)
+            if duplicate is not None:
+                if 'resolution=ignore-duplicates' in prefer and on_conflict:
+                    continue
+                if 'resolution=merge-duplicates' in prefer and on_conflict:
+                    table.update(duplicate, row)
+                    written.append(duplicate)
+                    continue
+                raise PostgrestError(409, '23505', 'duplicate key value violates unique constraint')
+            row.setdefault('created_at', now)
+            row.setdefault('updated_at', row['created_at'])
+            table.insert(row)
+            written.append(row)
+        return self._write_response(written, prefer, status=201)
+
+    @staticmethod
+    def _write_response(rows, prefer, status=200):
+        if 'return=representation' in prefer:
+            return httpx.Response(status, json=[dict(r) for r in rows])
+        return httpx.Response(204 if status == 200 else status)
+
+
+def seed_parts(db, count, locations, located_ratio=0.8, parts_per_production=40, parts_per_slip=5, rng=None):
+    """
+    Fills the parts table with `count` parts. Production numbers group ~parts_per_production
+    parts, slips ~parts_per_slip; located parts are spread over the given location codes
+    with a skew, so some cells hold many production numbers as on the real shelves.
+    """
+    rng = rng or random.Random(1)
+    parts = db.tables['parts']
+    productions = max(1, count // parts_per_production)
+    started = datetime(2025, 1, 1)
+    weights = [1.0 / (rank + 1) ** 0.5 for rank in range(len(locations))]
+    for i in range(count):
+        production_no = f"P{rng.randrange(productions):06d}"
+        stamp = (started + timedelta(seconds=i * 30)).isoformat()
+        located = rng.random() < located_ratio
+        parts.insert({
+            'id': i + 1,
+            'production_no': production_no,
+            'parts_name': f"部品{rng.choice(['シャフト', 'ブラケット', 'カバー', 'プレート', 'ギア', 'ボルト'])}{i}",
+            'parts_no': f"PN-{i:07d}",
+            'drawing_no': f"DW-{i % 5000:05d}",
+            'dimensions': f"{rng.randint(10, 500)}x{rng.randint(10, 500)}",
+            'order_slip_no': f"S{i // parts_per_slip:07d}",
+            'order_quantity': rng.randint(1, 20),
+            'delivery_date': (started + timedelta(days=rng.randint(0, 365))).date().isoformat(),
+            'storage_location': rng.choices(locations, weights)[0] if located else None,
+            'created_at': stamp,
+            'updated_at': stamp,
+        })
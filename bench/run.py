@@ -0,0 +1,265 @@
+"""
+Offline benchmark of the hot routes of app.py.
+
+Runs the Flask app in-process against bench/fake_postgrest.py (no Supabase needed),
+seeded with a configurable number of parts spread over the warehouse layout, and
+reports per-scenario latency percentiles and database round trips per request
+(taken from the Server-Timing header the app emits).
+
+    python bench/run.py --parts 20000 --latency-ms 20
+    python bench/run.py --parts 200000 --json after.json --baseline before.json
+    python bench/run.py --parts 20000 --read-replica /tmp/bench-replica.db
+
+With --baseline, exits with status 1 if a scenario's p95 or round trips regressed
+by more than --tolerance compared to the baseline report.
+
+Latencies include the fake's own CPU time (e.g. ILIKE searches scan every row), so
+compare runs made with the same configuration on the same machine. Round trips and
+bytes per request are exact.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import time
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = ('map_north', 'map_south', 'map_small', 'search', 'scan', 'production', 'update_slip', 'move_production_dnd', 'move_batch')
+SERVER_TIMING_DB = re.compile(r'db;dur=([\d.]+);desc="(\d+) calls, (\d+) bytes"')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--parts', type=int, default=10000, help="Number of seeded parts (default: 10000).")
+    parser.add_argument('--latency-ms', type=float, default=20.0, help="Simulated round-trip latency per database request.")
+    parser.add_argument('--iterations', type=int, default=30, help="Requests per scenario.")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help="Comma-separated scenarios to run.")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--read-replica', metavar='PATH', help="Serve reads from a SQLite read replica at PATH (recreated).")
+    parser.add_argument('--json', dest='json_path', help="Write the report to this file.")
+    parser.add_argument('--baseline', help="Compare against a report written by --json.")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed regression against the baseline (0.2 = 20%%).")
+    return parser.parse_args()
+
+
+def load_app(fake):
+    """Imports app.py with a bench configuration and points its PostgREST clients (sync and async) at the fake."""
+    os.environ.setdefault('SECRET_KEY', 'bench')
+    os.environ.setdefault('SUPABASE_URL', 'http://postgrest.bench')
+    os.environ.setdefault('SUPABASE_ANON_KEY', 'bench-anon-key')
+    os.environ.setdefault('SUPABASE_JWT_SECRET', 'bench-jwt-secret-bench-jwt-secret')
+    os.environ.setdefault('AUTH_VERIFY_MODE', 'local')
+    os.environ.setdefault('REQUEST_LOG_ENABLED', 'false')
+    import logging
+    import app as app_module
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+    def create_bench_client():
+        client = app_module.create_postgrest_client()
+        client.session._transport = fake.transport()
+        return client
+
+    def create_bench_async_client():
+        client = app_module.create_async_http_client()
+        client._transport = fake.async_transport()
+        return client
+
+    app_module.postgrest_pool._factory = create_bench_client
+    app_module.postgrest_pool.drain()
+    app_module.concurrent_queries._factory = create_bench_async_client
+    return app_module
+
+
+def login(app_module):
+    """Returns a test client with a session for a locally verified user (no auth round trip)."""
+    import jwt
+    expires = int(time.time()) + 3600
+    token = jwt.encode({'sub': 'bench-user', 'aud': 'authenticated', 'exp': expires, 'email': 'bench@example.com'},
+                       os.environ['SUPABASE_JWT_SECRET'], algorithm='HS256')
+    app_module.verified_user_cache.set(app_module._token_cache_key(token),
+                                       SimpleNamespace(id='bench-user', email='bench@example.com'), expires_at=expires)
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session['user_jwt'] = token
+    return client
+
+
+def build_scenarios(app_module, fake, rng):
+    """Returns scenario name -> function that performs one request and returns the response."""
+    parts = fake.tables['parts']
+    locations = sorted({r['storage_location'] for r in parts.rows.values() if r['storage_location']})
+    production_nos = sorted(parts.indexes['production_no'])
+    unlocated_slips = sorted({r['order_slip_no'] for r in parts.rows.values() if not r['storage_location']})
+    rng.shuffle(unlocated_slips)
+
+    def map_area(area):
+        return lambda client: client.get(f'/map/{area}_area')
+
+    def search(client):
+        # A different term each time so the search cache does not hide the query cost
+        term = rng.choice([rng.choice(production_nos)[:5], f"DW-{rng.randrange(5000):05d}", rng.choice(['シャフト', 'ギア', 'カバー'])])
+        return client.post('/search', data={'search_term': f"{term}{rng.choice(['', ' '])}"})
+
+    def scan(client):
+        # Exact codes as a scanner sends them: order slips, production numbers and part numbers
+        row = parts.rows[rng.choice(list(parts.rows))]
+        return client.get(f"/scan/{row[rng.choice(['order_slip_no', 'production_no', 'parts_no'])]}")
+
+    def production(client):
+        return client.get(f'/production/{rng.choice(production_nos)}')
+
+    def update_slip(client):
+        slip = unlocated_slips.pop() if unlocated_slips else rng.choice(sorted(parts.indexes['order_slip_no']))
+        form = {f"storage_location_{row_id}": rng.choice(locations)
+                for row_id in parts.indexes['order_slip_no'].get(slip, ())}
+        return client.post(f'/update/{slip}', data=form)
+
+    def move_production_dnd(client):
+        location = rng.choice([loc for loc in locations if parts.indexes['storage_location'].get(loc)])
+        row = parts.rows[next(iter(parts.indexes['storage_location'][location]))]
+        target = rng.choice([loc for loc in locations if loc != location])
+        return client.post('/move_production_dnd', json={
+            'production_no': row['production_no'], 'original_location': location, 'new_location': target})
+
+    def move_batch(client):
+        # A reorganised shelf block: ten production numbers, each from its cell to another one
+        moves = {}
+        while len(moves) < 10:
+            location = rng.choice([loc for loc in locations if parts.indexes['storage_location'].get(loc)])
+            row = parts.rows[next(iter(parts.indexes['storage_location'][location]))]
+            moves[(row['production_no'], location)] = rng.choice([loc for loc in locations if loc != location])
+        return client.post('/api/v1/moves/batch', json={'moves': [
+            {'production_no': production_no, 'from_location': location, 'to_location': target}
+            for (production_no, location), target in moves.items()]})
+
+    return {
+        'map_north': map_area('north'),
+        'map_south': map_area('south'),
+        'map_small': map_area('small'),
+        'search': search,
+        'scan': scan,
+        'production': production,
+        'update_slip': update_slip,
+        'move_production_dnd': move_production_dnd,
+        'move_batch': move_batch,
+    }
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run_scenario(client, request_once, iterations):
+    latencies, round_trips, db_bytes, statuses = [], [], [], set()
+    first_ms = None
+    for _ in range(iterations):
+        started = time.perf_counter()
+        response = request_once(client)
+        elapsed = (time.perf_counter() - started) * 1000
+        response.get_data()
+        statuses.add(response.status_code)
+        match = SERVER_TIMING_DB.search(response.headers.get('Server-Timing', ''))
+        if first_ms is None:
+            first_ms = elapsed
+        latencies.append(elapsed)
+        round_trips.append(int(match.group(2)) if match else 0)
+        db_bytes.append(int(match.group(3)) if match else 0)
+    return {
+        'requests': iterations,
+        'first_ms': round(first_ms, 1),
+        'p50_ms': round(percentile(latencies, 0.5), 1),
+        'p95_ms': round(percentile(latencies, 0.95), 1),
+        'max_ms': round(max(latencies), 1),
+        'round_trips_mean': round(statistics.mean(round_trips), 2),
+        'round_trips_max': max(round_trips),
+        'db_kib_mean': round(statistics.mean(db_bytes) / 1024, 1),
+        'statuses': sorted(statuses),
+    }
+
+
+def print_report(report):
+    config = report['config']
+    replica = ', read replica' if config.get('read_replica') else ''
+    print(f"\n{config['parts']} parts, {config['latency_ms']} ms simulated latency{replica}, {config['iterations']} requests per scenario\n")
+    header = f"{'scenario':<22}{'first':>9}{'p50':>9}{'p95':>9}{'max':>9}{'trips':>8}{'trips max':>11}{'db KiB':>9}  status"
+    print(header)
+    print('-' * len(header))
+    for name, result in report['scenarios'].items():
+        print(f"{name:<22}{result['first_ms']:>9}{result['p50_ms']:>9}{result['p95_ms']:>9}{result['max_ms']:>9}"
+              f"{result['round_trips_mean']:>8}{result['round_trips_max']:>11}{result['db_kib_mean']:>9}  "
+              f"{','.join(map(str, result['statuses']))}")
+
+
+def compare(report, baseline, tolerance):
+    """Returns a list of regressions of p95 latency or round trips against a baseline report."""
+    if baseline.get('config') != report['config']:
+        print(f"warning: baseline was measured with {baseline.get('config')}, this run with {report['config']}")
+    regressions = []
+    for name, result in report['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name)
+        if not before:
+            continue
+        for metric in ('p95_ms', 'round_trips_mean'):
+            # Small absolute differences are noise, not regressions
+            if result[metric] > before[metric] * (1 + tolerance) and result[metric] - before[metric] > 1:
+                regressions.append(f"{name}: {metric} {before[metric]} -> {result[metric]}")
+    return regressions
+
+
+def main():
+    args = parse_args()
+    import fake_postgrest
+
+    if args.read_replica:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(args.read_replica + suffix):
+                os.remove(args.read_replica + suffix)
+        os.environ['READ_REPLICA_PATH'] = args.read_replica
+
+    rng = random.Random(args.seed)
+    fake = fake_postgrest.FakePostgrest(latency=args.latency_ms / 1000, rng=random.Random(args.seed))
+    app_module = load_app(fake)
+    locations = [f"{shelf}{slot}" for spec in app_module.WAREHOUSE_LAYOUT.values()
+                 for shelf in spec['shelves'] for slot in spec['slots']]
+    started = time.perf_counter()
+    fake_postgrest.seed_parts(fake, args.parts, locations, rng=random.Random(args.seed))
+    print(f"Seeded {args.parts} parts over {len(locations)} locations in {time.perf_counter() - started:.1f}s")
+
+    client = login(app_module)
+    scenarios = build_scenarios(app_module, fake, rng)
+    selected = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in selected if name not in scenarios]
+    if unknown:
+        sys.exit(f"Unknown scenarios: {', '.join(unknown)} (available: {', '.join(SCENARIOS)})")
+
+    report = {
+        'config': {'parts': args.parts, 'latency_ms': args.latency_ms, 'iterations': args.iterations, 'seed': args.seed,
+                   'read_replica': bool(args.read_replica)},
+        'scenarios': {name: run_scenario(client, scenarios[name], args.iterations) for name in selected},
+    }
+    print_report(report)
+
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
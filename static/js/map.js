@@ -3,88 +3,430 @@ document.addEventListener('DOMContentLoaded', function () {
     const modalTitle = document.getElementById('locationModalLabel');
     const modalBody = document.getElementById('locationModalBody');
 
-    const itemsDataElement = document.getElementById('location-items-data');
     const productNumbersDataElement = document.getElementById('location-product-numbers-data');
 
-    if (!itemsDataElement || !productNumbersDataElement) {
+    if (!productNumbersDataElement) {
         console.error('Error: Data elements not found');
         return;
     }
 
-    const locationItems = JSON.parse(itemsDataElement.textContent);
     const locationProductNumbers = JSON.parse(productNumbersDataElement.textContent);
+    // Items are fetched per cell when its modal is first opened
+    const locationItemsCache = {};
+    // Drag-and-drop moves waiting to be committed as one batch: {production_no, from_location, to_location}.
+    // locationProductNumbers stays the server state; cells show it with these moves applied.
+    const pendingMoves = [];
 
-    // Populate product numbers in cells and add click listeners
-    for (const locationId in locationProductNumbers) {
-        const productNumbers = locationProductNumbers[locationId];
+    function fetchLocationItems(locationId) {
+        if (!locationItemsCache[locationId]) {
+            locationItemsCache[locationId] = fetch(`/map/location/${encodeURIComponent(locationId)}/items`)
+                .then(response => {
+                    if (!response.ok) {
+                        throw new Error(`HTTP ${response.status}`);
+                    }
+                    return response.json();
+                })
+                .then(data => data.items)
+                .catch(error => {
+                    delete locationItemsCache[locationId];
+                    throw error;
+                });
+        }
+        return locationItemsCache[locationId];
+    }
+
+    function isPendingDestination(productionNo, locationId) {
+        return pendingMoves.some(move => move.production_no === productionNo && move.to_location === locationId);
+    }
+
+    function displayedProductNumbers(locationId) {
+        const productionNumbers = new Set(locationProductNumbers[locationId] || []);
+        pendingMoves.forEach(move => {
+            if (move.from_location === locationId) {
+                productionNumbers.delete(move.production_no);
+            }
+            if (move.to_location === locationId) {
+                productionNumbers.add(move.production_no);
+            }
+        });
+        return Array.from(productionNumbers).sort();
+    }
+
+    function createProductionChip(productionNo, locationId) {
+        const chip = document.createElement('span');
+        chip.className = 'production-draggable';
+        if (isPendingDestination(productionNo, locationId)) {
+            chip.classList.add('pending-move');
+        }
+        chip.draggable = true;
+        chip.textContent = productionNo;
+        chip.title = 'ドラッグして別の保管場所へ移動';
+        chip.addEventListener('dragstart', function (event) {
+            event.dataTransfer.setData('application/json', JSON.stringify({ production_no: productionNo, from: locationId }));
+            event.dataTransfer.effectAllowed = 'move';
+        });
+        return chip;
+    }
+
+    function renderCell(locationId) {
         const cell = document.getElementById(locationId);
-        if (cell) {
-            const productNumbersSpan = cell.querySelector('.product-numbers');
-            if (productNumbersSpan) {
-                productNumbersSpan.textContent = productNumbers.join(', ');
+        if (!cell) {
+            return;
+        }
+        const productNumbersSpan = cell.querySelector('.product-numbers');
+        if (productNumbersSpan) {
+            productNumbersSpan.innerHTML = '';
+            displayedProductNumbers(locationId).forEach((productionNo, index) => {
+                if (index > 0) {
+                    productNumbersSpan.appendChild(document.createTextNode(', '));
+                }
+                productNumbersSpan.appendChild(createProductionChip(productionNo, locationId));
+            });
+        }
+    }
+
+    // --- Move Queue ---
+    const moveQueueBar = document.createElement('div');
+    moveQueueBar.className = 'move-queue-bar alert d-none';
+    moveQueueBar.setAttribute('role', 'status');
+    const moveQueueText = document.createElement('div');
+    const moveQueueButtons = document.createElement('div');
+    moveQueueButtons.className = 'move-queue-buttons';
+    const cancelMovesButton = document.createElement('button');
+    cancelMovesButton.type = 'button';
+    cancelMovesButton.className = 'btn btn-secondary btn-sm';
+    cancelMovesButton.textContent = '取消';
+    const commitMovesButton = document.createElement('button');
+    commitMovesButton.type = 'button';
+    commitMovesButton.className = 'btn btn-primary btn-sm';
+    commitMovesButton.innerHTML = '<i class="bi bi-check2-circle"></i> 移動を確定';
+    moveQueueButtons.appendChild(cancelMovesButton);
+    moveQueueButtons.appendChild(commitMovesButton);
+    moveQueueBar.appendChild(moveQueueText);
+    moveQueueBar.appendChild(moveQueueButtons);
+    (document.querySelector('.inventory-map-container') || document.body).prepend(moveQueueBar);
+
+    function showMoveQueue(alertClass, message, details) {
+        moveQueueBar.className = `move-queue-bar alert ${alertClass}`;
+        moveQueueText.textContent = message;
+        if (details && details.length > 0) {
+            const list = document.createElement('ul');
+            list.className = 'mb-0 small';
+            details.forEach(detail => {
+                const listItem = document.createElement('li');
+                listItem.textContent = detail;
+                list.appendChild(listItem);
+            });
+            moveQueueText.appendChild(list);
+        }
+        moveQueueButtons.classList.toggle('d-none', pendingMoves.length === 0);
+    }
+
+    function renderMoveQueue() {
+        if (pendingMoves.length === 0) {
+            moveQueueBar.classList.add('d-none');
+            return;
+        }
+        showMoveQueue('alert-warning', `未確定の移動が ${pendingMoves.length} 件あります。`,
+            pendingMoves.map(move => `製番 ${move.production_no}: ${move.from_location} → ${move.to_location}`));
+    }
+
+    // Queues moving a production number out of a cell as the cell is currently shown
+    function queueMove(productionNo, fromLocation, toLocation) {
+        if (fromLocation === toLocation) {
+            return;
+        }
+        // Parts already queued to arrive in the cell move on to the new target instead
+        pendingMoves.forEach(move => {
+            if (move.production_no === productionNo && move.to_location === fromLocation) {
+                move.to_location = toLocation;
             }
+        });
+        const alreadyQueued = pendingMoves.some(move => move.production_no === productionNo && move.from_location === fromLocation);
+        if ((locationProductNumbers[fromLocation] || []).includes(productionNo) && !alreadyQueued) {
+            pendingMoves.push({ production_no: productionNo, from_location: fromLocation, to_location: toLocation });
+        }
+        // A move redirected back to where it started is no move at all
+        for (let i = pendingMoves.length - 1; i >= 0; i--) {
+            if (pendingMoves[i].from_location === pendingMoves[i].to_location) {
+                pendingMoves.splice(i, 1);
+            }
+        }
+        renderCell(fromLocation);
+        renderCell(toLocation);
+        renderMoveQueue();
+    }
 
-            // Click event for modal
-            cell.addEventListener('click', function () {
-                const itemsInLocation = locationItems[locationId];
-                if (itemsInLocation && itemsInLocation.length > 0) {
-                    modalTitle.textContent = `保管場所: ${locationId}`;
-                    modalBody.innerHTML = '';
-
-                    const groupedByProduction = {};
-                    itemsInLocation.forEach(item => {
-                        const prodNo = item.production_no;
-                        if (!groupedByProduction[prodNo]) {
-                            groupedByProduction[prodNo] = { production_no: prodNo, items: [] };
-                        }
-                        groupedByProduction[prodNo].items.push(item);
-                    });
-
-                    const container = document.createElement('div');
-                    container.className = 'production-groups';
-
-                    for (const prodNo in groupedByProduction) {
-                        const group = groupedByProduction[prodNo];
-
-                        const groupDiv = document.createElement('div');
-                        groupDiv.className = 'd-flex justify-content-between align-items-center mb-2';
-
-                        const prodNoSpan = document.createElement('span');
-                        prodNoSpan.className = 'fw-bold fs-5';
-                        prodNoSpan.textContent = `製番: ${prodNo}`;
-
-                        // --- Button Group ---
-                        const buttonGroup = document.createElement('div');
-                        buttonGroup.className = 'btn-group';
-                        buttonGroup.setAttribute('role', 'group');
-
-                        // Details Button (Location Specific)
-                        const detailsButton = document.createElement('a');
-                        detailsButton.href = `/production/${prodNo}/location/${locationId}`;
-                        detailsButton.target = '_blank';
-                        detailsButton.className = 'btn btn-info btn-sm';
-                        detailsButton.innerHTML = '<i class="bi bi-info-circle"></i> 詳細';
-                        detailsButton.title = 'この場所の部品詳細を開く';
-
-                        // Move Button
-                        const moveButton = document.createElement('a');
-                        moveButton.href = `/move/location/${locationId}/production/${prodNo}`;
-                        moveButton.className = 'btn btn-warning btn-sm';
-                        moveButton.innerHTML = '<i class="bi bi-arrows-move"></i> 移動';
-                        moveButton.title = 'この製番をまとめて移動';
-
-                        buttonGroup.appendChild(detailsButton);
-                        buttonGroup.appendChild(moveButton);
-
-                        groupDiv.appendChild(prodNoSpan);
-                        groupDiv.appendChild(buttonGroup);
-                        container.appendChild(groupDiv);
-                    }
+    function clearMoveQueue() {
+        const touched = new Set();
+        pendingMoves.forEach(move => {
+            touched.add(move.from_location);
+            touched.add(move.to_location);
+        });
+        pendingMoves.length = 0;
+        touched.forEach(renderCell);
+        renderMoveQueue();
+    }
 
-                    modalBody.appendChild(container);
-                    locationModal.show();
+    async function commitMoveQueue() {
+        const moves = pendingMoves.map(move => Object.assign({}, move));
+        commitMovesButton.disabled = true;
+        try {
+            const response = await fetch('/api/v1/moves/batch', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ moves: moves })
+            });
+            const data = await response.json();
+            if (!response.ok || !data.success) {
+                showMoveQueue('alert-danger', data.message || `HTTP ${response.status}`, data.errors);
+                return;
+            }
+            // Apply the committed moves to the server state before dropping them from the queue
+            moves.forEach(move => {
+                const remaining = (locationProductNumbers[move.from_location] || []).filter(prodNo => prodNo !== move.production_no);
+                if (remaining.length > 0) {
+                    locationProductNumbers[move.from_location] = remaining;
+                } else {
+                    delete locationProductNumbers[move.from_location];
                 }
+                const arrived = new Set(locationProductNumbers[move.to_location] || []);
+                arrived.add(move.production_no);
+                locationProductNumbers[move.to_location] = Array.from(arrived).sort();
+                delete locationItemsCache[move.from_location];
+                delete locationItemsCache[move.to_location];
             });
+            clearMoveQueue();
+            showMoveQueue('alert-success', data.message);
+            setTimeout(renderMoveQueue, 3000);
+        } catch (error) {
+            console.error('Error committing moves:', error);
+            showMoveQueue('alert-danger', '移動の確定中にエラーが発生しました。');
+        } finally {
+            commitMovesButton.disabled = false;
+        }
+    }
+
+    cancelMovesButton.addEventListener('click', clearMoveQueue);
+    commitMovesButton.addEventListener('click', commitMoveQueue);
+    window.addEventListener('beforeunload', function (event) {
+        if (pendingMoves.length > 0) {
+            event.preventDefault();
+            event.returnValue = '';
+        }
+    });
+
+    // Patches the cells changed by a move instead of reloading the page
+    function applyLocationChange(change) {
+        [change.from, change.to].forEach(locationId => {
+            if (locationId) {
+                delete locationItemsCache[locationId];
+            }
+        });
+
+        if (change.cells) {
+            for (const locationId in change.cells) {
+                if (change.cells[locationId].length > 0) {
+                    locationProductNumbers[locationId] = change.cells[locationId];
+                } else {
+                    delete locationProductNumbers[locationId];
+                }
+                renderCell(locationId);
+            }
+            return;
         }
+
+        // The publishing worker had no snapshot to describe the cells; fetch them
+        fetch('/api/v1/locations')
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error(`HTTP ${response.status}`);
+                }
+                return response.json();
+            })
+            .then(data => {
+                [change.from, change.to].forEach(locationId => {
+                    if (!locationId) {
+                        return;
+                    }
+                    const location = data.locations[locationId];
+                    if (location) {
+                        locationProductNumbers[locationId] = location.production_numbers;
+                    } else {
+                        delete locationProductNumbers[locationId];
+                    }
+                    renderCell(locationId);
+                });
+            })
+            .catch(error => console.error('Error fetching locations:', error));
+    }
+
+    // Without a live stream (the server caps them per worker) the map polls for changes instead.
+    // The ETag makes a poll of an unchanged map a 304 without a body.
+    const LOCATION_POLL_INTERVAL = 10000;
+    const LOCATION_STREAM_RETRY_DELAY = 60000;
+    let locationsEtag = null;
+
+    function pollLocations() {
+        const headers = locationsEtag ? { 'If-None-Match': locationsEtag } : {};
+        return fetch('/api/v1/locations', { headers: headers, cache: 'no-store' })
+            .then(response => {
+                if (response.status === 304) {
+                    return null;
+                }
+                if (!response.ok) {
+                    throw new Error(`HTTP ${response.status}`);
+                }
+                locationsEtag = response.headers.get('ETag');
+                return response.json();
+            })
+            .then(data => {
+                if (!data) {
+                    return;
+                }
+                document.querySelectorAll('.grid-cell').forEach(cell => {
+                    const location = data.locations[cell.id];
+                    const productionNumbers = location ? location.production_numbers : [];
+                    if (productionNumbers.join('\n') === (locationProductNumbers[cell.id] || []).join('\n')) {
+                        return;
+                    }
+                    if (productionNumbers.length > 0) {
+                        locationProductNumbers[cell.id] = productionNumbers;
+                    } else {
+                        delete locationProductNumbers[cell.id];
+                    }
+                    delete locationItemsCache[cell.id];
+                    renderCell(cell.id);
+                });
+            })
+            .catch(error => console.error('Error polling locations:', error));
+    }
+
+    function connectLocationEvents() {
+        const locationEvents = new EventSource('/events/locations');
+        locationEvents.addEventListener('location-change', function (event) {
+            applyLocationChange(JSON.parse(event.data));
+        });
+        locationEvents.addEventListener('error', function () {
+            // Browsers reconnect dropped streams themselves, but not refused ones (e.g. 503)
+            if (locationEvents.readyState !== EventSource.CLOSED) {
+                return;
+            }
+            pollLocations();
+            const pollTimer = setInterval(pollLocations, LOCATION_POLL_INTERVAL);
+            setTimeout(() => {
+                clearInterval(pollTimer);
+                connectLocationEvents();
+            }, LOCATION_STREAM_RETRY_DELAY);
+        });
+    }
+
+    if (window.EventSource) {
+        connectLocationEvents();
     }
+
+    // Populate product numbers in cells and add click listeners.
+    // Every cell gets a listener because a move can fill an empty cell later.
+    document.querySelectorAll('.grid-cell').forEach(cell => {
+        const locationId = cell.id;
+        renderCell(locationId);
+        // Drop target for production numbers dragged from other cells
+        cell.addEventListener('dragover', function (event) {
+            if (event.dataTransfer.types.includes('application/json')) {
+                event.preventDefault();
+                event.dataTransfer.dropEffect = 'move';
+                cell.classList.add('drop-target');
+            }
+        });
+        cell.addEventListener('dragleave', function () {
+            cell.classList.remove('drop-target');
+        });
+        cell.addEventListener('drop', function (event) {
+            event.preventDefault();
+            cell.classList.remove('drop-target');
+            let dragged;
+            try {
+                dragged = JSON.parse(event.dataTransfer.getData('application/json'));
+            } catch (error) {
+                return;
+            }
+            queueMove(dragged.production_no, dragged.from, locationId);
+        });
+        // Click event for modal
+        cell.addEventListener('click', async function () {
+            if (!locationProductNumbers[locationId]) {
+                return;
+            }
+            let itemsInLocation;
+            try {
+                itemsInLocation = await fetchLocationItems(locationId);
+            } catch (error) {
+                console.error(`Error fetching items for ${locationId}:`, error);
+                return;
+            }
+            if (itemsInLocation && itemsInLocation.length > 0) {
+                modalTitle.textContent = `保管場所: ${locationId}`;
+                modalBody.innerHTML = '';
+
+                const groupedByProduction = {};
+                itemsInLocation.forEach(item => {
+                    const prodNo = item.production_no;
+                    if (!groupedByProduction[prodNo]) {
+                        groupedByProduction[prodNo] = { production_no: prodNo, items: [] };
+                    }
+                    groupedByProduction[prodNo].items.push(item);
+                });
+
+                const container = document.createElement('div');
+                container.className = 'production-groups';
+
+                const exportLink = document.createElement('a');
+                exportLink.href = `/export/location/${encodeURIComponent(locationId)}?format=excel`;
+                exportLink.className = 'btn btn-outline-success btn-sm mb-3';
+                exportLink.innerHTML = '<i class="bi bi-download"></i> この場所の部品をCSV出力';
+                container.appendChild(exportLink);
+
+                for (const prodNo in groupedByProduction) {
+                    const group = groupedByProduction[prodNo];
+
+                    const groupDiv = document.createElement('div');
+                    groupDiv.className = 'd-flex justify-content-between align-items-center mb-2';
+
+                    const prodNoSpan = document.createElement('span');
+                    prodNoSpan.className = 'fw-bold fs-5';
+                    prodNoSpan.textContent = `製番: ${prodNo} (${group.items.length}点)`;
+
+                    // --- Button Group ---
+                    const buttonGroup = document.createElement('div');
+                    buttonGroup.className = 'btn-group';
+                    buttonGroup.setAttribute('role', 'group');
+
+                    // Details Button (Location Specific)
+                    const detailsButton = document.createElement('a');
+                    detailsButton.href = `/production/${prodNo}/location/${locationId}`;
+                    detailsButton.target = '_blank';
+                    detailsButton.className = 'btn btn-info btn-sm';
+                    detailsButton.innerHTML = '<i class="bi bi-info-circle"></i> 詳細';
+                    detailsButton.title = 'この場所の部品詳細を開く';
+
+                    // Move Button
+                    const moveButton = document.createElement('a');
+                    moveButton.href = `/move/location/${locationId}/production/${prodNo}`;
+                    moveButton.className = 'btn btn-warning btn-sm';
+                    moveButton.innerHTML = '<i class="bi bi-arrows-move"></i> 移動';
+                    moveButton.title = 'この製番をまとめて移動';
+
+                    buttonGroup.appendChild(detailsButton);
+                    buttonGroup.appendChild(moveButton);
+
+                    groupDiv.appendChild(prodNoSpan);
+                    groupDiv.appendChild(buttonGroup);
+                    container.appendChild(groupDiv);
+                }
+
+                modalBody.appendChild(container);
+                locationModal.show();
+            }
+        });
+    });
 });
\ No newline at end of file
@@ -0,0 +1,50 @@
+-- Trigram search over the columns matched by search_parts() in app.py.
+-- Used when the app runs with SEARCH_MODE=trgm; the ILIKE search remains the fallback.
+
+create extension if not exists pg_trgm;
+
+-- Single lower-cased search column covering the five searched fields.
+-- (concat_ws is only STABLE, so the columns are joined with || to keep the expression IMMUTABLE.)
+alter table public.parts
+    add column if not exists search_text text
+    generated always as (
+        lower(
+            coalesce(production_no, '') || ' ' ||
+            coalesce(parts_no, '') || ' ' ||
+            coalesce(parts_name, '') || ' ' ||
+            coalesce(drawing_no, '') || ' ' ||
+            coalesce(order_slip_no, '')
+        )
+    ) stored;
+
+create index if not exists parts_search_text_trgm_idx
+    on public.parts using gin (search_text gin_trgm_ops);
+
+-- Substring search served by the trigram index, ranked by match quality:
+-- exact code matches first, then by trigram word similarity, then newest first.
+create or replace function public.search_parts_ranked(search_term text, max_rows integer default 200)
+returns setof public.parts
+language sql
+stable
+as $$
+    with term as (
+        select '%' || replace(replace(replace(search_term, '\', '\\'), '%', '\%'), '_', '\_') || '%' as pattern
+    )
+    select p.*
+    from public.parts p, term
+    where p.search_text like lower(term.pattern)
+      -- search_text joins the columns with spaces, so a term could match across two of them;
+      -- the index narrows the rows, and each column is rechecked as the ILIKE search does
+      and (p.production_no ilike term.pattern
+           or p.parts_no ilike term.pattern
+           or p.parts_name ilike term.pattern
+           or p.drawing_no ilike term.pattern
+           or p.order_slip_no ilike term.pattern)
+    order by
+        (p.production_no = search_term or p.order_slip_no = search_term or p.parts_no = search_term) desc,
+        word_similarity(lower(search_term), p.search_text) desc,
+        p.created_at desc
+    limit max_rows;
+$$;
+
+grant execute on function public.search_parts_ranked(text, integer) to authenticated;
@@ -0,0 +1,19 @@
+-- Per-production aggregate used by the production detail pages in app.py.
+-- One row per (production_no, order_slip_no, storage_location) with its part count and
+-- last change time; the app derives slip counts, distinct locations and per-location
+-- counts from these few rows instead of fetching every part of the production number.
+
+create index if not exists parts_production_no_idx on public.parts (production_no);
+
+create or replace view public.parts_production_summary
+with (security_invoker = true) as
+select
+    production_no,
+    order_slip_no,
+    storage_location,
+    count(*) as part_count,
+    max(updated_at) as last_moved_at
+from public.parts
+group by production_no, order_slip_no, storage_location;
+
+grant select on public.parts_production_summary to authenticated;
@@ -0,0 +1,55 @@
+-- Atomic move of a production number's parts, used by the move routes in app.py.
+-- Updates the parts and writes one work_history row per part in a single transaction,
+-- and returns the moved rows with their previous location, so a move is one round trip
+-- whatever its size and can never leave parts moved without history.
+--
+-- p_from_location null moves the parts wherever they are; the history details read
+-- '<p_details_prefix>により、保管場所が '<from>' から '<to>' に変更されました。'
+-- p_updated_at is the app's clock, which every other writer of parts.updated_at uses too,
+-- so the incremental refreshes ordering rows by updated_at see a single clock.
+
+drop function if exists public.move_production_parts(text, text, text, text, text);
+
+create or replace function public.move_production_parts(
+    p_production_no text,
+    p_from_location text,
+    p_to_location text,
+    p_action text,
+    p_details_prefix text,
+    p_updated_at timestamptz default now()
+)
+returns setof jsonb
+language sql
+volatile
+security invoker
+set search_path = public
+as $$
+    with targets as (
+        select id, storage_location
+        from public.parts
+        where production_no = p_production_no
+          and (p_from_location is null or storage_location = p_from_location)
+        for update
+    ),
+    moved as (
+        update public.parts p
+        set storage_location = p_to_location,
+            updated_at = p_updated_at
+        from targets t
+        where p.id = t.id
+        returning p.*
+    ),
+    history as (
+        insert into public.work_history (item_id, production_no, parts_name, action, details)
+        select m.id, m.production_no, m.parts_name, p_action,
+               format('%sにより、保管場所が ''%s'' から ''%s'' に変更されました。',
+                      p_details_prefix, t.storage_location, p_to_location)
+        from moved m
+        join targets t on t.id = m.id
+    )
+    select to_jsonb(m) || jsonb_build_object('previous_storage_location', t.storage_location)
+    from moved m
+    join targets t on t.id = m.id;
+$$;
+
+grant execute on function public.move_production_parts(text, text, text, text, text, timestamptz) to authenticated;
@@ -0,0 +1,41 @@
+-- Deleted parts, used by the read replica in app.py (READ_REPLICA_PATH) to remove rows
+-- deleted in Supabase from its local copy. seq orders the deletions, so the replica can
+-- resume after the last one it applied even when many rows share a deleted_at.
+
+create table if not exists public.parts_tombstones (
+    seq bigint generated always as identity primary key,
+    id text not null,
+    deleted_at timestamptz not null default now()
+);
+
+alter table public.parts_tombstones enable row level security;
+
+drop policy if exists "Authenticated users can read tombstones" on public.parts_tombstones;
+create policy "Authenticated users can read tombstones"
+    on public.parts_tombstones for select
+    to authenticated
+    using (true);
+
+grant select on public.parts_tombstones to authenticated;
+
+-- Statement-level so a bulk delete records its rows with one insert.
+-- security definer: users who may delete parts need no insert grant on the tombstones.
+create or replace function public.record_parts_tombstones()
+returns trigger
+language plpgsql
+security definer
+set search_path = public
+as $$
+begin
+    insert into public.parts_tombstones (id)
+    select deleted.id::text from deleted_parts deleted;
+    return null;
+end;
+$$;
+
+drop trigger if exists parts_record_tombstones on public.parts;
+create trigger parts_record_tombstones
+    after delete on public.parts
+    referencing old table as deleted_parts
+    for each statement
+    execute function public.record_parts_tombstones();
@@ -0,0 +1,16 @@
+-- Publishes changes of parts through Supabase Realtime, consumed by the change feed in
+-- app.py (CHANGE_FEED_MODE=realtime) to keep the caches of all workers coherent.
+-- DELETE events carry only the primary key with the default replica identity, which is
+-- all the feed needs.
+
+do $$
+begin
+    if exists (select 1 from pg_publication where pubname = 'supabase_realtime')
+       and not exists (
+           select 1 from pg_publication_tables
+           where pubname = 'supabase_realtime' and schemaname = 'public' and tablename = 'parts'
+       ) then
+        alter publication supabase_realtime add table public.parts;
+    end if;
+end
+$$;
@@ -0,0 +1,48 @@
+-- Who made each change, and indexes for the work history pages in app.py: the timelines
+-- on the part and production pages and the /history browser. Every query of those pages
+-- filters on at most one column and reads newest first by (created_at, id), paginating
+-- with a keyset on the same pair, so each filter gets a (column, created_at, id) index
+-- and a page costs an index range scan however old the rows it shows.
+
+alter table public.work_history
+    add column if not exists user_id uuid,
+    add column if not exists user_email text;
+
+-- Filled from the JWT of the request that writes the row (including rows written by the
+-- move_production_parts RPC), so the app does not send them and clients cannot forge them.
+-- Rows written without a user JWT (e.g. by the service role) keep the values given.
+create or replace function public.set_work_history_user()
+returns trigger
+language plpgsql
+set search_path = public
+as $$
+begin
+    new.user_id := coalesce(auth.uid(), new.user_id);
+    new.user_email := coalesce(auth.jwt() ->> 'email', new.user_email);
+    return new;
+end;
+$$;
+
+drop trigger if exists set_work_history_user on public.work_history;
+create trigger set_work_history_user
+    before insert on public.work_history
+    for each row execute function public.set_work_history_user();
+
+create index if not exists work_history_created_at_idx
+    on public.work_history (created_at desc, id desc);
+create index if not exists work_history_item_id_created_at_idx
+    on public.work_history (item_id, created_at desc, id desc);
+create index if not exists work_history_production_no_created_at_idx
+    on public.work_history (production_no, created_at desc, id desc);
+create index if not exists work_history_user_email_created_at_idx
+    on public.work_history (user_email, created_at desc, id desc);
+create index if not exists work_history_action_created_at_idx
+    on public.work_history (action, created_at desc, id desc);
+
+drop policy if exists "Authenticated users can read work history" on public.work_history;
+create policy "Authenticated users can read work history"
+    on public.work_history for select
+    to authenticated
+    using (true);
+
+grant select on public.work_history to authenticated;
@@ -0,0 +1,7 @@
+-- Exact-match lookups of scanned codes (/scan and /api/v1/scan in app.py) try order_slip_no,
+-- production_no and parts_no. production_no is indexed by parts_production_no_idx
+-- (20261018000200_parts_production_summary.sql); these cover the other two.
+-- order_slip_no also serves the update_slip page, which selects a slip's parts by it.
+
+create index if not exists parts_order_slip_no_idx on public.parts (order_slip_no);
+create index if not exists parts_parts_no_idx on public.parts (parts_no);
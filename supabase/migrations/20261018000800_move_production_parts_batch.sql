@@ -0,0 +1,83 @@
+-- Batch move of several production numbers between locations, used by /api/v1/moves/batch
+-- in app.py (e.g. a queue of drag-and-drops on the map). Moves the parts and writes their
+-- work_history rows in a single transaction and returns the moved rows with their previous
+-- location, like move_production_parts.
+--
+-- p_moves is a JSON array of {"production_no", "from_location", "to_location"}. Every
+-- operation moves the parts that were at its from_location when the batch started, so the
+-- result does not depend on the order of the operations. If any operation finds no parts,
+-- nothing is moved and the function raises P0002 with the JSON array of those operations
+-- as its detail. The history details read
+-- '<p_details_format with {} replaced by the production number>により、保管場所が '<from>' から '<to>' に変更されました。'
+-- p_updated_at is the app's clock, as in move_production_parts.
+
+drop function if exists public.move_production_parts_batch(jsonb, text, text);
+
+create or replace function public.move_production_parts_batch(
+    p_moves jsonb,
+    p_action text,
+    p_details_format text,
+    p_updated_at timestamptz default now()
+)
+returns setof jsonb
+language plpgsql
+volatile
+security invoker
+set search_path = public
+as $$
+declare
+    v_moved jsonb;
+    v_missing jsonb;
+begin
+    with ops as (
+        select distinct on (production_no, from_location) production_no, from_location, to_location
+        from jsonb_to_recordset(p_moves) as m(production_no text, from_location text, to_location text)
+        where from_location is distinct from to_location
+    ),
+    targets as (
+        select p.id, p.storage_location, o.to_location
+        from public.parts p
+        join ops o on p.production_no = o.production_no and p.storage_location = o.from_location
+        for update of p
+    ),
+    moved as (
+        update public.parts p
+        set storage_location = t.to_location,
+            updated_at = p_updated_at
+        from targets t
+        where p.id = t.id
+        returning p.*
+    ),
+    history as (
+        insert into public.work_history (item_id, production_no, parts_name, action, details)
+        select m.id, m.production_no, m.parts_name, p_action,
+               format('%sにより、保管場所が ''%s'' から ''%s'' に変更されました。',
+                      replace(p_details_format, '{}', m.production_no), t.storage_location, m.storage_location)
+        from moved m
+        join targets t on t.id = m.id
+    )
+    select coalesce(jsonb_agg(to_jsonb(m) || jsonb_build_object('previous_storage_location', t.storage_location)), '[]'::jsonb)
+    into v_moved
+    from moved m
+    join targets t on t.id = m.id;
+
+    select jsonb_agg(o)
+    into v_missing
+    from jsonb_to_recordset(p_moves) as o(production_no text, from_location text, to_location text)
+    where not exists (
+        select 1
+        from jsonb_array_elements(v_moved) r
+        where r ->> 'production_no' = o.production_no
+          and r ->> 'previous_storage_location' = o.from_location
+    );
+
+    if v_missing is not null then
+        raise exception 'Nothing to move for % operation(s)', jsonb_array_length(v_missing)
+            using errcode = 'P0002', detail = v_missing::text;
+    end if;
+
+    return query select jsonb_array_elements(v_moved);
+end;
+$$;
+
+grant execute on function public.move_production_parts_batch(jsonb, text, text, timestamptz) to authenticated;
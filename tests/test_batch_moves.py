@@ -0,0 +1,84 @@
+"""Validation and all-or-nothing application of /api/v1/moves/batch."""
+import pytest
+
+
+def move(production_no='P1', from_location='2A', to_location='3B'):
+    return {'production_no': production_no, 'from_location': from_location, 'to_location': to_location}
+
+
+def test_valid_batch_is_normalized(app_module):
+    moves, errors = app_module.validate_batch_moves({'moves': [
+        {'production_no': ' P1 ', 'from_location': '2A', 'to_location': '3B '},
+        {'production_no': 100, 'from_location': '2A', 'to_location': '4C'},
+    ]})
+    assert errors == []
+    assert moves == [move(), move('100', '2A', '4C')]
+
+
+@pytest.mark.parametrize('payload', [None, [], {}, {'moves': []}, {'moves': 'x'}])
+def test_missing_moves(app_module, payload):
+    moves, errors = app_module.validate_batch_moves(payload)
+    assert moves == [] and len(errors) == 1
+
+
+def test_batch_size_limit(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'move_batch_max_size', 2)
+    moves, errors = app_module.validate_batch_moves({'moves': [move(str(n)) for n in range(3)]})
+    assert moves == [] and len(errors) == 1
+
+
+def test_every_invalid_operation_is_reported(app_module):
+    moves, errors = app_module.validate_batch_moves({'moves': [
+        move(),
+        move(to_location=''),
+        'not an object',
+        move('P2', '5A', '5A'),
+        move(to_location='9Z'),  # same production and from_location as the first
+        move('P2'),
+    ]})
+    assert moves == [move(), move('P2')]
+    assert [error.split(' ')[0] for error in errors] == ['2', '3', '4', '5']
+
+
+def seed_batch(fake):
+    parts = fake.tables['parts']
+    for row_id, (production_no, location) in enumerate([('P1', '2A'), ('P1', '2A'), ('P1', '4C'), ('P2', '3B')], start=1):
+        parts.insert({'id': row_id, 'production_no': production_no, 'parts_name': f'part {row_id}',
+                      'storage_location': location, 'created_at': '2025-01-01T00:00:00', 'updated_at': '2025-01-01T00:00:00'})
+    return parts
+
+
+def test_batch_moves_every_operation(client, fake):
+    parts = seed_batch(fake)
+    response = client.post('/api/v1/moves/batch', json={'moves': [move('P1', '2A', '3B'), move('P2', '3B', '2A')]})
+    assert response.status_code == 200
+    assert [m['moved_count'] for m in response.get_json()['moves']] == [2, 1]
+    assert [parts.rows[row_id]['storage_location'] for row_id in (1, 2, 3, 4)] == ['3B', '3B', '4C', '2A']
+    assert len(fake.tables['work_history'].rows) == 3
+
+
+def test_batch_with_a_missing_operation_moves_nothing(client, fake):
+    parts = seed_batch(fake)
+    response = client.post('/api/v1/moves/batch', json={'moves': [move('P1', '2A', '3B'), move('P2', '9Z', '2A')]})
+    assert response.status_code == 409
+    assert "'9Z'" in response.get_json()['errors'][0]
+    assert [parts.rows[row_id]['storage_location'] for row_id in (1, 2, 3, 4)] == ['2A', '2A', '4C', '3B']
+    assert not fake.tables['work_history'].rows
+
+
+def test_invalid_batch_is_refused_before_the_database(client, fake):
+    response = client.post('/api/v1/moves/batch', json={'moves': [move(to_location='2A')]})
+    assert response.status_code == 400
+    assert fake.round_trips == 0
+
+
+def test_batch_without_the_rpc_is_refused(client, fake, app_module, monkeypatch):
+    seed_batch(fake)
+    del fake.rpcs['move_production_parts_batch']
+    monkeypatch.setattr(app_module, 'missing_rpcs', {})
+    response = client.post('/api/v1/moves/batch', json={'moves': [move()]})
+    assert response.status_code == 503
+    # The missing function is remembered, so the next batch does not ask again
+    round_trips = fake.round_trips
+    assert client.post('/api/v1/moves/batch', json={'moves': [move()]}).status_code == 503
+    assert fake.round_trips == round_trips
@@ -0,0 +1,133 @@
+"""
+The file-backed location event broker shared by the workers of a host. The tail thread is
+not started; the tests call _tail() themselves, as the thread does on every poll.
+"""
+import os
+import queue
+
+import pytest
+
+
+class Worker:
+    """One worker's broker and its tail state."""
+
+    def __init__(self, app_module, path, max_bytes=0):
+        self.broker = app_module.FileTailBroker(str(path), poll_interval=0, max_bytes=max_bytes)
+        self.broker._thread.ensure_started = lambda before_start=None: False
+        self.file, self.position = None, 0
+        self.events = self.broker.subscribe()
+
+    def poll(self):
+        self.file, self.position = self.broker._tail(self.file, self.position)
+        received = []
+        while True:
+            try:
+                received.append(self.events.get_nowait())
+            except queue.Empty:
+                return received
+
+
+@pytest.fixture
+def path(tmp_path):
+    return tmp_path / 'location-events.jsonl'
+
+
+@pytest.fixture
+def rotations(monkeypatch):
+    """Counts the replacements of the events file (inode numbers alone may be reused)."""
+    count = [0]
+    replace = os.replace
+
+    def counting_replace(source, target):
+        count[0] += 1
+        replace(source, target)
+
+    monkeypatch.setattr(os, 'replace', counting_replace)
+    return count
+
+
+def test_workers_see_each_others_events_with_the_same_ids(app_module, path):
+    first, second = Worker(app_module, path), Worker(app_module, path)
+    first.broker.publish({'n': 1})
+    second.broker.publish_all([{'n': 2}, {'n': 3}])
+    received = first.poll()
+    assert [event for _, event in received] == [{'n': 1}, {'n': 2}, {'n': 3}]
+    assert second.poll() == received
+    # An event's id is one past the offset of its line
+    assert [event_id for event_id, _ in received] == [1, 10, 19]
+
+
+def test_partial_and_malformed_lines(app_module, path):
+    worker = Worker(app_module, path)
+    with open(path, 'ab') as f:
+        f.write(b'not json\n{"n": 1')
+    assert worker.poll() == []
+    with open(path, 'ab') as f:
+        f.write(b'}\n')
+    assert [event for _, event in worker.poll()] == [{'n': 1}]
+
+
+def test_rotation_keeps_ids_increasing_and_loses_nothing(app_module, path, rotations):
+    # A rotation follows at least max_bytes - 4096 bytes (SEEK_DATA finds the data block, not the byte)
+    # after the previous one, more than the ten events between polls, as a reader must not miss a file
+    writer, reader = Worker(app_module, path, max_bytes=8192), Worker(app_module, path)
+    received = []
+    for n in range(300):
+        writer.broker.publish({'n': n, 'pad': 'x' * 200})
+        if n % 10 == 9:
+            received += reader.poll()
+    received += reader.poll()
+
+    assert rotations[0] > 5
+    assert [event['n'] for _, event in received] == list(range(300))
+    ids = [event_id for event_id, _ in received]
+    assert ids == sorted(set(ids))
+    # The replaced file keeps its apparent size but only the events after the hole take space
+    stat = os.stat(path)
+    assert stat.st_size >= ids[-1] and stat.st_blocks * 512 < stat.st_size
+    # A reconnecting stream replays what it missed across a rotation
+    replay = reader.broker.subscribe(ids[-20])
+    assert [replay.get_nowait()[0] for _ in range(replay.qsize())] == ids[-19:]
+
+
+def test_reader_starting_after_a_rotation_skips_the_hole(app_module, path, rotations):
+    writer = Worker(app_module, path, max_bytes=5000)
+    n = 0
+    while not rotations[0]:
+        writer.broker.publish({'n': n, 'pad': 'x' * 200})
+        n += 1
+    # Fewer bytes than a block past the hole, so these do not rotate the file again
+    for n in range(n, n + 3):
+        writer.broker.publish({'n': n, 'pad': 'x' * 200})
+    assert rotations[0] == 1
+    # A worker started later reads the file from the start, hole included
+    late = Worker(app_module, path)
+    received = late.poll()
+    assert [event['n'] for _, event in received] == [n - 2, n - 1, n]
+    assert [event_id for event_id, _ in received] == [event_id for event_id, _ in writer.poll()][-len(received):]
+
+
+def test_truncated_file_is_read_from_the_start(app_module, path):
+    worker = Worker(app_module, path)
+    worker.broker.publish_all([{'n': n} for n in range(5)])
+    assert len(worker.poll()) == 5
+    # e.g. an operator emptying the file in place
+    with open(path, 'r+b') as f:
+        f.truncate(0)
+    worker.broker.publish({'n': 'after'})
+    assert [event for _, event in worker.poll()] == [{'n': 'after'}]
+
+
+def test_replaced_file_is_drained_before_switching(app_module, path):
+    worker = Worker(app_module, path)
+    worker.broker.publish({'n': 1})
+    worker.poll()
+    # Another worker appends a last event and replaces the file before this one polls again
+    worker.broker.publish({'n': 2})
+    size = os.path.getsize(path)
+    os.replace(str(path), str(path) + '.old')
+    with open(path, 'wb') as f:
+        f.truncate(size)
+    worker.broker.publish({'n': 3})
+    assert [event for _, event in worker.poll()] == [{'n': 2}]
+    assert [event for _, event in worker.poll()] == [{'n': 3}]
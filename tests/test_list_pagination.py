@@ -0,0 +1,100 @@
+"""Keyset pagination of /inventory and /all: cursors, null sort values and both directions."""
+import base64
+import json
+import random
+
+import pytest
+
+
+@pytest.fixture
+def parts(seeded):
+    """The seeded rows, with nulls and repeated values in the sortable columns."""
+    rng = random.Random(5)
+    table = seeded.tables['parts']
+    for row in list(table.rows.values()):
+        changes = {}
+        if rng.random() < 0.3:
+            changes['production_no'] = None
+        if rng.random() < 0.3:
+            changes['updated_at'] = None
+        if changes:
+            table.update(row, changes)
+    return list(table.rows.values())
+
+
+def expected_ids(rows, sort, desc):
+    """Non-null values in list order (ties by id), then the nulls by id."""
+    values = sorted((r for r in rows if r.get(sort) is not None), key=lambda r: (r[sort], r['id']), reverse=desc)
+    nulls = sorted((r for r in rows if r.get(sort) is None), key=lambda r: r['id'], reverse=desc)
+    return [r['id'] for r in values + nulls]
+
+
+def fetch_page(app_module, db, list_args, **query):
+    with app_module.app.test_request_context('/', query_string=query):
+        items, next_cursor, prev_cursor = app_module.fetch_parts_page(db, list_args)
+    return [item['id'] for item in items], next_cursor, prev_cursor
+
+
+@pytest.mark.parametrize('row', [
+    {'id': 7, 'created_at': '2025-01-01T00:00:00'},
+    {'id': 8, 'production_no': 'P-"1",\\x'},
+    {'id': 9, 'updated_at': None},
+])
+def test_cursor_round_trip(app_module, row):
+    sort = next(key for key in row if key != 'id')
+    assert app_module.decode_cursor(app_module.encode_cursor(row, sort)) == (row[sort], row['id'])
+
+
+@pytest.mark.parametrize('raw', [[{'a': 1}, 2], ['x', 'y'], [None, 3.5], 'zz', [1]])
+def test_decode_cursor_rejects_malformed_tokens(app_module, raw):
+    token = base64.urlsafe_b64encode(json.dumps(raw).encode()).decode()
+    assert app_module.decode_cursor(token) is None
+    assert app_module.decode_cursor('not base64!') is None
+    assert app_module.decode_cursor(None) is None
+
+
+@pytest.mark.parametrize('order', ['asc', 'desc'])
+@pytest.mark.parametrize('sort', ['created_at', 'updated_at', 'production_no'])
+@pytest.mark.parametrize('per_page', [1, 7, 500])
+def test_pages_walk_the_list_both_ways(app_module, db, parts, sort, order, per_page):
+    list_args = {'sort': sort, 'order': order, 'per_page': per_page}
+    forward, cursor, pages = [], None, []
+    while True:
+        ids, next_cursor, prev_cursor = fetch_page(app_module, db, list_args, **({'cursor': cursor} if cursor else {}))
+        pages.append(ids)
+        forward += ids
+        if not next_cursor:
+            break
+        cursor = next_cursor
+    assert forward == expected_ids(parts, sort, order == 'desc')
+
+    # Back from the last page to the first, which has no previous page
+    backward, cursor = pages[-1], prev_cursor
+    while cursor:
+        ids, _, cursor = fetch_page(app_module, db, list_args, cursor=cursor, dir='prev')
+        backward = ids + backward
+    assert backward == forward
+
+
+def test_first_page_has_no_previous_page(app_module, db, parts):
+    ids, next_cursor, prev_cursor = fetch_page(app_module, db, {'sort': 'created_at', 'order': 'desc', 'per_page': 10})
+    assert len(ids) == 10 and next_cursor and prev_cursor is None
+
+
+def test_filters_apply_to_every_page(app_module, db, parts):
+    list_args = {'sort': 'updated_at', 'order': 'asc', 'per_page': 4, 'parts_name': 'ボルト'}
+    ids, cursor = [], None
+    while True:
+        page, cursor, _ = fetch_page(app_module, db, list_args, **({'cursor': cursor} if cursor else {}))
+        ids += page
+        if not cursor:
+            break
+    assert ids == expected_ids([r for r in parts if 'ボルト' in r['parts_name']], 'updated_at', False)
+
+
+@pytest.mark.parametrize('sort', ['updated_at', 'production_no'])
+def test_list_batches_cover_the_list(app_module, db, parts, monkeypatch, sort):
+    monkeypatch.setattr(app_module, 'db_page_size', 6)
+    batches = list(app_module.iter_list_batches(db, 'id', {'sort': sort, 'order': 'desc'}))
+    assert all(len(batch) <= 6 for batch in batches)
+    assert [row['id'] for batch in batches for row in batch] == expected_ids(parts, sort, True)
@@ -0,0 +1,96 @@
+"""The shared location snapshot of the map routes: loads, incremental refreshes and patches."""
+import pytest
+
+
+@pytest.fixture
+def snapshot(app_module, db, seeded):
+    snapshot = app_module.LocationSnapshot(refresh_interval=0, full_refresh_interval=3600)
+    snapshot.refresh(db)
+    return snapshot
+
+
+def fresh(app_module, db):
+    """A snapshot fully loaded from the current table, to compare with."""
+    snapshot = app_module.LocationSnapshot(refresh_interval=0, full_refresh_interval=3600)
+    snapshot.refresh(db)
+    return snapshot
+
+
+def contents(snapshot):
+    return ({loc: sorted(item['id'] for item in items) for loc, items in snapshot.location_items.items()},
+            snapshot.location_product_numbers)
+
+
+def test_full_load(snapshot, seeded):
+    rows = [row for row in seeded.tables['parts'].rows.values() if row['storage_location']]
+    expected = {}
+    for row in rows:
+        expected.setdefault(row['storage_location'], []).append(row['id'])
+    items, product_numbers = contents(snapshot)
+    assert items == {loc: sorted(ids) for loc, ids in expected.items()}
+    assert all(numbers == sorted(set(numbers)) for numbers in product_numbers.values())
+    assert snapshot.located_count == len(rows)
+    assert snapshot.watermark == max(row['updated_at'] for row in rows)
+
+
+def test_incremental_refresh_sees_moves_and_cleared_locations(app_module, db, seeded, snapshot):
+    parts = seeded.tables['parts']
+    located = [row for row in parts.rows.values() if row['storage_location']]
+    parts.update(located[0], {'storage_location': '9Z-99', 'updated_at': '2030-01-01T00:00:00'})
+    parts.update(located[1], {'storage_location': None, 'updated_at': '2030-01-01T00:00:01'})
+    snapshot.refresh(db)
+    assert contents(snapshot) == contents(fresh(app_module, db))
+    assert snapshot.checksum == fresh(app_module, db).checksum
+    assert snapshot.watermark == '2030-01-01T00:00:01'
+
+
+def test_patch_matches_a_reload_and_keeps_the_watermark(app_module, db, seeded, snapshot):
+    parts = seeded.tables['parts']
+    located = [row for row in parts.rows.values() if row['storage_location']]
+    watermark, checksum = snapshot.watermark, snapshot.checksum
+    moved = dict(located[0], storage_location='9Z-99', updated_at='2030-01-01T00:00:00')
+    parts.update(located[0], {'storage_location': '9Z-99', 'updated_at': '2030-01-01T00:00:00'})
+    parts.delete(located[1])
+
+    snapshot.patch([moved], deleted_ids=[located[1]['id']])
+    assert contents(snapshot) == contents(fresh(app_module, db))
+    assert snapshot.checksum == fresh(app_module, db).checksum != checksum
+    # A change the feed missed is still found by the next incremental refresh
+    assert snapshot.watermark == watermark
+
+
+def test_patch_ignores_older_versions(snapshot, seeded):
+    row = next(row for row in seeded.tables['parts'].rows.values() if row['storage_location'])
+    before = contents(snapshot), snapshot.checksum
+    snapshot.patch([dict(row, storage_location='9Z-99', updated_at='2000-01-01T00:00:00')])
+    assert (contents(snapshot), snapshot.checksum) == before
+
+
+def test_checksum_does_not_depend_on_order(app_module, snapshot):
+    rows = [item for items in snapshot.location_items.values() for item in items]
+    reversed_snapshot = app_module.LocationSnapshot(0, 3600)
+    reversed_snapshot._rebuild([rows[::-1]])
+    assert reversed_snapshot.checksum == snapshot.checksum
+    # Moving a part and moving it back restores the checksum
+    snapshot.patch([dict(rows[0], storage_location='9Z-99')])
+    assert snapshot.checksum != reversed_snapshot.checksum
+    snapshot.patch([rows[0]])
+    assert snapshot.checksum == reversed_snapshot.checksum
+
+
+def test_patch_before_the_first_load_is_ignored(app_module):
+    snapshot = app_module.LocationSnapshot(0, 3600)
+    snapshot.patch([{'id': 1, 'storage_location': '2A', 'updated_at': '2030-01-01T00:00:00'}])
+    assert snapshot.location_items == {} and not snapshot.loaded
+
+
+def test_refresh_without_a_watermark_reloads_everything(app_module, db, seeded):
+    parts = seeded.tables['parts']
+    for row in list(parts.rows.values()):
+        parts.update(row, {'updated_at': None})
+    snapshot = fresh(app_module, db)
+    assert snapshot.watermark is None
+    row = next(row for row in parts.rows.values() if row['storage_location'])
+    parts.update(row, {'storage_location': '9Z-99'})
+    snapshot.refresh(db)
+    assert '9Z-99' in snapshot.location_items
@@ -0,0 +1,106 @@
+"""Validation, deduplication and batching of the bulk parts import."""
+import io
+from datetime import date, datetime
+
+import pytest
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('2025-01-02', '2025-01-02'),
+    ('2025/1/2', '2025-01-02'),
+    ('2025.01.02', '2025-01-02'),
+    ('20250102', '2025-01-02'),
+    ('2025-01-02 10:30:00', '2025-01-02'),
+    ('2025-01-02T10:30', '2025-01-02'),
+    (datetime(2025, 1, 2, 10, 30), '2025-01-02'),
+    (date(2025, 1, 2), '2025-01-02'),
+    (' ', None),
+    (None, None),
+    (float('nan'), None),
+])
+def test_parse_delivery_date(app_module, value, expected):
+    assert app_module.parse_delivery_date(value) == expected
+
+
+@pytest.mark.parametrize('value', ['tomorrow', '2025-02-30', '02/01/2025'])
+def test_parse_delivery_date_rejects_other_text(app_module, value):
+    with pytest.raises(ValueError):
+        app_module.parse_delivery_date(value)
+
+
+def test_normalize_part(app_module):
+    part, errors = app_module.normalize_part({
+        'production_no': 1234.0, 'parts_name': ' Shaft ', 'parts_no': None, 'delivery_date': '2025/3/4', 'order_quantity': '5',
+    })
+    assert errors == []
+    assert part['production_no'] == '1234' and part['parts_name'] == 'Shaft' and part['parts_no'] == ''
+    assert part['delivery_date'] == '2025-03-04' and part['order_quantity'] == 5
+    assert 'updated_at' in part
+
+
+def test_normalize_part_reports_every_error(app_module):
+    part, errors = app_module.normalize_part({'production_no': 'P1', 'parts_name': '', 'delivery_date': 'x', 'order_quantity': 'many'})
+    assert len(errors) == 3
+    assert part['delivery_date'] is None and part['order_quantity'] is None
+
+
+def test_normalize_part_without_quantity(app_module):
+    part, errors = app_module.normalize_part({'production_no': 'P1', 'parts_name': 'Shaft', 'order_quantity': ''})
+    assert errors == [] and part['order_quantity'] is None
+    assert 'order_quantity' not in app_module.normalize_part({'production_no': 'P1', 'parts_name': 'Shaft'})[0]
+
+
+def row(production_no, parts_name='Shaft', **fields):
+    return dict({'production_no': production_no, 'parts_name': parts_name, 'parts_no': 'A-1'}, **fields)
+
+
+def test_import_dedupes_and_batches(app_module, db, fake, monkeypatch):
+    monkeypatch.setattr(app_module, 'import_batch_size', 2)
+    fake.tables['parts'].insert(dict(app_module.normalize_part(row('P0'))[0], id=1))
+    history = []
+    chunks = [
+        [(2, row('P0')), (3, row('P1')), (4, row('P1')), (5, row('P2', delivery_date='x'))],
+        [(6, {'production_no': '', 'parts_name': None}), (7, row('P1')), (8, row('P3')), (9, row('P4')), (10, row('P5'))],
+    ]
+    report = app_module.import_parts(db, chunks, history.extend, 'parts.csv')
+
+    assert report['total'] == 8  # the blank line 6 is not counted
+    assert report['inserted'] == 4  # P1, P3, P4, P5
+    assert report['skipped'] == 3  # P0 exists in the table, P1 twice earlier in the file
+    assert report['error_count'] == 1 and report['errors'][0][0] == 5
+    assert sorted(r['production_no'] for r in fake.tables['parts'].rows.values()) == ['P0', 'P1', 'P3', 'P4', 'P5']
+    assert sorted(entry['production_no'] for entry in history) == ['P1', 'P3', 'P4', 'P5']
+
+
+def test_import_caps_reported_errors(app_module, db, monkeypatch):
+    monkeypatch.setattr(app_module, 'import_max_reported_errors', 2)
+    report = app_module.import_parts(db, [[(line, row('')) for line in range(2, 7)]], lambda entries: None, 'parts.csv')
+    assert report['error_count'] == 5 and [line for line, _ in report['errors']] == [2, 3]
+
+
+def test_csv_rows_map_header_aliases(app_module):
+    text = '製番,品名,数量\nP1,シャフト,3\nP2,ギア,\n'
+    for encoding in ('utf-8-sig', 'cp932'):
+        chunks = list(app_module.iter_import_rows(io.BytesIO(text.encode(encoding)), 'parts.CSV', 1))
+        assert chunks == [[(2, {'production_no': 'P1', 'parts_name': 'シャフト', 'order_quantity': '3'})],
+                          [(3, {'production_no': 'P2', 'parts_name': 'ギア', 'order_quantity': ''})]]
+
+
+def test_xlsx_rows(app_module):
+    from openpyxl import Workbook
+
+    workbook = Workbook()
+    workbook.active.append(['製番', '品名', '納期'])
+    workbook.active.append([1234, 'シャフト', datetime(2025, 1, 2)])
+    stream = io.BytesIO()
+    workbook.save(stream)
+    stream.seek(0)
+    [[(line_no, fields)]] = list(app_module.iter_import_rows(stream, 'parts.xlsx', 10))
+    part, errors = app_module.normalize_part(fields)
+    assert line_no == 2 and errors == []
+    assert (part['production_no'], part['delivery_date']) == ('1234', '2025-01-02')
+
+
+def test_unknown_file_type(app_module):
+    with pytest.raises(ValueError):
+        app_module.iter_import_rows(io.BytesIO(b''), 'parts.pdf', 10)
@@ -0,0 +1,110 @@
+"""
+The read replica's PostgREST stand-in (ReplicaQuery): every query must return what the
+same query returns from PostgREST, here the fake of bench/fake_postgrest.py.
+"""
+import pytest
+
+
+@pytest.fixture
+def parts(seeded):
+    table = seeded.tables['parts']
+    rows = list(table.rows.values())
+    for row, name in zip(rows, ['ＢＯＬＴ ｍ８', 'Bolt 50%_off', 'x,y (z) "q"', 'a\\b', 'Ärmel']):
+        table.update(row, {'parts_name': name})
+    table.update(rows[5], {'production_no': None})
+    return rows
+
+
+@pytest.fixture
+def replica(app_module, db, parts, tmp_path):
+    replica = app_module.ReadReplica(str(tmp_path / 'replica.db'), 0, 3600)
+    replica.sync(db)
+    assert replica.ready
+    return replica
+
+
+QUERIES = {
+    'eq': lambda q: q.eq('production_no', 'P000001'),
+    'neq': lambda q: q.neq('storage_location', '2B-03'),
+    'range': lambda q: q.gte('created_at', '2025-01-01T00:10:00').lt('created_at', '2025-01-01T00:20:00'),
+    'in': lambda q: q.in_('storage_location', ['1A-01', '22A-01']),
+    'is null': lambda q: q.is_('storage_location', 'null'),
+    'not is null': lambda q: q.not_.is_('storage_location', 'null'),
+    'ilike ascii': lambda q: q.ilike('parts_name', '%bolt%'),
+    'ilike full-width': lambda q: q.ilike('parts_name', '%ｂｏｌｔ%'),
+    'ilike accented': lambda q: q.ilike('parts_name', 'ärmel'),
+    'ilike escaped': lambda q: q.ilike('parts_name', '%50\\%\\_%'),
+    'ilike backslash': lambda q: q.ilike('parts_name', '%a\\\\b%'),
+    'or quoted': lambda q: q.or_('parts_name.eq."x,y (z) \\"q\\"",production_no.eq.P000002'),
+    'or nested': lambda q: q.or_('storage_location.is.null,and(production_no.eq.P000000,storage_location.neq.7C-02)'),
+    'or negated': lambda q: q.or_('storage_location.not.is.null,production_no.is.null'),
+    'order nulls first': lambda q: q.order('storage_location', nullsfirst=True).order('id', desc=True).limit(30),
+    'order desc': lambda q: q.order('production_no', desc=True).order('id').limit(30),
+}
+
+
+@pytest.mark.parametrize('name', QUERIES)
+def test_replica_returns_the_postgrest_rows(app_module, db, replica, name):
+    build = QUERIES[name]
+    expected = build(db.table('parts').select('id, production_no')).execute().data
+    got = build(replica.client().table('parts').select('id, production_no')).execute().data
+    if not name.startswith('order'):
+        # Without order() neither returns the rows in a defined order
+        expected, got = (sorted(rows, key=lambda row: row['id']) for rows in (expected, got))
+    assert got == expected
+    assert name.startswith('order') or expected  # every filter matches something
+
+
+def test_exact_count_and_single(db, replica):
+    query = lambda client: client.table('parts').select('id', count='exact').eq('production_no', 'P000001').limit(2)
+    assert replica.client().table('parts').select('*').eq('id', 3).single().execute().data == \
+        db.table('parts').select('*').eq('id', 3).single().execute().data
+    assert query(replica.client()).execute().count == query(db).execute().count
+    with pytest.raises(Exception) as error:
+        replica.client().table('parts').select('id').eq('production_no', 'P000001').single().execute()
+    assert error.value.code == 'PGRST116'
+
+
+def test_summary_view(db, replica):
+    query = lambda client: client.table('parts_production_summary').select('order_slip_no, storage_location, part_count') \
+        .eq('production_no', 'P000002')
+    key = lambda row: (row['order_slip_no'], row['storage_location'] or '')
+    assert sorted(query(replica.client()).execute().data, key=key) == sorted(query(db).execute().data, key=key)
+
+
+def test_write_through(replica, parts):
+    client = replica.client()
+    replica.apply([dict(parts[0], storage_location='9Z-99', updated_at='2030-01-01T00:00:00')])
+    replica.discard([parts[1]['id']])
+    assert client.table('parts').select('storage_location').eq('id', parts[0]['id']).execute().data == [{'storage_location': '9Z-99'}]
+    assert client.table('parts').select('id').eq('id', parts[1]['id']).execute().data == []
+    # An older version of a row does not replace a newer one
+    replica.apply([dict(parts[0], storage_location='1A-01', updated_at='2029-01-01T00:00:00')])
+    assert client.table('parts').select('storage_location').eq('id', parts[0]['id']).execute().data == [{'storage_location': '9Z-99'}]
+
+
+@pytest.mark.parametrize('build', [
+    lambda q: q.eq('data', 'x'),
+    lambda q: q.eq('id; drop table parts', 1),
+    lambda q: q.or_('production_no.fts.bolt'),
+])
+def test_unsupported_filters_are_refused(replica, build):
+    with pytest.raises(ValueError):
+        build(replica.client().table('parts').select('id'))
+    with pytest.raises(ValueError):
+        replica.client().table('work_history')
+
+
+@pytest.mark.parametrize('text, parts', [
+    ('a.eq.1', ['a.eq.1']),
+    ('a.eq.1,and(b.eq.2,or(c.eq.3,d.eq.4)),e.is.null', ['a.eq.1', 'and(b.eq.2,or(c.eq.3,d.eq.4))', 'e.is.null']),
+    ('a.eq."x,(y",b.eq.2', ['a.eq."x,(y"', 'b.eq.2']),
+    ('a.eq."x\\",y",b.eq.2', ['a.eq."x\\",y"', 'b.eq.2']),
+])
+def test_split_postgrest_logic(app_module, text, parts):
+    assert app_module.split_postgrest_logic(text) == parts
+
+
+@pytest.mark.parametrize('value', ['plain', 'x,y', 'quote " and \\ backslash', '(paren)', ''])
+def test_quote_round_trip(app_module, value):
+    assert app_module.unquote_postgrest_value(app_module.postgrest_quote(value)) == value
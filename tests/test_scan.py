@@ -0,0 +1,67 @@
+"""Resolution of scanned codes to the page they open."""
+import pytest
+
+
+def part(row_id, production_no='P1', order_slip_no='S1', parts_no=None, storage_location=None):
+    return {'id': row_id, 'production_no': production_no, 'order_slip_no': order_slip_no,
+            'parts_no': parts_no or f'PN-{row_id}', 'storage_location': storage_location}
+
+
+@pytest.mark.parametrize('column, code, rows, expected', [
+    # A slip with an unlocated part (those come first) opens its location form
+    ('order_slip_no', 'S1', [part(1), part(2, storage_location='2A')], '/update/S1'),
+    ('order_slip_no', 'S1', [part(1, storage_location='')], '/update/S1'),
+    # A fully located slip opens its part, its production number, or the search results
+    ('order_slip_no', 'S1', [part(1, storage_location='2A')], '/item/1'),
+    ('order_slip_no', 'S1', [part(1, storage_location='2A'), part(2, storage_location='3B')], '/production/P1'),
+    ('order_slip_no', 'S1', [part(1, storage_location='2A'), part(2, 'P2', storage_location='3B')], '/search?search_term=S1'),
+    ('production_no', 'P1', [part(1)], '/production/P1'),
+    ('parts_no', 'PN-1', [part(1)], '/item/1'),
+    ('parts_no', 'DUP', [part(1, parts_no='DUP'), part(2, parts_no='DUP')], '/search?search_term=DUP'),
+    (None, 'X1', [], '/search?search_term=X1'),
+])
+def test_scan_target_url(app_module, column, code, rows, expected):
+    with app_module.app.test_request_context('/'):
+        assert app_module.scan_target_url(column, rows, code) == expected
+
+
+@pytest.fixture
+def parts(fake):
+    table = fake.tables['parts']
+    rows = [
+        part(1, 'P1', 'S1', storage_location='2A'),
+        part(2, 'P1', 'S1', storage_location='3B'),
+        part(3, 'P2', 'S2', storage_location='2A'),
+        part(4, 'P2', 'S2'),
+        # 'S3' is also a production number; the slip wins
+        part(5, 'S3', 'S3', storage_location='4C'),
+        part(6, 'P3', 'S4', parts_no='DUP', storage_location='2A'),
+        part(7, 'P3', 'S4', parts_no='DUP', storage_location='2A'),
+    ]
+    for row in rows:
+        table.insert(dict(row, parts_name=f'part {row["id"]}', created_at='2025-01-01T00:00:00', updated_at='2025-01-01T00:00:00'))
+    return rows
+
+
+@pytest.mark.parametrize('code, match, url', [
+    ('S1', 'order_slip_no', '/production/P1'),
+    ('S2', 'order_slip_no', '/update/S2'),
+    ('S3', 'order_slip_no', '/item/5'),
+    ('P2', 'production_no', '/production/P2'),
+    ('PN-3', 'parts_no', '/item/3'),
+    ('DUP', 'parts_no', '/search?search_term=DUP'),
+    ('part 1', 'search', '/search?search_term=part+1'),
+])
+def test_scan_api(client, parts, code, match, url):
+    response = client.get(f'/api/v1/scan/{code}')
+    assert response.status_code == 200
+    assert (response.get_json()['match'], response.get_json()['url']) == (match, url)
+
+
+def test_scan_api_miss(client, parts):
+    assert client.get('/api/v1/scan/nothing-like-this').status_code == 404
+
+
+def test_scan_page_redirects(client, parts):
+    response = client.get('/scan?code= S2 ')
+    assert response.status_code == 302 and response.headers['Location'].endswith('/update/S2')
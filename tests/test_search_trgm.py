@@ -0,0 +1,122 @@
+"""
+Checks supabase/migrations/20261018000100_parts_search_trgm.sql on a throwaway local
+PostgreSQL (pgserver): search_parts_ranked must return the rows the ILIKE search of
+search_parts() in app.py returns, with exact code matches first.
+
+If the server has no pg_trgm (pgserver's does not), the migration is applied without the
+extension and its index, and word_similarity() is replaced by a plain SQL stand-in: the rows
+and the exact-match ordering are still those of the function, only the trigram ranking of
+the remaining rows is not checked.
+
+    python -m pytest tests/test_search_trgm.py
+"""
+import os
+import re
+
+import pytest
+
+pgserver = pytest.importorskip('pgserver')
+psycopg2 = pytest.importorskip('psycopg2')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MIGRATION = os.path.join(ROOT, 'supabase', 'migrations', '20261018000100_parts_search_trgm.sql')
+SEARCH_COLUMNS = ('production_no', 'parts_no', 'parts_name', 'drawing_no', 'order_slip_no')
+
+# Only the columns the search reads; the real table has more
+SCHEMA = """
+do $$ begin
+    if not exists (select 1 from pg_roles where rolname = 'authenticated') then
+        create role authenticated;
+    end if;
+end $$;
+create table public.parts (
+    id bigserial primary key,
+    production_no text,
+    parts_no text,
+    parts_name text,
+    drawing_no text,
+    order_slip_no text,
+    created_at timestamptz not null default now()
+);
+"""
+
+# Used instead of pg_trgm's word_similarity() where the extension is not available
+WORD_SIMILARITY_STAND_IN = """
+create function public.word_similarity(term text, document text) returns real
+language sql immutable
+as $$ select (strpos(document, term) > 0)::int::real $$;
+"""
+
+# (production_no, parts_no, parts_name, drawing_no, order_slip_no)
+PARTS = [
+    ('P-100', 'A-1', 'Hex bolt 10', 'D-100-1', 'S-500'),
+    ('P-1000', 'A-2', 'Bolt', '12', 'S-501'),
+    ('P-2000', 'P-100', 'Washer', 'DP-100-2', 'S-502'),
+    ('P-3000', 'B-1', 'ナット 部品', None, 'P-100'),
+    ('P-4000', 'C_1', 'Spacer 50%', 'x\\y', 'S-503'),
+    ('P-5000', 'C-1', 'SPACER', None, None),
+    (None, None, 'Pin', None, 'S-504'),
+]
+
+TERMS = [
+    'P-100', 'p-100', '100', 'bolt', 'BOLT', 'bolt 1', '10 d', 'S-50', 'S-500', 'A-1',
+    '部品', 'ナット', '%', '50%', '_', 'C_1', '\\', 'x\\y', 'spacer', 'zzz',
+]
+
+
+@pytest.fixture(scope='module')
+def conn(tmp_path_factory):
+    server = pgserver.get_server(tmp_path_factory.mktemp('pgdata'), cleanup_mode='stop')
+    connection = psycopg2.connect(server.get_uri())
+    connection.autocommit = True
+    with connection.cursor() as cur:
+        cur.execute(SCHEMA)
+        cur.executemany(
+            "insert into public.parts (production_no, parts_no, parts_name, drawing_no, order_slip_no, created_at) "
+            "values (%s, %s, %s, %s, %s, now() - %s * interval '1 minute')",
+            [part + (index,) for index, part in enumerate(PARTS)])
+        with open(MIGRATION, encoding='utf-8') as f:
+            migration = f.read()
+        cur.execute("select exists (select 1 from pg_available_extensions where name = 'pg_trgm')")
+        if not cur.fetchone()[0]:
+            migration = re.sub(r"create extension if not exists pg_trgm;", "", migration)
+            migration = re.sub(r"create index if not exists \w+\s+on public\.parts using gin \(search_text gin_trgm_ops\);",
+                               "", migration)
+            assert 'pg_trgm' not in migration and 'gin_trgm_ops' not in migration
+            cur.execute(WORD_SIMILARITY_STAND_IN)
+        cur.execute(migration)
+    yield connection
+    connection.close()
+
+
+@pytest.fixture(scope='module')
+def escape_like_term(app_module):
+    return app_module.escape_like_term
+
+
+def ilike_ids(conn, escape_like_term, term):
+    """The ids matched by the ILIKE search of app.py (the same or-filter, run in SQL)."""
+    pattern = escape_like_term(term)
+    with conn.cursor() as cur:
+        cur.execute("select id from public.parts where " + " or ".join(f"{c} ilike %(p)s" for c in SEARCH_COLUMNS),
+                    {'p': pattern})
+        return {row[0] for row in cur.fetchall()}
+
+
+def ranked(conn, term):
+    with conn.cursor() as cur:
+        cur.execute("select id, production_no, parts_no, order_slip_no from public.search_parts_ranked(%s)", (term,))
+        return cur.fetchall()
+
+
+@pytest.mark.parametrize('term', TERMS)
+def test_ranked_search_matches_ilike_rows(conn, escape_like_term, term):
+    assert {row[0] for row in ranked(conn, term)} == ilike_ids(conn, escape_like_term, term)
+
+
+@pytest.mark.parametrize('term', ['P-100', 'S-500', 'A-1'])
+def test_exact_code_matches_rank_first(conn, term):
+    rows = ranked(conn, term)
+    exact = [term in row[1:] for row in rows]
+    assert any(exact)
+    assert exact == sorted(exact, reverse=True)
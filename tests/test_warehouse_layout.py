@@ -0,0 +1,53 @@
+"""Classification of location codes into map areas (WarehouseLayout)."""
+import pytest
+
+
+@pytest.fixture
+def layout(app_module):
+    return app_module.WarehouseLayout({
+        'north': {'shelves': [2, 3], 'slots': ['A', 'B']},
+        'south': {'shelves': [22, 23], 'slots': ['A', 'B']},
+    })
+
+
+@pytest.mark.parametrize('location, key', [
+    ('22A', (22, 'A')),
+    ('22a', (22, 'A')),
+    ('2', (2, '')),
+    ('22A-1', (22, 'A')),
+    ('040X', (40, 'X')),
+    ('A-22', None),
+    ('', None),
+    (None, None),
+])
+def test_parse_location(app_module, location, key):
+    assert app_module.WarehouseLayout.parse_location(location) == key
+
+
+@pytest.mark.parametrize('location, area', [
+    ('22A', 'south'),
+    ('2A', 'north'),
+    ('2', 'north'),
+    ('22', 'south'),
+    ('23B-4', 'south'),
+    ('2Z', 'north'),  # unknown slot of a known shelf
+    ('222A', None),
+    ('4A', None),
+    ('X', None),
+    (None, None),
+])
+def test_area_of_uses_the_whole_shelf_number(layout, location, area):
+    assert layout.area_of(location) == area
+    # Memoised lookups give the same answer
+    assert layout.area_of(location) == area
+
+
+def test_area_locations(layout):
+    index = {'2A': 1, '22A': 2, '3B': 3, '23A-1': 4, '9A': 5}
+    assert layout.area_locations(index, 'north') == {'2A': 1, '3B': 3}
+    assert layout.area_locations(index, 'south') == {'22A': 2, '23A-1': 4}
+
+
+@pytest.mark.parametrize('location, area', [('2A', 'north'), ('22A', 'south'), ('40X', 'small'), ('39A', 'small'), ('1A', None)])
+def test_warehouse_areas(app_module, location, area):
+    assert app_module.warehouse_layout.area_of(location) == area
@@ -0,0 +1,80 @@
+"""Keyset paging and filters of the work history browser and timelines."""
+import pytest
+
+
+@pytest.fixture
+def history(fake):
+    """120 entries over 3 parts and 2 production numbers; every 4 share a created_at."""
+    table = fake.tables['work_history']
+    for n in range(120):
+        table.insert({
+            'id': n + 1, 'item_id': n % 3 + 1, 'production_no': f'P{n % 2}', 'parts_name': f'part {n % 3 + 1}',
+            'action': '移動' if n % 5 else '更新', 'details': '', 'user_email': f'user{n % 2}@example.com',
+            'created_at': f'2025-01-{n // 40 + 1:02d}T{n // 4 % 10:02d}:00:00+09:00',
+        })
+    return list(table.rows.values())
+
+
+def newest_first(rows):
+    return [row['id'] for row in sorted(rows, key=lambda row: (row['created_at'], row['id']), reverse=True)]
+
+
+def walk(app_module, db, history_args, per_page):
+    """Pages forward from the newest entry, then back from the last page; returns both id lists."""
+    forward, cursor, pages = [], None, []
+    while True:
+        rows, next_cursor, prev_cursor = app_module.fetch_history_page(db, history_args, per_page, cursor)
+        assert (prev_cursor is None) == (cursor is None)
+        pages.append((rows, prev_cursor))
+        forward += [row['id'] for row in rows]
+        if not next_cursor:
+            break
+        cursor = app_module.decode_cursor(next_cursor)
+    rows, prev_cursor = pages[-1]
+    backward = [row['id'] for row in rows]
+    while prev_cursor:
+        rows, _, prev_cursor = app_module.fetch_history_page(db, history_args, per_page, app_module.decode_cursor(prev_cursor),
+                                                             backwards=True)
+        backward = [row['id'] for row in rows] + backward
+    return forward, backward
+
+
+@pytest.mark.parametrize('history_args', [{}, {'item_id': '2'}, {'production_no': 'P1'}, {'action': '更新'},
+                                          {'user_email': 'user0@example.com', 'action': '移動'}])
+@pytest.mark.parametrize('per_page', [1, 7, 50])
+def test_pages_walk_the_history_both_ways(app_module, db, history, history_args, per_page):
+    expected = newest_first([row for row in history if all(str(row[key]) == value for key, value in history_args.items())])
+    forward, backward = walk(app_module, db, history_args, per_page)
+    assert forward == expected
+    assert backward == expected
+
+
+def test_date_range_is_a_day_range_in_the_history_timezone(app_module, db, history):
+    assert app_module.history_day_start('2025-01-02') == '2025-01-02T00:00:00+09:00'
+    assert app_module.history_day_start('2025-01-31', days=1) == '2025-02-01T00:00:00+09:00'
+    forward, _ = walk(app_module, db, {'date_from': '2025-01-02', 'date_to': '2025-01-02'}, 9)
+    assert forward == newest_first([row for row in history if row['created_at'].startswith('2025-01-02')])
+
+
+def test_history_args_ignore_malformed_dates(app_module):
+    query = {'date_from': '2025-13-01', 'date_to': '2025-01-05', 'production_no': ' P1 ', 'unknown': 'x', 'action': ''}
+    with app_module.app.test_request_context('/history', query_string=query):
+        assert app_module.get_history_args() == {'production_no': 'P1', 'date_to': '2025-01-05'}
+
+
+def test_timeline(app_module, db, history, monkeypatch):
+    monkeypatch.setattr(app_module, 'history_timeline_size', 5)
+    expected = newest_first([row for row in history if row['item_id'] == 3])
+    with app_module.app.test_request_context('/'):
+        app_module.g.db = db
+        timeline = app_module.fetch_history_timeline({'item_id': 3})
+        # The same result from the query run together with a page's other queries
+        response = app_module.history_timeline_query({'item_id': 3})(db).execute()
+        gathered = app_module.fetch_history_timeline({'item_id': 3}, response)
+    assert [row['id'] for row in timeline['rows']] == expected[:5] and timeline['has_more']
+    assert gathered == timeline
+
+
+def test_timeline_error_hides_the_timeline(app_module):
+    with app_module.app.test_request_context('/'):
+        assert app_module.fetch_history_timeline({'item_id': 3}, RuntimeError('timed out')) is None